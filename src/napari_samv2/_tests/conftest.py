@@ -0,0 +1,197 @@
+# Mocked SAM V2 predictors and engines shared by the engine tests and the
+# benchmarks. Neither a GPU nor a checkpoint is needed.
+import numpy as np
+import pytest
+import torch
+
+from pipelines.samv2 import Samv2_engine
+
+MODEL_IMAGE_SIZE = 256
+
+
+# Stand-in for the SAM V2 video predictor with the same interface. Masks
+# are discs around the last click of every object, every frame goes through
+# the real frame loader so frame conversion is part of the timings.
+class MockPredictor:
+    image_size = MODEL_IMAGE_SIZE
+    device = torch.device("cpu")
+
+    def init_state(self, video_path):
+        frames = video_path
+        return {
+            "images": frames,
+            "num_frames": len(frames),
+            "video_height": frames.video_height,
+            "video_width": frames.video_width,
+            "device": self.device,
+            "cached_features": {},
+            "clicks": {},
+        }
+
+    def reset_state(self, inference_state):
+        inference_state["clicks"].clear()
+
+    # Image encoder, the masks only depend on the clicks
+    def _get_image_feature(self, inference_state, frame_idx, batch_size):
+        pass
+
+    def _logits(self, inference_state, frame_idx):
+        image = inference_state["images"][frame_idx]
+        height = inference_state["video_height"]
+        width = inference_state["video_width"]
+        obj_ids = sorted(inference_state["clicks"])
+        yy = torch.arange(height, dtype=torch.float32)[:, None]
+        xx = torch.arange(width, dtype=torch.float32)[None, :]
+        logits = torch.stack(
+            [
+                20.0
+                - torch.sqrt((yy - y) ** 2 + (xx - x) ** 2)
+                + image.mean()
+                for x, y in (inference_state["clicks"][i] for i in obj_ids)
+            ]
+        )
+        return obj_ids, logits[:, None]
+
+    def add_new_points_or_box(
+            self,
+            inference_state,
+            frame_idx,
+            obj_id,
+            points,
+            labels,
+            clear_old_points=True,
+    ):
+        inference_state["clicks"][obj_id] = tuple(points[-1])
+        obj_ids, logits = self._logits(inference_state, frame_idx)
+        return frame_idx, obj_ids, logits
+
+    def propagate_in_video(
+            self,
+            inference_state,
+            start_frame_idx=0,
+            max_frame_num_to_track=None,
+            reverse=False,
+    ):
+        num_frames = inference_state["num_frames"]
+        if max_frame_num_to_track is None:
+            max_frame_num_to_track = num_frames
+        if reverse:
+            end = max(start_frame_idx - max_frame_num_to_track, 0)
+            frames = range(start_frame_idx, end - 1, -1)
+        else:
+            end = min(start_frame_idx + max_frame_num_to_track, num_frames - 1)
+            frames = range(start_frame_idx, end + 1)
+        for frame_idx in frames:
+            obj_ids, logits = self._logits(inference_state, frame_idx)
+            yield frame_idx, obj_ids, logits
+
+
+# MockPredictor with a memory bank like SAM2's: every tracked frame is
+# stored in the per object outputs of the state and shifts the logits of
+# the frames tracked after it, so the masks depend on the frames read back.
+class MemoryMockPredictor(MockPredictor):
+    num_maskmem = 2
+    max_obj_ptrs_in_encoder = 3
+
+    def init_state(self, video_path):
+        state = super().init_state(video_path)
+        state["output_dict_per_obj"] = {}
+        return state
+
+    def reset_state(self, inference_state):
+        super().reset_state(inference_state)
+        inference_state["output_dict_per_obj"].clear()
+
+    def _obj_outputs(self, inference_state, obj_id):
+        return inference_state["output_dict_per_obj"].setdefault(
+            obj_id, {"cond_frame_outputs": {}, "non_cond_frame_outputs": {}}
+        )
+
+    def add_new_points_or_box(self, inference_state, frame_idx, *args, **kwargs):
+        frame_idx, obj_ids, logits = super().add_new_points_or_box(
+            inference_state, frame_idx, *args, **kwargs
+        )
+        for obj_id, obj_logits in zip(obj_ids, logits):
+            outputs = self._obj_outputs(inference_state, obj_id)
+            outputs["cond_frame_outputs"][frame_idx] = {
+                "maskmem_features": obj_logits.mean().reshape(1)
+            }
+        return frame_idx, obj_ids, logits
+
+    def propagate_in_video(self, inference_state, *args, reverse=False, **kwargs):
+        step = 1 if reverse else -1
+        for frame_idx, obj_ids, logits in super().propagate_in_video(
+                inference_state, *args, reverse=reverse, **kwargs
+        ):
+            logits = logits.clone()
+            for i, obj_id in enumerate(obj_ids):
+                outputs = self._obj_outputs(inference_state, obj_id)
+                if frame_idx in outputs["cond_frame_outputs"]:
+                    continue
+                memory = outputs["non_cond_frame_outputs"]
+                for t in range(1, self.max_obj_ptrs_in_encoder + 1):
+                    previous = memory.get(frame_idx + t * step)
+                    if previous is not None:
+                        logits[i] += 0.5**t * previous["maskmem_features"]
+                memory[frame_idx] = {
+                    "maskmem_features": logits[i].mean().reshape(1) / 10
+                }
+            yield frame_idx, obj_ids, logits
+
+
+# Predictor pool handing out a new mock predictor on every acquire; set
+# predictor_class to switch the mock
+class MockPool:
+    predictor_class = MockPredictor
+
+    def acquire(self, *args, **kwargs):
+        return self.predictor_class()
+
+    def release(self, predictor):
+        pass
+
+
+# Random uint16 stack for the engine tests
+@pytest.fixture
+def volume():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 2**16 - 1, (16, 256, 256), dtype=np.uint16)
+
+
+# The pool every engine of the test acquires its predictor from
+@pytest.fixture
+def mock_pool(monkeypatch):
+    pool = MockPool()
+    monkeypatch.setattr(Samv2_engine, "get_predictor_pool", lambda: pool)
+    monkeypatch.setattr(
+        Samv2_engine,
+        "init_state_from_frames",
+        lambda predictor, frames, **kwargs: predictor.init_state(
+            video_path=frames
+        ),
+    )
+    return pool
+
+
+# Mocked pool handing out predictors with a SAM2 like memory bank
+@pytest.fixture
+def memory_mock_pool(mock_pool):
+    mock_pool.predictor_class = MemoryMockPredictor
+    return mock_pool
+
+
+# Engines on the mocked predictor pool. Also patches the engines a
+# SeriesEngine builds for its timepoints.
+@pytest.fixture
+def make_engine(mock_pool, tmp_path):
+    def make(volume, **kwargs):
+        return Samv2_engine.SamV2Engine(
+            volume,
+            "mock.pt",
+            "mock.yaml",
+            tmp_path,
+            device="cpu",
+            **kwargs,
+        )
+
+    return make
@@ -0,0 +1,237 @@
+# Benchmarks of the preprocessing, click and propagation paths.
+#
+# Runs on the CPU with synthetic volumes and the mocked predictor of
+# conftest.py, so neither a GPU nor a SAM V2 checkpoint is needed. Only
+# timings are recorded here, the results of these paths are checked by the
+# per feature test modules. Save a run with
+#   pytest src/napari_samv2/_tests/test_benchmarks.py --benchmark-autosave
+# and compare it with the saved runs with --benchmark-compare.
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytest_benchmark")
+
+from pipelines.samv2.Samv2_frame_export import (  # noqa: E402
+    MANIFEST_NAME,
+    export_frames,
+)
+from pipelines.samv2.Samv2_frame_source import VolumeFrameLoader  # noqa: E402
+from pipelines.samv2.Samv2_normalization import (  # noqa: E402
+    compute_contrast_policy,
+    convert_volume_to_8bit,
+)
+from pipelines.samv2.Samv2_series import SeriesEngine  # noqa: E402
+from pipelines.samv2.Samv2_session import (  # noqa: E402
+    load_session,
+    save_session,
+)
+
+SHAPES = {
+    "16x256x256": (16, 256, 256),
+    "32x512x512": (32, 512, 512),
+}
+DTYPES = ("uint8", "uint16", "float32")
+MODEL_IMAGE_SIZE = 256
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def record(benchmark, **info):
+    benchmark.extra_info.update(info)
+    benchmark.extra_info["peak_rss_mb"] = peak_rss_mb()
+
+
+def synthetic_volume(shape, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return rng.random(shape, dtype=np.float32).astype(dtype)
+    return rng.integers(0, np.iinfo(dtype).max, shape, dtype=dtype)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_convert_to_8bit(benchmark, shape, dtype):
+    volume = synthetic_volume(shape, dtype)
+    policy = compute_contrast_policy(volume, "percentile")
+    out = np.empty(shape, dtype=np.uint8)
+
+    benchmark(convert_volume_to_8bit, volume, policy, out=out)
+    record(
+        benchmark,
+        frames_per_s=shape[0] / benchmark.stats.stats.mean,
+    )
+
+
+@pytest.mark.parametrize("dtype", ("uint8", "uint16"))
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_export_frames(benchmark, tmp_path, shape, dtype):
+    volume = synthetic_volume(shape, dtype)
+    policy = compute_contrast_policy(volume, "percentile")
+
+    # Drop the manifest so every round exports instead of reusing frames
+    def setup():
+        (tmp_path / MANIFEST_NAME).unlink(missing_ok=True)
+
+    benchmark.pedantic(
+        export_frames,
+        args=(volume, tmp_path, policy),
+        setup=setup,
+        rounds=3,
+    )
+    record(
+        benchmark,
+        frames_per_s=shape[0] / benchmark.stats.stats.mean,
+    )
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_frame_loading(benchmark, dtype):
+    volume = synthetic_volume(SHAPES["32x512x512"], dtype)
+    loader = VolumeFrameLoader(
+        volume,
+        MODEL_IMAGE_SIZE,
+        contrast_policy=compute_contrast_policy(volume, "percentile"),
+    )
+    frames = iter(range(10**9))
+
+    benchmark(lambda: loader.load_frame(next(frames) % len(loader)))
+    record(benchmark, ms_per_frame=benchmark.stats.stats.mean * 1000)
+
+
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_click_latency(benchmark, make_engine, shape):
+    engine = make_engine(synthetic_volume(shape, "uint16"))
+    clicks = iter(range(10**9))
+
+    def click():
+        i = next(clicks)
+        engine.add_point(
+            i % shape[0], shape[1] // 2, shape[2] // 2, 1 + i % 3
+        )
+
+    benchmark(click)
+    record(benchmark, ms_per_click=benchmark.stats.stats.mean * 1000)
+    engine.close()
+
+
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_propagation(benchmark, make_engine, shape):
+    engine = make_engine(synthetic_volume(shape, "uint16"))
+    for obj_id in (1, 2, 3):
+        engine.add_point(
+            shape[0] // 2, obj_id * shape[1] // 4, shape[2] // 2, obj_id
+        )
+
+    benchmark.pedantic(engine.propagate, rounds=3)
+    # Both passes cover the prompted frame
+    frames = shape[0] + 1
+    record(
+        benchmark,
+        ms_per_frame=benchmark.stats.stats.mean * 1000 / frames,
+        frames_per_s=frames / benchmark.stats.stats.mean,
+    )
+    engine.close()
+
+
+@pytest.mark.parametrize("shape", SHAPES.values(), ids=SHAPES.keys())
+def test_incremental_propagation(benchmark, make_engine, shape):
+    engine = make_engine(synthetic_volume(shape, "uint16"))
+    for obj_id in (1, 2, 3):
+        engine.add_point(
+            shape[0] // 2, obj_id * shape[1] // 4, shape[2] // 2, obj_id
+        )
+    engine.propagate()
+    # Correction click on the middle object
+    correction = (shape[0] // 2, shape[1] // 2 + 4, shape[2] // 2, 2)
+    engine.add_point(*correction)
+
+    frames = benchmark.pedantic(
+        lambda: len(list(engine.iter_incremental_propagate())), rounds=3
+    )
+    record(
+        benchmark,
+        frames=frames,
+        ms_per_frame=benchmark.stats.stats.mean * 1000 / frames,
+    )
+    engine.close()
+
+
+@pytest.mark.parametrize("stride", (4, 8))
+def test_preview_propagation(benchmark, make_engine, stride):
+    shape = SHAPES["32x512x512"]
+    engine = make_engine(synthetic_volume(shape, "uint16"))
+    for obj_id in (1, 2, 3):
+        engine.add_point(
+            shape[0] // 2, obj_id * shape[1] // 4, shape[2] // 2, obj_id
+        )
+
+    benchmark.pedantic(
+        lambda: list(engine.iter_preview_propagate(stride=stride, xy_step=2)),
+        rounds=3,
+    )
+    record(
+        benchmark,
+        stride=stride,
+        frames_per_s=shape[0] / benchmark.stats.stats.mean,
+    )
+    engine.close()
+
+
+def test_session_load(benchmark, make_engine, tmp_path):
+    shape = SHAPES["32x512x512"]
+    volume = synthetic_volume(shape, "uint16")
+    engine = make_engine(volume)
+    for obj_id in (1, 2, 3):
+        engine.add_point(
+            shape[0] // 2, obj_id * shape[1] // 4, shape[2] // 2, obj_id
+        )
+    engine.propagate()
+    session_path = save_session(engine, tmp_path / "volume.samv2")
+
+    resumed = make_engine(volume)
+    benchmark.pedantic(load_session, args=(resumed, session_path), rounds=3)
+    record(
+        benchmark,
+        session_mb=session_path.stat().st_size / 1024**2,
+        ms_per_load=benchmark.stats.stats.mean * 1000,
+    )
+    engine.close()
+    resumed.close()
+
+
+@pytest.mark.parametrize("workers", (1, 4))
+# mock_pool also patches the engines of the timepoints
+def test_series_propagation(benchmark, mock_pool, tmp_path, workers):
+    timepoints, *shape = (4,) + SHAPES["16x256x256"]
+    volume = synthetic_volume((timepoints, *shape), "uint16")
+    engine = SeriesEngine(
+        volume, "mock.pt", "mock.yaml", tmp_path, max_workers=workers, device="cpu"
+    )
+    # One object per timepoint, clicked at a different place in each
+    prompts = [
+        (t, shape[0] // 2, shape[1] // 2, (t + 1) * shape[2] // 6, 1, t + 1)
+        for t in range(timepoints)
+    ]
+    engine.add_prompts(prompts)
+
+    benchmark.pedantic(engine.propagate, rounds=3)
+    frames = timepoints * (shape[0] + 1)
+    record(
+        benchmark,
+        workers=workers,
+        frames_per_s=frames / benchmark.stats.stats.mean,
+    )
+    engine.close()
+
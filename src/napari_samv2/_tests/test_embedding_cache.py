@@ -0,0 +1,78 @@
+# Embedding cache round trips of fake backbone outputs.
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelines.samv2.Samv2_embedding_cache import EmbeddingCache  # noqa: E402
+from pipelines.samv2.Samv2_predictor_pool import PredictorPool  # noqa: E402
+
+MODEL_KEY = PredictorPool.make_key("model.yaml", "model.pt", "cpu")
+
+
+def backbone_out(dtype=torch.float32):
+    generator = torch.Generator().manual_seed(0)
+    backbone_fpn = [
+        torch.randn(1, 8, size, size, generator=generator).to(dtype)
+        for size in (16, 8, 4)
+    ]
+    return {
+        "vision_features": backbone_fpn[-1],
+        "vision_pos_enc": [torch.zeros_like(fpn) for fpn in backbone_fpn],
+        "backbone_fpn": backbone_fpn,
+    }
+
+
+@pytest.mark.parametrize("dtype", (torch.float32, torch.bfloat16))
+def test_hit_matches_the_encoder_output(tmp_path, dtype):
+    cache = EmbeddingCache(tmp_path, "hash", MODEL_KEY, 1024)
+    computed = backbone_out(dtype)
+    cache.store(3, computed)
+
+    loaded = cache.load(3, "cpu")
+    assert cache.hits == 1
+    for cached, original in zip(
+            loaded["backbone_fpn"], computed["backbone_fpn"]
+    ):
+        assert cached.dtype == dtype
+        assert torch.equal(cached, original)
+    assert loaded["vision_features"] is loaded["backbone_fpn"][-1]
+
+
+def test_float16_storage_is_opt_in(tmp_path):
+    lossless = EmbeddingCache(tmp_path, "hash", MODEL_KEY, 1024)
+    half = EmbeddingCache(
+        tmp_path, "hash", MODEL_KEY, 1024, storage_dtype=torch.float16
+    )
+    assert half.cache_dir != lossless.cache_dir
+
+    computed = backbone_out()
+    half.store(0, computed)
+    assert 0 not in lossless
+    loaded = half.load(0, "cpu")
+    for cached, original in zip(
+            loaded["backbone_fpn"], computed["backbone_fpn"]
+    ):
+        assert cached.dtype == torch.float32
+        torch.testing.assert_close(cached, original, rtol=1e-3, atol=1e-3)
+
+
+# Features of a quantized, compiled or other checkpoint's model are not
+# served to a full precision one and vice versa
+def test_cache_is_keyed_by_the_model(make_engine, volume):
+    full = make_engine(volume, name="full", embedding_cache_gb=1)
+    full.embedding_cache.store(0, backbone_out())
+    same = make_engine(volume, name="same", embedding_cache_gb=1)
+    assert 0 in same.embedding_cache
+
+    for kwargs in ({"quantize": True}, {"compile_model": True}):
+        other = make_engine(
+            volume, name="other", embedding_cache_gb=1, **kwargs
+        )
+        cache = other.embedding_cache
+        assert cache.cache_dir != full.embedding_cache.cache_dir
+        assert 0 not in cache
+        assert cache.load(0, "cpu") is None
+        assert cache.misses == 1
+        other.close()
+    full.close()
+    same.close()
@@ -0,0 +1,149 @@
+# Memory bank spilling of SAM2 inference states, on fake frame outputs
+# and on the mocked predictor (see conftest.py).
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelines.samv2.Samv2_memory import (  # noqa: E402
+    MemoryBank,
+    SpillingFrameOutputs,
+    frames_read_per_step,
+    state_memory_report,
+)
+
+
+def frame_output(value):
+    return {
+        "maskmem_features": torch.full((4, 8), float(value)),
+        "maskmem_pos_enc": [torch.zeros(4, 8)],
+        "pred_masks": torch.zeros(1, 1, 16, 16),
+        "obj_ptr": torch.ones(1, 8),
+        "object_score_logits": None,
+    }
+
+
+def test_farthest_frames_spill_to_disk(tmp_path):
+    outputs = SpillingFrameOutputs(tmp_path / "bank", max_resident=3)
+    for frame_idx in range(10):
+        outputs[frame_idx] = frame_output(frame_idx)
+
+    assert outputs.resident_frames == 3
+    assert outputs.spilled_frames == 7
+    assert sorted(dict.keys(outputs)) == [7, 8, 9]
+    assert len(outputs) == 10
+    assert sorted(outputs) == list(range(10))
+    assert len(list((tmp_path / "bank").glob("*.pt"))) == 7
+
+
+def test_spilled_frames_load_back(tmp_path):
+    outputs = SpillingFrameOutputs(tmp_path / "bank", max_resident=2)
+    for frame_idx in range(5):
+        outputs[frame_idx] = frame_output(frame_idx)
+
+    assert 0 in outputs
+    assert outputs.get(0)["maskmem_features"][0, 0] == 0
+    assert outputs.get(42) is None
+    # Read back frames are resident again, their file is gone
+    assert dict.__contains__(outputs, 0)
+    assert not (tmp_path / "bank" / "0.pt").exists()
+    assert outputs.pop(1)["maskmem_features"][0, 0] == 1
+    assert 1 not in outputs
+
+
+def test_clear_and_release_remove_the_files(tmp_path):
+    outputs = SpillingFrameOutputs(tmp_path / "bank", max_resident=1)
+    for frame_idx in range(4):
+        outputs[frame_idx] = frame_output(frame_idx)
+    outputs.clear()
+    assert len(outputs) == 0
+    assert not list((tmp_path / "bank").glob("*.pt"))
+
+    outputs[0] = frame_output(0)
+    outputs[1] = frame_output(1)
+    del outputs
+    assert not (tmp_path / "bank").exists()
+
+
+def test_memory_bank_attach_and_report(tmp_path):
+    state = {
+        "cached_features": {},
+        "output_dict_per_obj": {
+            0: {
+                "cond_frame_outputs": {5: frame_output(5)},
+                "non_cond_frame_outputs": {
+                    i: frame_output(i) for i in range(6, 12)
+                },
+            }
+        },
+    }
+    bank = MemoryBank(tmp_path / "memory_bank", max_resident_frames=2)
+    bank.attach(state)
+    outputs = state["output_dict_per_obj"][0]["non_cond_frame_outputs"]
+
+    assert isinstance(outputs, SpillingFrameOutputs)
+    assert sorted(outputs) == list(range(6, 12))
+    report = state_memory_report(state)
+    assert report["memory_bank_frames"] == 2
+    assert report["spilled_frames"] == 4
+    assert report["spilled_mb"] > 0
+
+    assert bank.spill_dir.parent == tmp_path / "memory_bank"
+    bank.close()
+    assert not bank.spill_dir.exists()
+
+
+def test_memory_banks_of_the_same_name_are_separate(tmp_path):
+    first = MemoryBank(tmp_path / "memory_bank", 2, prefix="volume")
+    (first.spill_dir / "0.pt").write_bytes(b"spilled")
+    second = MemoryBank(tmp_path / "memory_bank", 2, prefix="volume")
+
+    assert second.spill_dir != first.spill_dir
+    assert (first.spill_dir / "0.pt").exists()
+    second.close()
+    assert (first.spill_dir / "0.pt").exists()
+    first.close()
+
+
+def test_memory_bank_keeps_the_frames_the_model_reads(tmp_path, caplog):
+    class Model:
+        num_maskmem = 7
+        max_obj_ptrs_in_encoder = 16
+
+    assert frames_read_per_step(Model()) == 16
+    bank = MemoryBank(tmp_path / "memory_bank", max_resident_frames=4)
+    bank.fit_model(Model())
+    assert bank.max_resident_frames == 16
+    assert "instead of 4" in caplog.text
+
+    bank = MemoryBank(tmp_path / "memory_bank", max_resident_frames=32)
+    bank.fit_model(Model())
+    assert bank.max_resident_frames == 32
+
+
+# Spilling the memory bank to disk does not change what an engine
+# propagates
+def test_engine_spilling_is_lossless(make_engine, memory_mock_pool, volume):
+    outputs = []
+    for memory_bank_frames in (None, 1):
+        engine = make_engine(
+            volume,
+            name=f"bank_{memory_bank_frames}",
+            memory_bank_frames=memory_bank_frames,
+        )
+        engine.add_point(4, 64, 128, 1)
+        engine.add_point(12, 192, 128, 2)
+        engine.propagate()
+        # A second run reads the memory of the first one back
+        engine.add_point(8, 128, 100, 3)
+        engine.propagate()
+        outputs.append(engine.output.copy())
+        report = engine.memory_report()
+        bank = engine.memory_bank
+        engine.close()
+
+    # Raised to what MemoryMockPredictor reads back per frame
+    assert bank.max_resident_frames == 3
+    assert report["spilled_frames"] > 0
+    assert set(np.unique(outputs[0])) == {0, 1, 2, 3}
+    np.testing.assert_array_equal(outputs[1], outputs[0])
@@ -0,0 +1,172 @@
+# Model store downloads against a local HTTP server standing in for the
+# checkpoint host.
+import hashlib
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+from pipelines.samv2 import Samv2_model_store  # noqa: E402
+from pipelines.samv2.Samv2_model_store import (  # noqa: E402
+    CHECKSUMS_NAME,
+    MODEL_CONFIGS,
+    ModelStore,
+)
+
+CHECKPOINT = bytes(range(256)) * 4096  # 1 MB
+SHA256 = hashlib.sha256(CHECKPOINT).hexdigest()
+
+
+class CheckpointHandler(BaseHTTPRequestHandler):
+    def __init__(self, server_state, *args, **kwargs):
+        self.state = server_state
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def send_body_headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.state["ranges"]:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_body_headers(200, len(CHECKPOINT))
+
+    def do_GET(self):
+        self.state["requests"].append(self.headers.get("Range"))
+        header = self.headers.get("Range")
+        if header and self.state["ranges"]:
+            start, end = header.removeprefix("bytes=").split("-")
+            start, end = int(start), int(end) + 1
+            self.send_body_headers(
+                206, end - start, f"bytes {start}-{end - 1}/{len(CHECKPOINT)}"
+            )
+        else:
+            start, end = 0, len(CHECKPOINT)
+            self.send_body_headers(200, end - start)
+        self.wfile.write(CHECKPOINT[start:end])
+
+
+@pytest.fixture
+def server():
+    state = {"ranges": True, "requests": []}
+    httpd = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(CheckpointHandler, state)
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{httpd.server_port}/"
+    yield state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_parts(monkeypatch):
+    monkeypatch.setattr(Samv2_model_store, "MIN_PART_BYTES", 64 * 1024)
+
+
+def test_parallel_download(tmp_path, server):
+    store = ModelStore(tmp_path, base_url=server["url"], parts=4)
+
+    path = store.fetch("model.pt")
+
+    assert path.read_bytes() == CHECKPOINT
+    assert len(server["requests"]) == 4
+    assert store.read_manifest()["model.pt"]["sha256"] == SHA256
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "manifest.json",
+        "model.pt",
+    ]
+
+
+def test_resume_from_partial_parts(tmp_path, server):
+    store = ModelStore(tmp_path, base_url=server["url"], parts=2)
+    half = len(CHECKPOINT) // 2
+    (tmp_path / "model.pt.parts").write_text("2")
+    (tmp_path / "model.pt.part0").write_bytes(CHECKPOINT[:1000])
+    (tmp_path / "model.pt.part1").write_bytes(CHECKPOINT[half:])
+
+    path = store.fetch("model.pt")
+
+    assert path.read_bytes() == CHECKPOINT
+    # Only the rest of the first part is requested again
+    assert server["requests"] == [f"bytes=1000-{half - 1}"]
+
+
+def test_download_without_range_support(tmp_path, server):
+    server["ranges"] = False
+    store = ModelStore(tmp_path, base_url=server["url"], parts=4)
+
+    assert store.fetch("model.pt").read_bytes() == CHECKPOINT
+    assert server["requests"] == [None]
+
+
+def test_checksum_mismatch_keeps_nothing(tmp_path, server):
+    store = ModelStore(
+        tmp_path, base_url=server["url"], checksums={"model.pt": "0" * 64}
+    )
+
+    with pytest.raises(ValueError, match="SHA-256"):
+        store.fetch("model.pt")
+    assert not (tmp_path / "model.pt").exists()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_offline_prepopulated_cache(tmp_path):
+    (tmp_path / "model.pt").write_bytes(CHECKPOINT)
+    (tmp_path / CHECKSUMS_NAME).write_text(f"{SHA256}  model.pt\n")
+    store = ModelStore(tmp_path, base_url="http://127.0.0.1:9/", offline=True)
+
+    assert store.fetch("model.pt") == tmp_path / "model.pt"
+    with pytest.raises(FileNotFoundError):
+        store.fetch("other.pt")
+
+
+def test_corrupted_cache_is_rejected(tmp_path, server):
+    store = ModelStore(tmp_path, base_url=server["url"])
+    path = store.fetch("model.pt")
+    path.write_bytes(CHECKPOINT[:-1])
+
+    assert not store.verify("model.pt")
+    assert store.fetch("model.pt").read_bytes() == CHECKPOINT
+
+
+# Official checkpoints are checked against CHECKPOINT_SHA256 on their
+# first download
+def test_official_checkpoint_is_checked_against_its_pinned_hash(
+        tmp_path, server, monkeypatch
+):
+    _, name = MODEL_CONFIGS["sam2.1_hiera_tiny"]
+    monkeypatch.setitem(Samv2_model_store.CHECKPOINT_SHA256, name, "0" * 64)
+    store = ModelStore(tmp_path, base_url=server["url"])
+    with pytest.raises(ValueError, match="expected 0000"):
+        store.fetch(name)
+    assert not (tmp_path / name).exists()
+
+    monkeypatch.setitem(Samv2_model_store.CHECKPOINT_SHA256, name, SHA256)
+    store = ModelStore(tmp_path, base_url=server["url"])
+    assert store.fetch(name).read_bytes() == CHECKPOINT
+    assert store.read_manifest()[name]["sha256"] == SHA256
+
+
+def test_pinned_hash_is_checked(tmp_path, server):
+    store = ModelStore(
+        tmp_path, base_url=server["url"], pinned={"model.pt": "0" * 64}
+    )
+    with pytest.raises(ValueError, match="expected 0000"):
+        store.fetch("model.pt")
+    assert not (tmp_path / "model.pt").exists()
+
+    store = ModelStore(
+        tmp_path, base_url=server["url"], pinned={"model.pt": SHA256}
+    )
+    assert store.fetch("model.pt").read_bytes() == CHECKPOINT
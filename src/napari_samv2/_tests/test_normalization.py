@@ -0,0 +1,72 @@
+# Recorded contrast policies are only reused for the volume they were
+# computed for, and a policy maps an intensity to the same 8-bit value on
+# every slice.
+import json
+
+import numpy as np
+import pytest
+
+from pipelines.samv2.Samv2_normalization import (
+    CONTRAST_MODES,
+    compute_contrast_policy,
+    convert_volume_to_8bit,
+    resolve_contrast_policy,
+)
+
+
+def volume(high, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, high, (8, 64, 64), dtype=np.uint16)
+
+
+def test_policy_is_reused_for_the_same_volume(tmp_path):
+    policy_path = tmp_path / "contrast_policy.json"
+    first = resolve_contrast_policy(policy_path, volume(1000), "percentile")
+    recorded = json.loads(policy_path.read_text())
+
+    second = resolve_contrast_policy(policy_path, volume(1000), "percentile")
+    assert second == first
+    assert json.loads(policy_path.read_text()) == recorded
+    assert recorded["volume"]["shape"] == [8, 64, 64]
+
+
+def test_policy_is_recomputed_for_another_volume(tmp_path):
+    # Same layer name (policy path), shape and dtype, other content
+    policy_path = tmp_path / "contrast_policy.json"
+    first = resolve_contrast_policy(policy_path, volume(1000), "percentile")
+    second = resolve_contrast_policy(policy_path, volume(60000), "percentile")
+
+    assert second != first
+    assert second.high > 10 * first.high
+    third = resolve_contrast_policy(
+        policy_path, volume(60000)[:4], "percentile"
+    )
+    assert json.loads(policy_path.read_text())["volume"]["shape"] == [
+        4,
+        64,
+        64,
+    ]
+    assert third.mode == "percentile"
+
+
+# Slices of very different brightness sharing one voxel value
+def uneven_volume(dtype, shared=500):
+    rng = np.random.default_rng(1)
+    volume = np.stack(
+        [rng.integers(0, 1000 * (z + 1), (64, 64)) for z in range(8)]
+    ).astype(dtype)
+    volume[:, :4, :4] = shared
+    return volume
+
+
+@pytest.mark.parametrize("dtype", ("uint16", "float32"))
+@pytest.mark.parametrize("mode", CONTRAST_MODES)
+def test_same_intensity_maps_to_the_same_value(mode, dtype):
+    volume = uneven_volume(dtype)
+    policy = compute_contrast_policy(volume, mode, contrast_limits=(0, 4000))
+
+    converted = convert_volume_to_8bit(volume, policy, chunk_frames=3)
+    assert converted.dtype == np.uint8
+    assert len(np.unique(converted[:, :4, :4])) == 1
+    for z in range(len(volume)):
+        np.testing.assert_array_equal(policy.apply(volume[z]), converted[z])
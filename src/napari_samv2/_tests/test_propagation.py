@@ -0,0 +1,129 @@
+# Propagation, preview and correction paths of the engine on the mocked
+# predictor (see conftest.py).
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelines.samv2.Samv2_frame_source import VolumeFrameLoader  # noqa: E402
+
+
+def add_objects(engine, obj_ids=(1, 2, 3)):
+    depth, height, width = engine.image_volume.shape
+    for obj_id in obj_ids:
+        engine.add_point(depth // 2, obj_id * height // 4, width // 2, obj_id)
+
+
+# A second run with a narrower window leaves nothing of the first one
+# outside its window, labels of other objects stay
+def test_narrower_window_clears_stale_frames(make_engine, volume):
+    engine = make_engine(volume)
+    engine.add_point(8, 128, 128, 1)
+    engine.propagate()
+    assert all((engine.output[z] == 1).any() for z in range(len(volume)))
+    engine.output[0, :4, :4] = 9
+
+    engine.propagate(window=2)
+    for z in range(len(volume)):
+        assert (engine.output[z] == 1).any() == (6 <= z <= 10)
+    assert (engine.output[0, :4, :4] == 9).all()
+    engine.close()
+
+
+# Frames past where a pass stopped lose the masks of an earlier run
+def test_stopped_pass_clears_stale_frames(make_engine, volume):
+    engine = make_engine(volume)
+    engine.add_point(8, 128, 128, 1)
+    engine.propagate()
+    logits = engine.predictor._logits
+
+    # The object disappears after frame 10
+    def vanishing_logits(inference_state, frame_idx):
+        obj_ids, frame_logits = logits(inference_state, frame_idx)
+        if frame_idx > 10:
+            frame_logits = frame_logits - 1000
+        return obj_ids, frame_logits
+
+    engine.predictor._logits = vanishing_logits
+    engine.propagate(stop_after_empty=2)
+    assert engine.object_extents[1] == (0, 10)
+    assert not (engine.output[11:] == 1).any()
+    engine.close()
+
+
+# Re-propagating the corrected object gives the labels of a full run, and
+# only the corrected object moves
+def test_incremental_propagation_matches_a_full_run(make_engine, volume):
+    engine = make_engine(volume)
+    add_objects(engine)
+    engine.propagate()
+    before = engine.output.copy()
+    correction = (8, 132, 128, 2)
+    engine.add_point(*correction)
+    list(engine.iter_incremental_propagate())
+
+    full = make_engine(volume, name="full")
+    add_objects(full)
+    full.add_point(*correction)
+    full.propagate()
+    np.testing.assert_array_equal(engine.output, full.output)
+    for obj_id in (1, 3):
+        np.testing.assert_array_equal(
+            engine.output == obj_id, before == obj_id
+        )
+    assert ((engine.output == 2) != (before == 2)).any()
+    engine.close()
+    full.close()
+
+
+# A refined object matches a full resolution propagation, the other objects
+# keep their preview
+def test_refined_objects_match_a_full_run(make_engine, volume):
+    engine = make_engine(volume)
+    add_objects(engine)
+    list(engine.iter_preview_propagate(stride=4, xy_step=2))
+    # Every frame gets the mask of its nearest preview frame
+    assert all(engine.output[z].any() for z in range(len(volume)))
+    assert engine.preview_objects == {1, 2, 3}
+
+    list(engine.iter_refine_objects([2]))
+    assert engine.preview_objects == {1, 3}
+    preview = engine.output.copy()
+    full = make_engine(volume, name="full")
+    add_objects(full)
+    full.propagate()
+    np.testing.assert_array_equal(engine.output == 2, full.output == 2)
+    list(engine.iter_refine_objects([1]))
+    np.testing.assert_array_equal(engine.output == 3, preview == 3)
+    engine.close()
+    full.close()
+
+
+# A label that does not fit the output is rejected before it is recorded
+def test_rejected_click_leaves_no_prompt(make_engine, volume):
+    engine = make_engine(volume)
+    engine.add_point(4, 128, 128, 1)
+    engine.convert_output_dtype("uint8")
+
+    with pytest.raises(ValueError, match="does not fit"):
+        engine.add_point(8, 128, 128, 300)
+    assert engine.prompts.objects() == [1]
+    assert engine.last_correction == (1, 4)
+    engine.close()
+
+
+# Cancelling a preview (closing its generator) closes its frame loader
+def test_cancelled_preview_closes_frames(make_engine, volume, monkeypatch):
+    closed = []
+    monkeypatch.setattr(
+        VolumeFrameLoader, "close", lambda self: closed.append(self)
+    )
+    engine = make_engine(volume)
+    engine.add_point(8, 128, 128, 1)
+
+    frames = engine.iter_preview_propagate(stride=4)
+    next(frames)
+    frames.close()
+    assert len(closed) == 1
+    monkeypatch.undo()
+    engine.close()
@@ -0,0 +1,44 @@
+# 4D propagation of a SeriesEngine on the mocked predictor.
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelines.samv2.Samv2_series import SeriesEngine  # noqa: E402
+
+
+# Every timepoint holds the labels of its own 3D propagation
+@pytest.mark.parametrize("workers", (1, 4))
+def test_timepoints_match_single_volumes(make_engine, tmp_path, workers):
+    rng = np.random.default_rng(0)
+    volume = rng.integers(0, 2**16 - 1, (4, 16, 128, 128), dtype=np.uint16)
+    timepoints, depth, height, width = volume.shape
+    # make_engine also patches the predictor pool of the sub-volume engines
+    engine = SeriesEngine(
+        volume,
+        "mock.pt",
+        "mock.yaml",
+        tmp_path / "series",
+        max_workers=workers,
+        device="cpu",
+    )
+    # One object per timepoint, clicked at a different place in each
+    prompts = [
+        (t, depth // 2, height // 2, (t + 1) * width // 6, 1, t + 1)
+        for t in range(timepoints)
+    ]
+    engine.add_prompts(prompts)
+    engine.propagate()
+
+    for t, z, y, x, label, obj_id in prompts:
+        single = make_engine(
+            volume[t],
+            name=f"single_{t}",
+            contrast_policy=engine.contrast_policy,
+        )
+        single.add_point(z, y, x, obj_id, label)
+        single.propagate()
+        assert engine.output[t].any()
+        np.testing.assert_array_equal(engine.output[t], single.output)
+        single.close()
+    engine.close()
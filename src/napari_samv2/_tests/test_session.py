@@ -0,0 +1,50 @@
+# Saving and resuming engine sessions on the mocked predictor.
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelines.samv2 import Samv2_session  # noqa: E402
+from pipelines.samv2.Samv2_session import (  # noqa: E402
+    load_session,
+    save_session,
+)
+
+
+def propagated_engine(make_engine, volume):
+    engine = make_engine(volume)
+    for obj_id in (1, 2, 3):
+        engine.add_point(8, obj_id * 64, 128, obj_id)
+    engine.propagate()
+    return engine
+
+
+def test_resumed_session_matches(make_engine, volume, tmp_path):
+    engine = propagated_engine(make_engine, volume)
+    session_path = save_session(engine, tmp_path / "volume.samv2")
+
+    resumed = make_engine(volume)
+    load_session(resumed, session_path)
+    np.testing.assert_array_equal(resumed.output, engine.output)
+    assert resumed.prompts.objects() == [1, 2, 3]
+    assert resumed.object_extents == engine.object_extents
+    engine.close()
+    resumed.close()
+
+
+# Tracker memory saved with another sam2 version is replaced by a replay
+def test_session_from_other_sam2_version_replays(
+        make_engine, volume, tmp_path, monkeypatch, caplog
+):
+    engine = propagated_engine(make_engine, volume)
+    session_path = save_session(engine, tmp_path / "volume.samv2")
+
+    monkeypatch.setattr(Samv2_session, "sam2_version", lambda: "0.0-other")
+    resumed = make_engine(volume)
+    metadata = load_session(resumed, session_path)
+    assert metadata["checkpoint"] == "mock.pt"
+    assert "Replaying the prompts" in caplog.text
+    assert resumed.prompts.objects() == [1, 2, 3]
+    np.testing.assert_array_equal(resumed.output, engine.output)
+    engine.close()
+    resumed.close()
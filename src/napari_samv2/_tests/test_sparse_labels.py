@@ -0,0 +1,87 @@
+# Sparse per-object label volumes and the COCO RLE export.
+import numpy as np
+
+from pipelines.samv2.Samv2_sparse_labels import (
+    SparseLabelVolume,
+    export_coco_rle,
+    iter_label_planes,
+    load_coco_rle,
+    rle_counts,
+    rle_pixels,
+)
+
+
+def dense_labels(shape=(6, 32, 48)):
+    labels = np.zeros(shape, dtype=np.uint16)
+    labels[1, 4:12, 5:20] = 1
+    labels[1, 20:30, 30:47] = 2
+    labels[3, 0:5, 0:5] = 300
+    labels[3, 10, 10] = 1
+    return labels
+
+
+def test_planes_round_trip():
+    dense = dense_labels()
+    sparse = SparseLabelVolume.from_array(dense)
+
+    assert sparse.planes() == [(1,), (3,)]
+    assert sparse.objects((1,)) == [1, 2]
+    assert sparse.nbytes < dense.nbytes // 10
+    np.testing.assert_array_equal(np.asarray(sparse), dense)
+    np.testing.assert_array_equal(sparse[1], dense[1])
+    np.testing.assert_array_equal(sparse[2:5, 8:, ::2], dense[2:5, 8:, ::2])
+    assert [key for key, _ in iter_label_planes(sparse)] == [(1,), (3,)]
+
+
+def test_writes_like_numpy():
+    dense = dense_labels()
+    sparse = SparseLabelVolume.from_array(dense)
+
+    dense[1, 6:8, :] = 5
+    sparse[1, 6:8, :] = 5
+    dense[0] = dense[3]
+    sparse[0] = dense[3]
+    np.testing.assert_array_equal(np.asarray(sparse), dense)
+
+    sparse[1] = 0
+    assert (1,) not in sparse.planes()
+    sparse[...] = 0
+    assert sparse.planes() == []
+    assert sparse.nbytes == 0
+
+
+def test_point_indices():
+    sparse = SparseLabelVolume((4, 16, 16), np.int32)
+    zs, ys, xs = np.array([0, 0, 2]), np.array([1, 2, 3]), np.array([4, 5, 6])
+
+    sparse[zs, ys, xs] = 7
+    np.testing.assert_array_equal(sparse[zs, ys, xs], [7, 7, 7])
+    assert sparse.planes() == [(0,), (2,)]
+    assert sparse[0, 1, 4] == 7
+    assert sparse[1].sum() == 0
+
+
+def test_rle_counts_round_trip():
+    mask = np.zeros((7, 5), dtype=bool)
+    mask[0, 0] = mask[6, 0] = mask[0, 1] = True
+    mask[2:5, 3] = True
+    ys, xs = np.nonzero(mask)
+    counts = rle_counts(ys, xs, mask.shape)
+
+    assert sum(counts) == mask.size
+    # Column major, starting with the background
+    assert counts[:4] == [0, 1, 5, 2]
+    decoded = np.zeros_like(mask)
+    decoded[rle_pixels(counts, mask.shape)] = True
+    np.testing.assert_array_equal(decoded, mask)
+    assert rle_counts([], [], mask.shape) == [mask.size]
+
+
+def test_coco_export_round_trip(tmp_path):
+    dense = dense_labels()
+    path = export_coco_rle(dense, tmp_path / "labels.json")
+
+    labels = load_coco_rle(path)
+    assert labels.shape == dense.shape
+    assert labels.dtype == dense.dtype
+    np.testing.assert_array_equal(np.asarray(labels), dense)
@@ -0,0 +1,93 @@
+# Tiled propagation hands objects over to the tiles they move into.
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from pipelines.samv2.Samv2_normalization import (  # noqa: E402
+    compute_contrast_policy,
+)
+from pipelines.samv2.Samv2_prompts import PromptStore  # noqa: E402
+from pipelines.samv2.Samv2_tiling import TiledPropagator  # noqa: E402
+
+RADIUS = 20
+
+
+# Disc drifting along x, in volume coordinates
+def disc_center(frame_idx):
+    return 128, 60 + 35 * frame_idx
+
+
+def disc(shape, frame_idx, y0=0, x0=0):
+    cy, cx = disc_center(frame_idx)
+    yy = torch.arange(shape[0], dtype=torch.float32)[:, None] + y0
+    xx = torch.arange(shape[1], dtype=torch.float32)[None, :] + x0
+    return RADIUS - torch.sqrt((yy - cy) ** 2 + (xx - cx) ** 2)
+
+
+# Predictor that tracks the disc perfectly for the objects it was given.
+# Like SAM2, a state refuses new objects once tracking has started.
+class TrackingPredictor:
+    image_size = 64
+    device = torch.device("cpu")
+
+    # Backbone warm up of init_state_from_frames, nothing to compute here
+    def _get_image_feature(self, inference_state, frame_idx, batch_size):
+        pass
+
+    def _add(self, state, obj_id):
+        if state["tracking_has_started"]:
+            raise RuntimeError("Cannot add new objects after tracking starts")
+        if obj_id not in state["obj_ids"]:
+            state["obj_ids"].append(obj_id)
+
+    def add_new_points_or_box(self, inference_state, frame_idx, obj_id, **kwargs):
+        self._add(inference_state, obj_id)
+
+    def add_new_mask(self, inference_state, frame_idx, obj_id, mask):
+        assert mask.any()
+        self._add(inference_state, obj_id)
+
+    def propagate_in_video(
+            self,
+            inference_state,
+            start_frame_idx=0,
+            max_frame_num_to_track=None,
+            reverse=False,
+    ):
+        inference_state["tracking_has_started"] = True
+        frames = inference_state["images"]
+        y0, x0 = (s.start or 0 for s in frames.crop)
+        shape = (frames.video_height, frames.video_width)
+        step = -1 if reverse else 1
+        for i in range(max_frame_num_to_track + 1):
+            frame_idx = start_frame_idx + i * step
+            logits = disc(shape, frame_idx, y0, x0)
+            obj_ids = list(inference_state["obj_ids"])
+            yield frame_idx, obj_ids, logits.expand(len(obj_ids), 1, *shape)
+
+
+def test_object_is_handed_to_the_tiles_it_moves_into():
+    volume = np.zeros((12, 256, 512), dtype=np.uint8)
+    propagator = TiledPropagator(
+        TrackingPredictor(),
+        volume,
+        tile_size=256,
+        contrast_policy=compute_contrast_policy(volume),
+        overlap=64,
+    )
+    prompts = PromptStore()
+    cy, cx = disc_center(0)
+    prompts.add(1, 0, (cx, cy), 1)
+
+    propagator.prepare(prompts)
+    assert list(propagator.states) == [0]
+    frames = {}
+    for frame_idx, labels, *_ in propagator.iter_frames():
+        frames[frame_idx] = labels.copy()
+
+    assert sorted(frames) == list(range(12))
+    for frame_idx, labels in frames.items():
+        expected = (disc(volume.shape[1:], frame_idx) > 0).numpy()
+        np.testing.assert_array_equal(labels == 1, expected)
+    propagator.close()
@@ -1,20 +1,47 @@
 # Imports
+import logging
 import os
+import time
 import numpy as np
 import napari
-import requests
+from napari.qt.threading import GeneratorWorker, create_worker
+from pipelines.samv2.Samv2_model_store import MODEL_CONFIGS, get_model_store
 from pipelines.samv2.Samv2_pipeline_handler import SamV2_pipeline
+from pipelines.samv2.Samv2_session import SESSION_SUFFIX
+from pipelines.samv2.Samv2_timing import (
+    configure_logging,
+    get_timings,
+    torch_profile,
+)
 from qtpy import uic
 from qtpy.QtWidgets import (
+    QCheckBox,
     QComboBox,
+    QDoubleSpinBox,
     QFileDialog,
+    QLabel,
     QLineEdit,
     QProgressBar,
     QPushButton,
+    QSpinBox,
     QWidget,
 )
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
+
+# Generator worker that closes the propagation generator on the worker
+# thread once the work ends (done, failed or cancelled). Its finally blocks
+# (autocast, inference state cleanup) then run on the thread that entered
+# them, not on whichever thread garbage collects the generator.
+class PropagationWorker(GeneratorWorker):
+    def work(self):
+        try:
+            return super().work()
+        finally:
+            self._gen.close()
+
 
 # Main Plugin class that is connected from outside at napari plugin entry point
 class SAMV2_min(QWidget):
@@ -22,6 +49,10 @@ class SAMV2_min(QWidget):
         # Initializing
         super().__init__()
         self.viewer = napari_viewer
+        self.pipeline_object = None
+        self.propagation_worker = None
+        self.pending_points = []
+        configure_logging()
 
         # Load the UI file - Main window
         script_dir = os.path.dirname(__file__)
@@ -43,19 +74,89 @@ class SAMV2_min(QWidget):
             QComboBox, "output_layer_combo"
         )
         self.model_cbbox = self.findChild(QComboBox, "model_cbbox")
+        self.contrast_cbbox = self.findChild(QComboBox, "contrast_cbbox")
+        self.jpeg_frames_chkbox = self.findChild(
+            QCheckBox, "jpeg_frames_chkbox"
+        )
+        self.export_workers_spinbox = self.findChild(
+            QSpinBox, "export_workers_spinbox"
+        )
+        self.embedding_cache_chkbox = self.findChild(
+            QCheckBox, "embedding_cache_chkbox"
+        )
+        self.embedding_cache_spinbox = self.findChild(
+            QDoubleSpinBox, "embedding_cache_spinbox"
+        )
 
+        self.tile_size_spinbox = self.findChild(QSpinBox, "tile_size_spinbox")
+        self.tile_overlap_spinbox = self.findChild(
+            QSpinBox, "tile_overlap_spinbox"
+        )
+        self.device_cbbox = self.findChild(QComboBox, "device_cbbox")
+        self.threads_spinbox = self.findChild(QSpinBox, "threads_spinbox")
+        self.quantize_chkbox = self.findChild(QCheckBox, "quantize_chkbox")
+        self.compile_chkbox = self.findChild(QCheckBox, "compile_chkbox")
+        self.propagation_axis_cbbox = self.findChild(
+            QComboBox, "propagation_axis_cbbox"
+        )
+        self.series_workers_spinbox = self.findChild(
+            QSpinBox, "series_workers_spinbox"
+        )
+        self.frame_cache_spinbox = self.findChild(
+            QSpinBox, "frame_cache_spinbox"
+        )
+        self.memory_bank_spinbox = self.findChild(
+            QSpinBox, "memory_bank_spinbox"
+        )
+        self.offload_chkbox = self.findChild(QCheckBox, "offload_chkbox")
         self.initialize_btn = self.findChild(QPushButton, "Initialize_btn")
         self.video_propagation_progressBar = self.findChild(
             QProgressBar, "Propagation_progress"
         )
         self.video_propagate_btn = self.findChild(QPushButton, "Propagate_btn")
+        self.update_correction_btn = self.findChild(
+            QPushButton, "update_correction_btn"
+        )
+        self.preview_stride_spinbox = self.findChild(
+            QSpinBox, "preview_stride_spinbox"
+        )
+        self.preview_xy_spinbox = self.findChild(QSpinBox, "preview_xy_spinbox")
+        self.preview_btn = self.findChild(QPushButton, "preview_btn")
+        self.refine_objects_lineedt = self.findChild(
+            QLineEdit, "refine_objects_lineedt"
+        )
+        self.refine_btn = self.findChild(QPushButton, "refine_btn")
         self.reset_btn = self.findChild(QPushButton, "reset_btn")
-        #self.reset_and_prop_btn = self.findChild(QPushButton, "reset_and_prop")
+        self.pause_btn = self.findChild(QPushButton, "pause_btn")
+        self.cancel_btn = self.findChild(QPushButton, "cancel_btn")
+        self.window_spinbox = self.findChild(QSpinBox, "window_spinbox")
+        self.stop_empty_spinbox = self.findChild(QSpinBox, "stop_empty_spinbox")
+        self.merge_rule_cbbox = self.findChild(QComboBox, "merge_rule_cbbox")
+        self.label_dtype_cbbox = self.findChild(QComboBox, "label_dtype_cbbox")
+        self.label_store_chkbox = self.findChild(
+            QCheckBox, "label_store_chkbox"
+        )
+        self.sparse_labels_chkbox = self.findChild(
+            QCheckBox, "sparse_labels_chkbox"
+        )
+        self.object_extents_label = self.findChild(
+            QLabel, "object_extents_label"
+        )
+        self.profile_chkbox = self.findChild(QCheckBox, "profile_chkbox")
+        self.export_trace_btn = self.findChild(QPushButton, "export_trace_btn")
+        self.timings_label = self.findChild(QLabel, "timings_label")
+        self.save_session_btn = self.findChild(QPushButton, "save_session_btn")
+        self.load_session_btn = self.findChild(QPushButton, "load_session_btn")
+        self.export_labels_btn = self.findChild(QPushButton, "export_labels_btn")
 
         # Populate combo box - call
         self.populate_combo_box(self.image_layers_combo, "image")
         self.populate_combo_box(self.output_layers_combo, "label")
         self.populate_model_combo()
+        self.populate_contrast_combo()
+        self.populate_merge_combos()
+        self.populate_device_combo()
+        self.populate_axis_combo()
 
 
         # Connect events to functions
@@ -68,8 +169,16 @@ class SAMV2_min(QWidget):
         self.interdir_browse_btn.clicked.connect(self.choose_inter_frame_dir)
         self.initialize_btn.clicked.connect(self.initialize_pipeline)
         self.video_propagate_btn.clicked.connect(self.video_propagate)
+        self.update_correction_btn.clicked.connect(self.propagate_correction)
+        self.preview_btn.clicked.connect(self.preview_propagation)
+        self.refine_btn.clicked.connect(self.refine_objects)
         self.reset_btn.clicked.connect(self.reset_everything)
-        #self.reset_and_prop_btn.clicked.connect(self.reset_and_propagate)
+        self.pause_btn.clicked.connect(self.toggle_pause_propagation)
+        self.cancel_btn.clicked.connect(self.cancel_propagation)
+        self.export_trace_btn.clicked.connect(self.export_chrome_trace)
+        self.save_session_btn.clicked.connect(self.save_session)
+        self.load_session_btn.clicked.connect(self.load_session)
+        self.export_labels_btn.clicked.connect(self.export_labels)
 
         # Key board shortcut
         @napari_viewer.bind_key('a')
@@ -80,20 +189,7 @@ class SAMV2_min(QWidget):
             position = self.viewer.cursor.position
             if position is None:
                 return
-            point = [int(position[0]), int(position[1]), int(position[2])]
-            layer_name = self.output_layers_combo.currentText()
-            if layer_name not in self.viewer.layers:
-                return
-            layer = self.viewer.layers[layer_name]
-            active_label = layer.selected_label
-            self.pipeline_object.add_point(point, active_label, neg_or_pos=1)
-            # Update Positive Points layer
-            if "Positive Points" in self.viewer.layers:
-                pos_layer = self.viewer.layers["Positive Points"]
-                if pos_layer.data.size == 0:
-                    pos_layer.data = np.array([point])
-                else:
-                    pos_layer.data = np.concatenate([pos_layer.data, [point]], axis=0)
+            self.add_prompt_point(self.point_at(position), neg_or_pos=1)
 
         @napari_viewer.bind_key('n')
         def add_negative_point(napari_viewer):
@@ -103,20 +199,7 @@ class SAMV2_min(QWidget):
             position = self.viewer.cursor.position
             if position is None:
                 return
-            point = [int(position[0]), int(position[1]), int(position[2])]
-            layer_name = self.output_layers_combo.currentText()
-            if layer_name not in self.viewer.layers:
-                return
-            layer = self.viewer.layers[layer_name]
-            active_label = layer.selected_label
-            self.pipeline_object.add_point(point, active_label, neg_or_pos=0)
-            # Update Negative Points layer
-            if "Negative Points" in self.viewer.layers:
-                neg_layer = self.viewer.layers["Negative Points"]
-                if neg_layer.data.size == 0:
-                    neg_layer.data = np.array([point])
-                else:
-                    neg_layer.data = np.concatenate([neg_layer.data, [point]], axis=0)
+            self.add_prompt_point(self.point_at(position), neg_or_pos=0)
 
     # Function to populate combo boxes based on layers
     def populate_combo_box(self, combobx, layer_type="image"):
@@ -162,109 +245,464 @@ class SAMV2_min(QWidget):
             ]
         )
 
+    # add contrast policies in cbbox
+    def populate_contrast_combo(self):
+        self.contrast_cbbox.clear()
+        self.contrast_cbbox.addItem("Percentile (0.5 - 99.5 %)", "percentile")
+        self.contrast_cbbox.addItem("Layer contrast limits", "contrast_limits")
+        self.contrast_cbbox.addItem("Data type range", "dtype")
+
+    # add execution devices in cbbox
+    def populate_device_combo(self):
+        self.device_cbbox.clear()
+        self.device_cbbox.addItem("Auto (GPU if available)", "auto")
+        self.device_cbbox.addItem("GPU (CUDA)", "cuda")
+        self.device_cbbox.addItem("CPU", "cpu")
+
+    # add propagation axes of 4D layers in cbbox
+    def populate_axis_combo(self):
+        self.propagation_axis_cbbox.clear()
+        self.propagation_axis_cbbox.addItem("Along Z, every T on its own", 1)
+        self.propagation_axis_cbbox.addItem("Along T, every Z on its own", 0)
+
+    # add overlap rules and label dtypes in cbboxes
+    def populate_merge_combos(self):
+        self.merge_rule_cbbox.clear()
+        self.merge_rule_cbbox.addItem("Forward pass wins", "forward")
+        self.merge_rule_cbbox.addItem("Higher confidence wins", "confidence")
+        self.merge_rule_cbbox.addItem("Newest prompt wins", "newest_prompt")
+        self.label_dtype_cbbox.clear()
+        self.label_dtype_cbbox.addItem("Keep label dtype", None)
+        self.label_dtype_cbbox.addItem("uint16 labels", "uint16")
+        self.label_dtype_cbbox.addItem("uint8 labels", "uint8")
+
     # Choose inter frame dir
     def choose_inter_frame_dir(self):
         dname = QFileDialog.getExistingDirectory()
-        print(dname)
+        logger.debug("Inter frame dir %s", dname)
         self.interdir_lineedt.setText(str(dname))
 
     # Initialize pipeline
-    BASE_URL = "https://dl.fbaipublicfiles.com/segment_anything_2/092824/"
-    CHECKPOINTS = {
-        "sam2.1_hiera_tiny": "sam2.1_hiera_tiny.pt",
-        "sam2.1_hiera_small": "sam2.1_hiera_small.pt",
-        "sam2.1_hiera_base_plus": "sam2.1_hiera_base_plus.pt",
-        "sam2.1_hiera_large": "sam2.1_hiera_large.pt",
-    }
-
     def initialize_pipeline(self):
-        script_dir = os.path.dirname(__file__)
-        model_map = {
-            "sam2.1_hiera_large": ("configs/sam2.1/sam2.1_hiera_l.yaml", "sam2.1_hiera_large.pt"),
-            "sam2.1_hiera_small": ("configs/sam2.1/sam2.1_hiera_s.yaml", "sam2.1_hiera_small.pt"),
-            "sam2.1_hiera_tiny": ("configs/sam2.1/sam2.1_hiera_t.yaml", "sam2.1_hiera_tiny.pt"),
-            "sam2.1_hiera_base_plus": ("configs/sam2.1/sam2.1_hiera_b+.yaml", "sam2.1_hiera_base_plus.pt"),
-        }
+        if self.propagation_worker is not None:
+            logger.warning("Cancel the running propagation before initializing")
+            return
+        model_map = MODEL_CONFIGS
         selected_model = self.model_cbbox.currentText()
         if selected_model in model_map:
             model_cfg, checkpoint_name = model_map[selected_model]
-            model_path_parent_folder = Path(self.interdir_lineedt.text()) / Path("models")
-            model_path_parent_folder.mkdir(parents=True, exist_ok=True)
-            checkpoint_path = os.path.join(
-                str(model_path_parent_folder), checkpoint_name
-            )
-            """
-            checkpoint_path = os.path.join(
-                script_dir, "..", "model", checkpoint_name
-            )
-            """
-            if not os.path.exists(checkpoint_path):
-                print(f"Checkpoint {checkpoint_name} not found. Downloading...")
-                self.download_checkpoint(checkpoint_name, checkpoint_path)
+            # Verified checkpoint from the shared model cache, downloaded
+            # (or resumed) when missing
+            try:
+                checkpoint_path = get_model_store().fetch(checkpoint_name)
+            except (OSError, ValueError) as e:
+                logger.error("Could not get checkpoint %s: %s", checkpoint_name, e)
+                return
+            # The timing panel reports on the new volume only
+            get_timings().reset()
+            previous_pipeline = self.pipeline_object
             self.pipeline_object = SamV2_pipeline(
-                self.viewer, self, checkpoint_path, model_cfg
+                self.viewer,
+                self,
+                checkpoint_path,
+                model_cfg,
+                use_jpeg_frames=self.jpeg_frames_chkbox.isChecked(),
+                contrast_mode=self.contrast_cbbox.currentData(),
+                export_workers=self.export_workers_spinbox.value() or None,
+                embedding_cache_gb=(
+                    self.embedding_cache_spinbox.value()
+                    if self.embedding_cache_chkbox.isChecked()
+                    else None
+                ),
+                label_dtype=self.label_dtype_cbbox.currentData(),
+                tile_size=self.tile_size_spinbox.value() or None,
+                tile_overlap=self.tile_overlap_spinbox.value(),
+                label_store=self.label_store_chkbox.isChecked(),
+                sparse_labels=self.sparse_labels_chkbox.isChecked(),
+                device=self.device_cbbox.currentData(),
+                num_threads=self.threads_spinbox.value() or None,
+                quantize=self.quantize_chkbox.isChecked(),
+                compile_model=self.compile_chkbox.isChecked(),
+                propagation_axis=self.propagation_axis_cbbox.currentData(),
+                series_workers=self.series_workers_spinbox.value(),
+                frame_cache_mb=self.frame_cache_spinbox.value() or None,
+                memory_bank_frames=self.memory_bank_spinbox.value() or None,
+                offload=self.offload_chkbox.isChecked(),
             )
+            # The model stays loaded in the predictor pool, only the old
+            # inference state goes away
+            if previous_pipeline is not None:
+                previous_pipeline.close()
 
             # Create two points layers (if they don't already exist)
-            if "Positive Points" not in self.viewer.layers:
-                self.viewer.add_points(name="Positive Points", data=[], ndim=3)
-            if "Negative Points" not in self.viewer.layers:
-                self.viewer.add_points(name="Negative Points", data=[], ndim=3)
+            # Every point records its object and click label as features
+            for points_layer_name in ("Positive Points", "Negative Points"):
+                if points_layer_name not in self.viewer.layers:
+                    self.viewer.add_points(
+                        name=points_layer_name,
+                        data=np.empty((0, 3)),
+                        ndim=self.pipeline_object.point_ndim,
+                        features={
+                            "obj_id": np.empty(0, dtype=int),
+                            "label": np.empty(0, dtype=int),
+                        },
+                    )
 
             self.viewer.layers.selection = {self.viewer.layers[self.output_layers_combo.currentText()]}
         else:
-            print("Model not recognized.")
+            logger.error("Model %s not recognized.", selected_model)
 
-    def download_checkpoint(self, checkpoint_name, checkpoint_path):
-        url = self.BASE_URL + checkpoint_name
+    # Add a click to the pipeline (or queue it while propagating) and to
+    # the matching points layer
+    def add_prompt_point(self, point, neg_or_pos=1):
+        layer_name = self.output_layers_combo.currentText()
+        if layer_name not in self.viewer.layers:
+            return
+        layer = self.viewer.layers[layer_name]
+        active_label = layer.selected_label
 
-        try:
-            response = requests.get(url, stream=True)
-            response.raise_for_status()  # Check if the download was successful
-
-            with open(checkpoint_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-            print(f"{checkpoint_name} downloaded successfully.")
-
-        except requests.exceptions.RequestException as e:
-            print(
-                f"Failed to download {checkpoint_name} from {url}. Error: {e}"
-            )
+        if self.propagation_worker is not None:
+            # The inference state is busy - apply the click after the run
+            logger.info("Propagation running, queued point %s", point)
+            self.pending_points.append((point, active_label, neg_or_pos))
+        else:
+            self.pipeline_object.add_point(point, active_label, neg_or_pos=neg_or_pos)
+            self.show_timings()
+
+        points_layer_name = "Positive Points" if neg_or_pos else "Negative Points"
+        if points_layer_name in self.viewer.layers:
+            points_layer = self.viewer.layers[points_layer_name]
+            if points_layer.ndim != len(point):
+                logger.warning(
+                    "%s is %dD, not keeping the %dD point",
+                    points_layer_name,
+                    points_layer.ndim,
+                    len(point),
+                )
+                return
+            self.set_point_features(points_layer, active_label, neg_or_pos)
+            if points_layer.data.size == 0:
+                points_layer.data = np.array([point])
+            else:
+                points_layer.data = np.concatenate([points_layer.data, [point]], axis=0)
+
+    # New points of the layer get obj_id and label features from the
+    # feature defaults. Layers from older sessions get the columns first,
+    # their points are assigned to the object being clicked.
+    def set_point_features(self, points_layer, obj_id, neg_or_pos):
+        features = points_layer.features
+        if "obj_id" not in features or "label" not in features:
+            features = features.copy()
+            if "obj_id" not in features:
+                features["obj_id"] = obj_id
+            if "label" not in features:
+                features["label"] = neg_or_pos
+            points_layer.features = features
+        defaults = points_layer.feature_defaults.iloc[0].to_dict()
+        defaults.update(obj_id=obj_id, label=neg_or_pos)
+        points_layer.feature_defaults = defaults
+
+    # Integer [z, y, x] (or [t, z, y, x] for 4D layers) of a viewer position
+    def point_at(self, position):
+        return [int(p) for p in position[-self.pipeline_object.point_ndim:]]
 
     def on_mouse_click(self, layer, event):
         if event.button == 3:  # Middle click
-            point = [int(event.position[0]), int(event.position[1]), int(event.position[2])]
-            layer_name = self.output_layers_combo.currentText()
-            if layer_name not in self.viewer.layers:
+            if self.pipeline_object is None:
                 return
-            layer = self.viewer.layers[layer_name]
-            active_label = layer.selected_label
+            point = self.point_at(event.position)
             if "Control" in event.modifiers:
                 # Negative point
-                self.pipeline_object.add_point(point, active_label, neg_or_pos=0)
-                if "Negative Points" in self.viewer.layers:
-                    neg_layer = self.viewer.layers["Negative Points"]
-                    if neg_layer.data.size == 0:
-                        neg_layer.data = np.array([point])
-                    else:
-                        neg_layer.data = np.concatenate([neg_layer.data, [point]], axis=0)
+                self.add_prompt_point(point, neg_or_pos=0)
             else:
                 # Positive point
-                self.pipeline_object.add_point(point, active_label, neg_or_pos=1)
-                if "Positive Points" in self.viewer.layers:
-                    pos_layer = self.viewer.layers["Positive Points"]
-                    if pos_layer.data.size == 0:
-                        pos_layer.data = np.array([point])
-                    else:
-                        pos_layer.data = np.concatenate([pos_layer.data, [point]], axis=0)
+                self.add_prompt_point(point, neg_or_pos=1)
 
+    # Propagation runs in a napari worker thread and streams the masks back
     def video_propagate(self):
-        self.pipeline_object.video_propagate()
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            return
+        generator_function = self.pipeline_object.iter_video_propagate
+        if self.profile_chkbox.isChecked():
+            generator_function = self.profiled_propagation
+            self.profile_chkbox.setChecked(False)
+        self.start_propagation_worker(
+            generator_function,
+            window=self.window_spinbox.value() if self.window_spinbox.value() >= 0 else None,
+            stop_after_empty=self.stop_empty_spinbox.value() or None,
+            merge_rule=self.merge_rule_cbbox.currentData(),
+        )
+
+    # Re-propagate only the object of the last click from its frame
+    def propagate_correction(self):
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            return
+        self.start_propagation_worker(
+            self.pipeline_object.iter_incremental_propagate,
+            window=self.window_spinbox.value() if self.window_spinbox.value() >= 0 else None,
+        )
+
+    # Coarse propagation on a subset of the frames at a lower resolution
+    def preview_propagation(self):
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            return
+        self.start_propagation_worker(
+            self.pipeline_object.iter_preview_propagate,
+            stride=self.preview_stride_spinbox.value(),
+            xy_step=self.preview_xy_spinbox.value(),
+            merge_rule=self.merge_rule_cbbox.currentData(),
+        )
+
+    # Propagate the accepted objects (ids in the line edit, or every
+    # previewed object) at full resolution
+    def refine_objects(self):
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            return
+        text = self.refine_objects_lineedt.text().replace(",", " ").split()
+        try:
+            obj_ids = [int(obj_id) for obj_id in text] or None
+        except ValueError:
+            logger.error("Objects to refine must be label ids, got %r", text)
+            return
+        self.start_propagation_worker(
+            self.pipeline_object.iter_refine_objects,
+            obj_ids=obj_ids,
+            window=self.window_spinbox.value() if self.window_spinbox.value() >= 0 else None,
+        )
+
+    # Propagation under torch.profiler, the trace goes to the profiles
+    # folder of the inter frame dir. Entered in the worker thread.
+    def profiled_propagation(self, **kwargs):
+        profile_dir = Path(self.interdir_lineedt.text()) / Path("profiles")
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        trace_path = profile_dir / f"propagation_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        with torch_profile(trace_path):
+            yield from self.pipeline_object.iter_video_propagate(**kwargs)
+
+    def start_propagation_worker(self, generator_function, *args, **kwargs):
+        worker = create_worker(
+            generator_function,
+            *args,
+            _worker_class=PropagationWorker,
+            **kwargs,
+        )
+        worker.yielded.connect(self.on_propagated_frame)
+        worker.errored.connect(self.on_propagation_error)
+        worker.finished.connect(self.on_propagation_finished)
+        self.propagation_worker = worker
+
+        self.video_propagation_progressBar.setValue(0)
+        self.video_propagate_btn.setEnabled(False)
+        self.update_correction_btn.setEnabled(False)
+        self.preview_btn.setEnabled(False)
+        self.refine_btn.setEnabled(False)
+        self.pause_btn.setEnabled(True)
+        self.pause_btn.setText("Pause")
+        self.cancel_btn.setEnabled(True)
+        worker.start()
+
+    def on_propagated_frame(self, result):
+        frame_idx, progress = result
+        self.pipeline_object.refresh_frame(frame_idx)
+        self.video_propagation_progressBar.setValue(progress)
+
+    def on_propagation_error(self, error):
+        logger.error("Propagation failed: %s", error)
+
+    def on_propagation_finished(self):
+        aborted = self.propagation_worker.abort_requested
+        self.propagation_worker = None
+        self.video_propagate_btn.setEnabled(True)
+        self.update_correction_btn.setEnabled(True)
+        self.preview_btn.setEnabled(True)
+        self.refine_btn.setEnabled(True)
+        self.pause_btn.setEnabled(False)
+        self.pause_btn.setText("Pause")
+        self.cancel_btn.setEnabled(False)
+        if not aborted:
+            self.video_propagation_progressBar.setValue(100)
+
+        layer_name = self.output_layers_combo.currentText()
+        if layer_name in self.viewer.layers:
+            self.viewer.layers[layer_name].refresh()
+        self.show_object_extents()
+        self.show_timings()
+
+        # Apply the clicks that came in while the worker was running
+        pending_points, self.pending_points = self.pending_points, []
+        for point, active_label, neg_or_pos in pending_points:
+            self.pipeline_object.add_point(point, active_label, neg_or_pos=neg_or_pos)
+
+    # Show the frame range every object was found in
+    def show_object_extents(self):
+        extents = self.pipeline_object.object_extents
+        self.object_extents_label.setText(
+            "Object extents: "
+            + ", ".join(
+                f"{obj_id}: frames {z_min} - {z_max}"
+                for obj_id, (z_min, z_max) in sorted(extents.items())
+            )
+            if extents
+            else ""
+        )
+
+    # Show propagation throughput, click latency, model stage times and
+    # memory use from the recorded timings
+    def show_timings(self):
+        summary = self.pipeline_object.performance_summary()
+        stages = summary["stages"]
+        parts = []
+        if "frames_per_s" in summary:
+            parts.append(f"{summary['frames_per_s']:.1f} frames/s")
+        if "ms_per_click" in summary:
+            parts.append(f"{summary['ms_per_click']:.0f} ms/click")
+        for stage, name in (
+                ("model.image_encoder", "encoder"),
+                ("model.memory_attention", "memory attention"),
+                ("napari.write_plane", "painting"),
+        ):
+            if stage in stages:
+                parts.append(f"{name} {stages[stage]['mean_ms']:.1f} ms")
+        resident = summary.get("resident", {})
+        if "frames" in resident:
+            parts.append(
+                f"frames {resident['frames']} ({resident['frames_mb']:.0f} MB)"
+            )
+        if "memory_bank_mb" in resident:
+            bank = f"memory bank {resident['memory_bank_mb']:.0f} MB"
+            if resident["spilled_frames"]:
+                bank += f" (+{resident['spilled_mb']:.0f} MB on disk)"
+            parts.append(bank)
+        memory = summary["memory"]
+        if "gpu_mb" in memory:
+            parts.append(
+                f"GPU {memory['gpu_mb']:.0f} MB (peak {memory['peak_gpu_mb']:.0f} MB)"
+            )
+        if "rss_mb" in memory:
+            parts.append(f"CPU {memory['rss_mb']:.0f} MB")
+        if "peak_rss_mb" in memory:
+            parts.append(f"CPU peak {memory['peak_rss_mb']:.0f} MB")
+        self.timings_label.setText(" | ".join(parts))
+
+    # Save the recorded stage timings as a Chrome trace
+    def export_chrome_trace(self):
+        file_name, _ = QFileDialog.getSaveFileName(
+            self,
+            "Export Chrome trace",
+            str(Path(self.interdir_lineedt.text()) / Path("samv2_trace.json")),
+            "Chrome trace (*.json)",
+        )
+        if file_name:
+            get_timings().export_chrome_trace(file_name)
+
+    # Save prompts, tracker memory and labels, by default to the inter
+    # frame dir
+    def save_session(self):
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            return
+        default_path = Path(self.interdir_lineedt.text()) / Path(
+            self.image_layers_combo.currentText() + SESSION_SUFFIX
+        )
+        file_name, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save session",
+            str(default_path),
+            f"SAM V2 session (*{SESSION_SUFFIX})",
+        )
+        if file_name:
+            self.pipeline_object.save_session(file_name)
+
+    # Export the labels as a compressed zarr volume or as COCO RLE JSON,
+    # picked by the file filter
+    def export_labels(self):
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            return
+        default_path = Path(self.interdir_lineedt.text()) / Path(
+            self.output_layers_combo.currentText()
+        )
+        file_name, selected_filter = QFileDialog.getSaveFileName(
+            self,
+            "Export labels",
+            str(default_path),
+            "Zarr volume (*.zarr);;COCO RLE (*.json)",
+        )
+        if not file_name:
+            return
+        path = Path(file_name)
+        if path.suffix not in (".zarr", ".json"):
+            path = path.with_suffix(".json" if "json" in selected_filter else ".zarr")
+        try:
+            self.pipeline_object.export_labels(path)
+        except (ImportError, OSError, ValueError) as e:
+            logger.error("Could not export the labels to %s: %s", path, e)
+            return
+        self.show_timings()
+
+    # Resume a session of the initialized image layer: the labels, prompts
+    # and tracker memory are restored and the points layers show its clicks
+    def load_session(self):
+        if self.pipeline_object is None or self.propagation_worker is not None:
+            logger.warning("Initialize the image layer before loading a session")
+            return
+        file_name, _ = QFileDialog.getOpenFileName(
+            self,
+            "Load session",
+            self.interdir_lineedt.text(),
+            f"SAM V2 session (*{SESSION_SUFFIX})",
+        )
+        if not file_name:
+            return
+        try:
+            self.pipeline_object.load_session(file_name)
+        except (OSError, KeyError, ValueError) as e:
+            logger.error("Could not load session %s: %s", file_name, e)
+            return
+
+        points = list(self.pipeline_object.prompt_points())
+        ndim = self.pipeline_object.point_ndim
+        for points_layer_name, label in (
+                ("Positive Points", 1),
+                ("Negative Points", 0),
+        ):
+            rows = [(point, obj_id) for point, obj_id, lbl in points if lbl == label]
+            data = np.array([point for point, _ in rows]).reshape(-1, ndim)
+            features = {
+                "obj_id": np.array([obj_id for _, obj_id in rows], dtype=int),
+                "label": np.full(len(rows), label, dtype=int),
+            }
+            if points_layer_name in self.viewer.layers:
+                points_layer = self.viewer.layers[points_layer_name]
+                if points_layer.ndim != ndim:
+                    logger.warning(
+                        "%s is %dD, not showing the session points",
+                        points_layer_name,
+                        points_layer.ndim,
+                    )
+                    continue
+                points_layer.data = data
+                points_layer.features = features
+            else:
+                self.viewer.add_points(
+                    name=points_layer_name, data=data, ndim=ndim, features=features
+                )
+        self.show_object_extents()
+        self.show_timings()
+
+    def toggle_pause_propagation(self):
+        if self.propagation_worker is None:
+            return
+        self.propagation_worker.toggle_pause()
+        self.pause_btn.setText(
+            "Resume" if self.propagation_worker.is_paused else "Pause"
+        )
+
+    def cancel_propagation(self):
+        if self.propagation_worker is not None:
+            logger.info("Cancelling propagation")
+            self.propagation_worker.quit()
 
     def reset_everything(self):
+        if self.propagation_worker is not None:
+            logger.warning("Cancel the running propagation before resetting")
+            return
         self.pipeline_object.reset()
-
-    def reset_and_propagate(self):
-        self.pipeline_object.reset_and_video_propagate()
\ No newline at end of file
@@ -0,0 +1,379 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from pipelines.samv2.Samv2_label_store import (
+    blosc_compression,
+    open_label_store,
+)
+from pipelines.samv2.Samv2_model_store import MODEL_CONFIGS, ModelStore
+from pipelines.samv2.Samv2_propagation import MERGE_RULES, label_dtype_for
+from pipelines.samv2.Samv2_timing import configure_logging, get_timings
+
+logger = logging.getLogger(__name__)
+
+VOLUME_SUFFIXES = (".npy", ".tif", ".tiff", ".zarr")
+PROMPT_SUFFIXES = (".csv", ".json")
+PROMPT_COLUMNS = ("z", "y", "x", "label", "obj_id")
+
+
+# Read click prompts as (z, y, x, label, obj_id) rows. CSV files need a
+# header with those columns; JSON files hold a list of objects with those
+# keys (or of [z, y, x, label, obj_id] lists), optionally under "prompts".
+# label defaults to 1 (positive) and obj_id to 1. Prompts of 4D volumes
+# have a "t" column first and are read as (t, z, y, x, label, obj_id).
+# With the volume's ndim, every prompt is checked to have a "t" column
+# exactly when the volume is 4D.
+def read_prompt_file(path, ndim=None):
+    path = Path(path)
+    if path.suffix == ".csv":
+        with open(path, newline="") as f:
+            records = list(csv.DictReader(f))
+    elif path.suffix == ".json":
+        with open(path) as f:
+            records = json.load(f)
+        if isinstance(records, dict):
+            records = records["prompts"]
+    else:
+        raise ValueError(f"Unsupported prompt file {path}")
+
+    prompts = []
+    for record in records:
+        if not isinstance(record, dict):
+            columns = PROMPT_COLUMNS
+            if len(record) > len(PROMPT_COLUMNS):
+                columns = ("t",) + PROMPT_COLUMNS
+            record = dict(zip(columns, record))
+        missing = [key for key in ("z", "y", "x") if key not in record]
+        if missing:
+            raise ValueError(f"Prompt {record} in {path} has no {missing}")
+        if ndim is not None and ("t" in record) != (ndim == 4):
+            raise ValueError(
+                f"Prompt {record} in {path} "
+                + (
+                    "needs a t column, the volume is 4D"
+                    if ndim == 4
+                    else f"has a t column, the volume is {ndim}D"
+                )
+            )
+        prompts.append(
+            ((int(float(record["t"])),) if "t" in record else ())
+            + (
+                int(float(record["z"])),
+                int(float(record["y"])),
+                int(float(record["x"])),
+                int(float(record.get("label", 1))),
+                int(float(record.get("obj_id", 1))),
+            )
+        )
+    return prompts
+
+
+# Open a volume without reading it into memory when the format allows it
+def load_volume(path):
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.load(path, mmap_mode="r")
+    if path.suffix in (".tif", ".tiff"):
+        from skimage.io import imread
+
+        return imread(path)
+    if path.suffix == ".zarr":
+        import zarr
+
+        return zarr.open_array(str(path), mode="r")
+    raise ValueError(f"Unsupported volume format {path}")
+
+
+# One volume to segment with its prompts and where the labels go
+class SegmentationJob:
+    def __init__(self, volume_path, prompt_path, output_path):
+        self.volume_path = Path(volume_path)
+        self.prompt_path = Path(prompt_path)
+        self.output_path = Path(output_path)
+
+    def __repr__(self):
+        return f"SegmentationJob({self.volume_path.name})"
+
+    @property
+    def name(self):
+        return self.volume_path.stem
+
+
+# Pair every volume of volume_dir with the prompt file of the same name
+# (in prompt_dir, the volume dir by default)
+def find_jobs(volume_dir, output_dir, prompt_dir=None, zarr_output=False):
+    volume_dir = Path(volume_dir)
+    prompt_dir = Path(prompt_dir) if prompt_dir else volume_dir
+    jobs = []
+    for volume_path in sorted(volume_dir.iterdir()):
+        if volume_path.suffix not in VOLUME_SUFFIXES:
+            continue
+        prompt_path = next(
+            (
+                prompt_dir / f"{volume_path.stem}{suffix}"
+                for suffix in PROMPT_SUFFIXES
+                if (prompt_dir / f"{volume_path.stem}{suffix}").exists()
+            ),
+            None,
+        )
+        if prompt_path is None:
+            logger.warning("Skipping %s, no prompt file", volume_path.name)
+            continue
+        suffix = ".zarr" if zarr_output else ".npy"
+        jobs.append(
+            SegmentationJob(
+                volume_path,
+                prompt_path,
+                Path(output_dir) / f"{volume_path.stem}_labels{suffix}",
+            )
+        )
+    return jobs
+
+
+# Segment one volume. Module level so process pools can pickle it; every
+# worker process keeps its model loaded between jobs.
+def run_job(job, options):
+    from pipelines.samv2.Samv2_engine import SamV2Engine
+    from pipelines.samv2.Samv2_series import SeriesEngine
+    from pipelines.samv2.Samv2_session import SESSION_SUFFIX, save_session
+    from pipelines.samv2.Samv2_sparse_labels import (
+        SparseLabelVolume,
+        export_coco_rle,
+        export_zarr,
+    )
+
+    # Spawned workers start without the log handler of the main process
+    configure_logging(options["log_level"])
+    start = time.perf_counter()
+    volume = load_volume(job.volume_path)
+    prompts = read_prompt_file(job.prompt_path, ndim=volume.ndim)
+    if not prompts:
+        raise ValueError(f"No prompts in {job.prompt_path}")
+    label_dtype = label_dtype_for(max(obj_id for *_, obj_id in prompts))
+
+    job.output_path.parent.mkdir(parents=True, exist_ok=True)
+    if options["sparse"]:
+        # Written out once propagation is done
+        output = SparseLabelVolume(volume.shape, label_dtype)
+    elif job.output_path.suffix == ".zarr":
+        output = open_label_store(
+            job.output_path,
+            volume.shape,
+            label_dtype,
+            compression=blosc_compression(),
+        )
+    else:
+        output = np.zeros(volume.shape, dtype=label_dtype)
+
+    model_cfg, _ = MODEL_CONFIGS[options["model"]]
+    engine_kwargs = {
+        "name": job.name,
+        "output": output,
+        "contrast_mode": options["contrast"],
+        "tile_size": options["tile_size"],
+        "tile_overlap": options["tile_overlap"],
+        "device": options["device"],
+        "num_threads": options["threads"],
+        "quantize": options["quantize"],
+        "compile_model": options["compile"],
+        "frame_cache_mb": options["frame_cache_mb"],
+        "prefetch_frames": options["prefetch_frames"],
+        "offload_frames": options["offload"],
+        "offload_state": options["offload"],
+        "memory_bank_frames": options["memory_bank_frames"],
+    }
+    if volume.ndim == 4:
+        engine = SeriesEngine(
+            volume,
+            options["checkpoint"],
+            model_cfg,
+            options["work_dir"],
+            propagation_axis=options["propagation_axis"],
+            max_workers=options["series_workers"],
+            **engine_kwargs,
+        )
+    else:
+        engine = SamV2Engine(
+            volume,
+            options["checkpoint"],
+            model_cfg,
+            options["work_dir"],
+            **engine_kwargs,
+        )
+    try:
+        engine.add_prompts(prompts)
+        engine.propagate(
+            window=options["window"],
+            stop_after_empty=options["stop_after_empty"],
+            merge_rule=options["merge_rule"],
+        )
+        if options["sparse"] and job.output_path.suffix == ".zarr":
+            export_zarr(engine.output, job.output_path)
+        elif job.output_path.suffix == ".npy":
+            np.save(job.output_path, np.asarray(engine.output))
+        if options["coco"]:
+            export_coco_rle(
+                engine.output, job.output_path.with_suffix(".json")
+            )
+        if options["sessions"]:
+            # Resumable in the widget without propagating again
+            save_session(engine, job.output_path.with_suffix(SESSION_SUFFIX))
+        extents = dict(engine.object_extents)
+    finally:
+        engine.close()
+    return job.output_path, time.perf_counter() - start, extents
+
+
+# Run jobs one after the other (jobs=1) or in a pool of worker processes.
+# Returns the list of (job, error) that failed.
+def run_jobs(jobs, options, num_jobs=1):
+    failed = []
+
+    def report(job, result):
+        output_path, seconds, extents = result
+        logger.info(
+            "%s: %d objects written to %s in %.1f s",
+            job.name,
+            len(extents),
+            output_path,
+            seconds,
+        )
+
+    if num_jobs <= 1:
+        for job in jobs:
+            try:
+                report(job, run_job(job, options))
+            except Exception as e:  # noqa: BLE001 - keep the queue going
+                logger.exception("%s failed", job.name)
+                failed.append((job, e))
+        return failed
+
+    # spawn, so every worker initializes torch / cuda on its own
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_jobs, mp_context=context) as pool:
+        futures = {pool.submit(run_job, job, options): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                report(job, future.result())
+            except Exception as e:  # noqa: BLE001 - keep the queue going
+                logger.exception("%s failed", job.name)
+                failed.append((job, e))
+    return failed
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="samv2-batch",
+        description=(
+            "Segment a directory of volumes with SAM V2 from click prompt "
+            "files (CSV or JSON of z, y, x, label, obj_id) without napari."
+        ),
+    )
+    parser.add_argument("volume_dir", help="directory of .npy, .tif or .zarr volumes")
+    parser.add_argument("--prompts", dest="prompt_dir", help="directory of prompt files (default: volume_dir)")
+    parser.add_argument("--output", dest="output_dir", help="directory for the label volumes (default: volume_dir/labels)")
+    parser.add_argument("--work-dir", help="directory for models, frames and caches (default: output/.samv2)")
+    parser.add_argument("--model", default="sam2.1_hiera_large", choices=sorted(MODEL_CONFIGS))
+    parser.add_argument("--checkpoint", help="checkpoint file (default: the model cache)")
+    parser.add_argument("--model-cache", help="shared checkpoint cache (default: $SAMV2_MODEL_CACHE or the user cache dir)")
+    parser.add_argument("--model-url", help="base URL checkpoints are downloaded from")
+    parser.add_argument("--offline", action="store_true", default=None, help="only use checkpoints already in the model cache")
+    parser.add_argument("--jobs", type=int, default=1, help="volumes processed at the same time")
+    parser.add_argument("--threads", type=int, help="CPU threads per job (default: cores / jobs)")
+    parser.add_argument("--device", default="auto", choices=("auto", "cuda", "cpu"))
+    parser.add_argument("--quantize", action="store_true", help="dynamic int8 quantization (CPU)")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the encoder and memory attention")
+    # contrast_limits needs a napari layer, so it is not offered here
+    parser.add_argument("--contrast", default="percentile", choices=("percentile", "dtype"))
+    parser.add_argument("--window", type=int, help="frames to propagate beyond the prompted frames")
+    parser.add_argument("--stop-after-empty", type=int, help="stop a pass after this many empty frames")
+    parser.add_argument("--merge-rule", default="forward", choices=MERGE_RULES)
+    parser.add_argument("--tile-size", type=int, help="propagate tiles of this size at full resolution")
+    parser.add_argument("--tile-overlap", type=int, default=128)
+    parser.add_argument("--zarr", action="store_true", help="write the labels as chunked zarr volumes")
+    parser.add_argument("--sparse", action="store_true", help="keep the labels as per object bounding boxes and bit-packed masks while propagating, memory follows the labeled voxels")
+    parser.add_argument("--coco", action="store_true", help="also write the labels as COCO RLE JSON (<volume>_labels.json)")
+    parser.add_argument("--propagation-axis", type=int, default=1, choices=(0, 1), help="4D volumes: propagate along axis 0 (T) or 1 (Z), the other axis is split into sub-volumes")
+    parser.add_argument("--series-workers", type=int, default=2, help="4D volumes: sub-volumes propagated at the same time")
+    parser.add_argument("--frame-cache-mb", type=float, help="memory for converted frames (default: 16 frames)")
+    parser.add_argument("--prefetch-frames", type=int, default=2, help="frames read ahead of propagation on a background thread")
+    parser.add_argument("--memory-bank-frames", type=int, help="propagated frames of tracker memory kept in memory per object, the others spill to the work dir")
+    parser.add_argument("--offload", action="store_true", help="keep frames and tracker memory in CPU memory instead of on the GPU")
+    parser.add_argument("--sessions", action="store_true", help="also save a session file (prompts, tracker memory, labels) next to every output")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"), help="DEBUG also logs every timed stage")
+    parser.add_argument("--trace", help="write the stage timings as a Chrome trace (JSON) to this file")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_level)
+    volume_dir = Path(args.volume_dir)
+    output_dir = Path(args.output_dir) if args.output_dir else volume_dir / "labels"
+    work_dir = Path(args.work_dir) if args.work_dir else output_dir / ".samv2"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    jobs = find_jobs(volume_dir, output_dir, args.prompt_dir, args.zarr)
+    if not jobs:
+        logger.error("No volumes with prompt files in %s", volume_dir)
+        return 1
+
+    checkpoint_path = args.checkpoint
+    if not checkpoint_path:
+        # Fetched once here, so the workers never download at the same time
+        store = ModelStore(args.model_cache, args.model_url, args.offline)
+        try:
+            checkpoint_path = store.fetch(MODEL_CONFIGS[args.model][1])
+        except (OSError, ValueError) as e:
+            logger.error("Could not get the %s checkpoint: %s", args.model, e)
+            return 1
+
+    num_jobs = max(1, min(args.jobs, len(jobs)))
+    options = {
+        "model": args.model,
+        "checkpoint": str(checkpoint_path),
+        "work_dir": str(work_dir),
+        "device": args.device,
+        "threads": args.threads or max(1, (os.cpu_count() or 1) // num_jobs),
+        "quantize": args.quantize,
+        "compile": args.compile,
+        "contrast": args.contrast,
+        "window": args.window,
+        "stop_after_empty": args.stop_after_empty,
+        "merge_rule": args.merge_rule,
+        "tile_size": args.tile_size,
+        "tile_overlap": args.tile_overlap,
+        "log_level": args.log_level,
+        "propagation_axis": args.propagation_axis,
+        "series_workers": args.series_workers,
+        "sessions": args.sessions,
+        "sparse": args.sparse,
+        "coco": args.coco,
+        "frame_cache_mb": args.frame_cache_mb,
+        "prefetch_frames": args.prefetch_frames,
+        "memory_bank_frames": args.memory_bank_frames,
+        "offload": args.offload,
+    }
+    logger.info("Segmenting %d volumes with %d concurrent jobs", len(jobs), num_jobs)
+    failed = run_jobs(jobs, options, num_jobs)
+    logger.info("%d of %d volumes segmented", len(jobs) - len(failed), len(jobs))
+    if args.trace:
+        if num_jobs > 1:
+            logger.warning("--trace only records the stages run in this process")
+        get_timings().export_chrome_trace(args.trace)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+DEVICE_CHOICES = ("auto", "cuda", "cpu")
+
+
+# Resolve a device preference ("auto", "cuda" or "cpu") to a torch device
+def select_device(preference="auto"):
+    preference = preference or "auto"
+    if preference not in DEVICE_CHOICES:
+        raise ValueError(
+            f"Invalid device {preference!r}. Expected one of {DEVICE_CHOICES}."
+        )
+    if preference == "cuda" and not torch.cuda.is_available():
+        logger.warning("CUDA is not available, running on the CPU")
+        preference = "cpu"
+    if preference == "auto":
+        preference = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(preference)
+
+
+# Backend settings of the device: TF32 matmuls on Ampere or newer GPUs and
+# the number of intra-op threads on the CPU (None uses every core)
+def configure_device(device, num_threads=None):
+    device = torch.device(device)
+    if device.type == "cuda":
+        if torch.cuda.get_device_properties(device).major >= 8:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        return
+    num_threads = num_threads or os.cpu_count() or 1
+    if torch.get_num_threads() != num_threads:
+        torch.set_num_threads(num_threads)
+    logger.info("Running on the CPU with %d threads", num_threads)
+
+
+# The two modules that dominate the run time: the Hiera image encoder and
+# the memory attention run for every frame
+OPTIMIZED_MODULES = ("image_encoder", "memory_attention")
+
+
+# Dynamic int8 quantization of the linear layers (weights stored as int8,
+# activations quantized on the fly) - CPU only
+def quantize_predictor(predictor):
+    if predictor.device.type != "cpu":
+        logger.warning("int8 quantization is only used on the CPU, skipping")
+        return predictor
+    for name in OPTIMIZED_MODULES:
+        module = getattr(predictor, name)
+        torch.ao.quantization.quantize_dynamic(
+            module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    logger.info("Quantized the image encoder and memory attention to int8")
+    return predictor
+
+
+# torch.compile the encoder and memory attention. The first frames are
+# slow while the graphs are compiled.
+def compile_predictor(predictor):
+    if not hasattr(torch, "compile"):
+        logger.warning("torch.compile needs torch 2.0 or newer, skipping")
+        return predictor
+    for name in OPTIMIZED_MODULES:
+        setattr(predictor, name, torch.compile(getattr(predictor, name)))
+    logger.info("Compiled the image encoder and memory attention")
+    return predictor
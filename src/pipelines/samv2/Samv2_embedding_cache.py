@@ -0,0 +1,343 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+POS_ENC_DIR = "vision_pos_enc"
+META_NAME = "meta.json"
+# Temp entries left this long are abandoned, whichever process made them
+STALE_TMP_SECONDS = 3600
+# Temp entries of processes that are gone are removed after this grace
+# period (the pid may be from another host sharing the root)
+DEAD_TMP_SECONDS = 60
+
+
+# Folder size helper used to rebuild the LRU index from disk
+def _dir_size(path):
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.is_file())
+
+
+# storage_dtype None keeps the tensor dtype (bfloat16, which numpy has no
+# type for, is stored as float32 without loss)
+def _tensor_to_numpy(tensor, storage_dtype=None):
+    dtype = storage_dtype or tensor.dtype
+    if dtype == torch.bfloat16:
+        dtype = torch.float32
+    return tensor.detach().to("cpu", dtype=dtype).numpy()
+
+
+def _numpy_to_tensor(path, device, dtype):
+    array = np.load(path, mmap_mode="r")
+    return torch.from_numpy(np.array(array)).to(device=device, dtype=dtype)
+
+
+def _pid_alive(pid):
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+# A temp entry (<name>.tmp<pid>) nobody is writing any more
+def _is_stale_tmp(entry):
+    try:
+        age = time.time() - entry.stat().st_mtime
+    except OSError:
+        return False
+    if age > STALE_TMP_SECONDS:
+        return True
+    pid = entry.name.rpartition(".tmp")[2]
+    return (
+        age > DEAD_TMP_SECONDS
+        and pid.isdigit()
+        and not _pid_alive(int(pid))
+    )
+
+
+# LRU index of the entries under one cache root, shared by every
+# EmbeddingCache of the process using that root (e.g. the sub-volume
+# engines of a 4D layer), so they all stay within one budget: the
+# max_bytes of the cache opened last.
+class _CacheIndex:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self._scan()
+
+    # Index every cached entry under root, oldest access first
+    def _scan(self):
+        entries = []
+        for key_dir in self.root.iterdir():
+            if not key_dir.is_dir():
+                continue
+            for entry in key_dir.iterdir():
+                if ".tmp" in entry.name:
+                    if _is_stale_tmp(entry):
+                        shutil.rmtree(entry, ignore_errors=True)
+                elif entry.is_dir() and (entry / META_NAME).exists():
+                    entries.append(
+                        (entry.stat().st_mtime, entry, _dir_size(entry))
+                    )
+        for _, entry, size in sorted(entries, key=lambda e: e[0]):
+            self.entries[entry] = size
+            self.total_bytes += size
+
+    def touch(self, entry):
+        with self.lock:
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+        with contextlib.suppress(OSError):
+            os.utime(entry)
+
+    def add(self, entry):
+        size = _dir_size(entry)
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(entry, 0)
+            self.entries[entry] = size
+            # Evict least recently used entries, but never the new one
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_entry, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                shutil.rmtree(old_entry, ignore_errors=True)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _shared_index(root, max_bytes):
+    key = os.path.realpath(root)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = _CacheIndex(Path(root), max_bytes)
+        else:
+            index.max_bytes = max_bytes
+        return index
+
+
+# On-disk cache of the image encoder output (backbone_out) of every frame.
+# Entries live under <root>/<model>-<key digest>-<resolution>-<volume hash>/
+# <frame>/ as .npy files. model_key is the PredictorPool key of the model
+# (config, checkpoint, device, dtype, quantize, compile), so the features of
+# another checkpoint or of a quantized or compiled model are never mixed.
+# The least recently used frames are removed once the whole root grows
+# past max_bytes (one budget per root and process, see
+# _CacheIndex). The positional encodings do not depend on the
+# image content so they are stored once per key. Features are stored in
+# their own dtype, so a hit gives the same masks as running the encoder;
+# storage_dtype=torch.float16 halves the disk use of float32 features at
+# the cost of slightly different masks (kept under a separate key).
+class EmbeddingCache:
+    def __init__(
+            self,
+            root,
+            volume_hash,
+            model_key,
+            image_size,
+            max_bytes=10 * 1024**3,
+            storage_dtype=None,
+    ):
+        self.root = Path(root)
+        self.model_name = Path(str(model_key[0])).stem
+        model_digest = hashlib.blake2b(
+            repr(tuple(model_key)).encode(), digest_size=8
+        ).hexdigest()
+        self.key = (
+            f"{self.model_name}-{model_digest}-{image_size}-{volume_hash}"
+        )
+        if storage_dtype is not None:
+            self.key += "-" + str(storage_dtype).replace("torch.", "")
+        self.cache_dir = self.root / self.key
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.storage_dtype = storage_dtype
+        self.hits = 0
+        self.misses = 0
+
+        self._pos_enc = None
+        self._index = _shared_index(self.root, max_bytes)
+
+    def frame_dir(self, frame_idx):
+        return self.cache_dir / f"{frame_idx:05d}"
+
+    def __contains__(self, frame_idx):
+        return (self.frame_dir(frame_idx) / META_NAME).exists()
+
+    # Bytes under the root, for every cache sharing it
+    @property
+    def total_bytes(self):
+        return self._index.total_bytes
+
+    def _touch(self, entry):
+        self._index.touch(entry)
+
+    # An evicted positional encoding entry is written again by the next
+    # store; the copy loaded in memory stays valid
+    def _add(self, entry):
+        self._index.add(entry)
+
+    # Write the arrays of one entry to a temp dir and rename it in place
+    def _write_entry(self, entry, tensors, meta):
+        tmp_entry = entry.with_name(entry.name + f".tmp{os.getpid()}")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir(parents=True)
+        for name, tensor in tensors.items():
+            np.save(
+                tmp_entry / f"{name}.npy",
+                _tensor_to_numpy(tensor, self.storage_dtype),
+            )
+        with open(tmp_entry / META_NAME, "w") as f:
+            json.dump(meta, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+        self._add(entry)
+
+    def _load_pos_enc(self, device):
+        if self._pos_enc is None:
+            entry = self.cache_dir / POS_ENC_DIR
+            if not (entry / META_NAME).exists():
+                return None
+            with open(entry / META_NAME) as f:
+                meta = json.load(f)
+            dtype = getattr(torch, meta["dtype"])
+            self._pos_enc = [
+                _numpy_to_tensor(entry / f"{i}.npy", device, dtype)
+                for i in range(meta["levels"])
+            ]
+            self._touch(entry)
+        return [pos.to(device) for pos in self._pos_enc]
+
+    # Rebuild the backbone_out dict of a frame, None on a cache miss
+    def load(self, frame_idx, device):
+        entry = self.frame_dir(frame_idx)
+        if not (entry / META_NAME).exists():
+            self.misses += 1
+            return None
+        pos_enc = self._load_pos_enc(device)
+        if pos_enc is None:
+            self.misses += 1
+            return None
+
+        try:
+            with open(entry / META_NAME) as f:
+                meta = json.load(f)
+            dtype = getattr(torch, meta["dtype"])
+            backbone_fpn = [
+                _numpy_to_tensor(entry / f"fpn_{i}.npy", device, dtype)
+                for i in range(meta["levels"])
+            ]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(
+                "Dropping unreadable embedding cache entry %s: %s", entry, e
+            )
+            shutil.rmtree(entry, ignore_errors=True)
+            self.misses += 1
+            return None
+
+        if meta["vision_features_is_last_fpn"]:
+            vision_features = backbone_fpn[-1]
+        else:
+            vision_features = _numpy_to_tensor(
+                entry / "vision_features.npy", device, dtype
+            )
+        self._touch(entry)
+        self.hits += 1
+        return {
+            "vision_features": vision_features,
+            "vision_pos_enc": pos_enc,
+            "backbone_fpn": backbone_fpn,
+        }
+
+    # Persist the backbone_out dict computed for a frame
+    def store(self, frame_idx, backbone_out):
+        backbone_fpn = backbone_out["backbone_fpn"]
+        dtype = str(backbone_out["vision_features"].dtype).replace("torch.", "")
+
+        if not (self.cache_dir / POS_ENC_DIR / META_NAME).exists():
+            pos_enc = backbone_out["vision_pos_enc"]
+            self._write_entry(
+                self.cache_dir / POS_ENC_DIR,
+                {str(i): pos for i, pos in enumerate(pos_enc)},
+                {
+                    "dtype": str(pos_enc[0].dtype).replace("torch.", ""),
+                    "levels": len(pos_enc),
+                },
+            )
+
+        tensors = {f"fpn_{i}": fpn for i, fpn in enumerate(backbone_fpn)}
+        is_last_fpn = backbone_out["vision_features"] is backbone_fpn[-1]
+        if not is_last_fpn:
+            tensors["vision_features"] = backbone_out["vision_features"]
+        self._write_entry(
+            self.frame_dir(frame_idx),
+            tensors,
+            {
+                "dtype": dtype,
+                "levels": len(backbone_fpn),
+                "vision_features_is_last_fpn": is_last_fpn,
+            },
+        )
+
+
+# Look up the cache attached to an inference state (or to its frame loader)
+def get_embedding_cache(inference_state):
+    cache = inference_state.get("embedding_cache")
+    if cache is None:
+        cache = getattr(inference_state.get("images"), "embedding_cache", None)
+    return cache
+
+
+# Route the predictor's image feature lookup through the embedding cache.
+# The hook is installed once per predictor and is a no-op for inference
+# states without a cache, so a predictor can be shared between volumes.
+def install_embedding_cache_hook(predictor):
+    if getattr(predictor, "_embedding_cache_hooked", False):
+        return
+    compute_image_feature = predictor._get_image_feature
+
+    def _get_image_feature(inference_state, frame_idx, batch_size):
+        cache = get_embedding_cache(inference_state)
+        if cache is None or frame_idx in inference_state["cached_features"]:
+            return compute_image_feature(inference_state, frame_idx, batch_size)
+
+        device = inference_state["device"]
+        backbone_out = cache.load(frame_idx, device)
+        if backbone_out is not None:
+            image = (
+                inference_state["images"][frame_idx]
+                .to(device)
+                .float()
+                .unsqueeze(0)
+            )
+            inference_state["cached_features"] = {
+                frame_idx: (image, backbone_out)
+            }
+            return compute_image_feature(inference_state, frame_idx, batch_size)
+
+        result = compute_image_feature(inference_state, frame_idx, batch_size)
+        cache.store(frame_idx, inference_state["cached_features"][frame_idx][1])
+        return result
+
+    predictor._get_image_feature = _get_image_feature
+    predictor._embedding_cache_hooked = True
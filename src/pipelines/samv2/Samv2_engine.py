@@ -0,0 +1,927 @@
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+
+from pipelines.samv2.Samv2_device import configure_device, select_device
+from pipelines.samv2.Samv2_embedding_cache import (
+    EmbeddingCache,
+    install_embedding_cache_hook,
+)
+from pipelines.samv2.Samv2_frame_export import (
+    export_frames,
+    volume_content_hash,
+)
+from pipelines.samv2.Samv2_frame_source import (
+    VolumeFrameLoader,
+    cached_frames_for,
+    init_state_from_frames,
+)
+from pipelines.samv2.Samv2_label_output import LabelOutputMixin
+from pipelines.samv2.Samv2_masks import MaskCompositor
+from pipelines.samv2.Samv2_memory import MemoryBank, state_memory_report
+from pipelines.samv2.Samv2_normalization import resolve_contrast_policy
+from pipelines.samv2.Samv2_predictor_pool import (
+    PredictorPool,
+    autocast_context,
+    default_autocast_dtype,
+    get_predictor_pool,
+)
+from pipelines.samv2.Samv2_preview import (
+    FrameSubset,
+    preview_frames,
+    preview_spans,
+    upsample_plane,
+)
+from pipelines.samv2.Samv2_prompts import PromptStore
+from pipelines.samv2.Samv2_propagation import (
+    FrameMerger,
+    ObjectExtents,
+    check_label_fits,
+    clear_objects,
+    propagation_passes,
+    propagation_range,
+    replace_object_mask,
+)
+from pipelines.samv2.Samv2_tiling import TiledPropagator
+from pipelines.samv2.Samv2_timing import get_timings, memory_usage
+
+logger = logging.getLogger(__name__)
+
+
+# GUI free Sam V2 engine: a volume and prompts in, a label volume out.
+# work_dir holds everything derived from the volume (contrast policy, JPEG
+# frames, embeddings, label stores) under name. output is the label volume
+# written in place, a zeroed int32 volume is made when none is given.
+class SamV2Engine(LabelOutputMixin):
+    def __init__(
+            self,
+            volume,
+            checkpoint_path,
+            model_cfg_name,
+            work_dir,
+            name="volume",
+            output=None,
+            use_jpeg_frames=False,
+            contrast_mode="percentile",
+            contrast_limits=None,
+            export_workers=None,
+            embedding_cache_gb=None,
+            tile_size=None,
+            tile_overlap=128,
+            device="auto",
+            num_threads=None,
+            quantize=False,
+            compile_model=False,
+            contrast_policy=None,
+            frame_cache_mb=None,
+            prefetch_frames=2,
+            offload_frames=False,
+            offload_state=False,
+            memory_bank_frames=None,
+    ):
+        self.work_dir = Path(work_dir)
+        self.name = name
+        self.image_volume = volume
+        self.model_cfg_name = model_cfg_name
+        self.checkpoint_path = checkpoint_path
+        self.output = (
+            output
+            if output is not None
+            else np.zeros(volume.shape, dtype=np.int32)
+        )
+        self.source_frame_dir = (
+            None  # Will be set inside process volume function
+        )
+        self.frame_source = None
+        self.contrast_policy = None
+        self.volume_hash = None
+        # Tiled propagation for slices larger than tile_size (None disables)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        # Stage timings, shared by every engine of the process
+        self.timings = get_timings()
+        # Memory budgets: converted frames kept in frame_cache_mb (prefetched
+        # ahead of propagation), frames and tracker state offloaded to the
+        # CPU, and at most memory_bank_frames propagated frames of memory
+        # per object in memory, the others spill to the work dir
+        self.frame_cache_mb = frame_cache_mb
+        self.prefetch_frames = prefetch_frames
+        self.offload_frames = offload_frames
+        self.init_state_kwargs = {"offload_state_to_cpu": offload_state}
+        self.memory_bank = (
+            MemoryBank(
+                self.work_dir / Path("memory_bank"),
+                memory_bank_frames,
+                prefix=name,
+            )
+            if memory_bank_frames
+            else None
+        )
+
+        DEVICE = select_device(device)
+        configure_device(DEVICE, num_threads)
+        sam2_checkpoint = checkpoint_path
+        model_cfg = model_cfg_name
+
+        # The network is shared through the process wide pool, so
+        # re-initializing (e.g. for another volume) does not reload the
+        # checkpoint; only the inference state below belongs to this volume.
+        # autocast is entered around each model call (see autocast()).
+        self.autocast_dtype = default_autocast_dtype(DEVICE)
+        self.predictor_pool = get_predictor_pool()
+        self.model_key = PredictorPool.make_key(
+            model_cfg,
+            sam2_checkpoint,
+            DEVICE,
+            self.autocast_dtype,
+            quantize=quantize,
+            compile_model=compile_model,
+        )
+        with self.timings.span("model.load"):
+            self.predictor = self.predictor_pool.acquire(
+                model_cfg,
+                sam2_checkpoint,
+                DEVICE,
+                self.autocast_dtype,
+                quantize=quantize,
+                compile_model=compile_model,
+            )
+        self.timings.instrument_model(self.predictor)
+        if self.memory_bank is not None:
+            self.memory_bank.fit_model(self.predictor)
+
+        # One intensity mapping for the whole volume, recorded for re-runs
+        # (or given, e.g. shared by the sub-volumes of a 4D volume)
+        with self.timings.span("frames.contrast_policy"):
+            self.contrast_policy = contrast_policy or self.get_contrast_policy(
+                contrast_mode, contrast_limits
+            )
+
+        if use_jpeg_frames:
+            # Fallback - write the frames to the work dir as JPEGs
+            with self.timings.span("frames.export"):
+                self.preprocess_volume(num_workers=export_workers)
+        else:
+            # Build the frames straight from the volume
+            self.frame_source = self.frame_loader(volume)
+
+        self.embedding_cache = None
+        if embedding_cache_gb:
+            if self.volume_hash is None:
+                self.volume_hash = volume_content_hash(
+                    volume, self.contrast_policy
+                )
+            self.embedding_cache = EmbeddingCache(
+                self.work_dir / Path("embeddings"),
+                self.volume_hash,
+                self.model_key,
+                self.predictor.image_size,
+                max_bytes=int(embedding_cache_gb * 1024**3),
+            )
+            install_embedding_cache_hook(self.predictor)
+
+        with self.timings.span("init_state"):
+            if use_jpeg_frames:
+                self.inference_state = self.predictor.init_state(
+                    video_path=self.source_frame_dir.as_posix(),
+                    offload_video_to_cpu=offload_frames,
+                    **self.init_state_kwargs,
+                )
+                self.inference_state["embedding_cache"] = self.embedding_cache
+            else:
+                self.frame_source.embedding_cache = self.embedding_cache
+                self.inference_state = init_state_from_frames(
+                    self.predictor, self.frame_source, **self.init_state_kwargs
+                )
+
+        self.prompts = PromptStore()
+        self.compositor = MaskCompositor(
+            self.inference_state["video_height"],
+            self.inference_state["video_width"],
+            self.predictor.device,
+        )
+        self.last_click_latency_ms = None
+        self.click_latencies_ms = []
+        self.object_extents = {}
+        # (obj_id, frame_idx) of the last click, see iter_incremental_propagate
+        self.last_correction = None
+        # Objects whose labels come from the last preview
+        self.preview_objects = set()
+
+    # Frame source over (a view of) the volume within the frame budget
+    def frame_loader(self, volume, crop=None):
+        return VolumeFrameLoader(
+            volume,
+            image_size=self.predictor.image_size,
+            device=self.predictor.device,
+            offload_video_to_cpu=self.offload_frames,
+            max_cached_frames=cached_frames_for(
+                self.frame_cache_mb, self.predictor.image_size
+            ),
+            contrast_policy=self.contrast_policy,
+            crop=crop,
+            prefetch_frames=self.prefetch_frames,
+        )
+
+    # Bound the memory bank of a state before propagating over it
+    def bound_memory(self, state):
+        if self.memory_bank is not None:
+            self.memory_bank.attach(state)
+
+    # Compute (or reload) the 8-bit contrast policy of the volume
+    def get_contrast_policy(self, contrast_mode, contrast_limits=None):
+        policy_dir = self.work_dir / Path(self.name)
+        policy_dir.mkdir(parents=True, exist_ok=True)
+        return resolve_contrast_policy(
+            policy_dir / "contrast_policy.json",
+            self.image_volume,
+            contrast_mode,
+            contrast_limits=contrast_limits,
+        )
+
+    def preprocess_volume(self, num_workers=None):
+        volume = self.image_volume
+
+        # Create a source frame directory
+        self.source_frame_dir = self.work_dir / Path(self.name)
+        logger.info("Creating the frame dir %s", self.source_frame_dir)
+
+        if volume.ndim not in (2, 3):
+            # 4D volumes are split into 3D sub-volumes by SeriesEngine
+            logger.error("Unsupported number of dimensions: %d", volume.ndim)
+            return
+
+        # Frames are reused only if the manifest hash matches the content
+        self.volume_hash = export_frames(
+            volume,
+            self.source_frame_dir,
+            self.contrast_policy,
+            num_workers=num_workers,
+        )
+
+    # Add one click and return the label plane of its frame. The plane is
+    # written into output unless write is False (the caller writes it).
+    def add_point(self, frame_idx, y, x, obj_id, neg_or_pos=1, write=True):
+        click_start = time.perf_counter()
+        # Before the click is recorded, so a rejected label leaves no prompt
+        check_label_fits(obj_id, self.output)
+
+        # The predictor keeps the earlier clicks of this object and frame,
+        # so only the new point is sent (clear_old_points=False)
+        self.prompts.add(obj_id, frame_idx, (x, y), neg_or_pos)
+        self.last_correction = (obj_id, frame_idx)
+        points = np.array([[x, y]], dtype=np.float32)
+        labels = np.array([neg_or_pos], np.int32)
+
+        with self.autocast():
+            with self.timings.span("click.model", frame=int(frame_idx)):
+                _, out_obj_ids, out_mask_logits = (
+                    self.predictor.add_new_points_or_box(
+                        inference_state=self.inference_state,
+                        frame_idx=frame_idx,
+                        obj_id=obj_id,
+                        points=points,
+                        labels=labels,
+                        clear_old_points=False,
+                    )
+                )
+            # Includes the device to host transfer of the label plane
+            with self.timings.span("click.composite"):
+                mask_for_this_frame = self.compositor.composite(
+                    out_obj_ids, out_mask_logits
+                )
+        if write:
+            with self.timings.span("click.write"):
+                self.output[frame_idx] = mask_for_this_frame
+
+        click_seconds = time.perf_counter() - click_start
+        self.timings.record("click", click_seconds, click_start)
+        self.last_click_latency_ms = click_seconds * 1000
+        self.click_latencies_ms.append(self.last_click_latency_ms)
+        logger.info("Click to mask latency: %.1f ms", self.last_click_latency_ms)
+        return mask_for_this_frame
+
+    # autocast is thread local, so worker threads have to enter it themselves
+    def autocast(self):
+        return autocast_context(self.predictor.device, self.autocast_dtype)
+
+    # Drop the inference state and hand the predictor back to the pool
+    def close(self):
+        if self.predictor is None:
+            return
+        self.inference_state = None
+        if self.frame_source is not None:
+            self.frame_source.close()
+        self.frame_source = None
+        if self.memory_bank is not None:
+            self.memory_bank.close()
+        self.predictor_pool.release(self.predictor)
+        self.predictor = None
+
+    # Generator over the forward and reverse passes. Every frame is
+    # composited on the device and written straight into output, then
+    # (frame_idx, progress) is yielded so the caller can refresh a view - it
+    # can run in a worker thread.
+    #
+    # The forward pass starts at the first prompted frame and the reverse
+    # pass at the last one. window limits both passes to that many frames
+    # beyond the prompted frames (None runs to the ends of the volume) and
+    # stop_after_empty ends a pass once every object has been empty for
+    # that many consecutive frames. Frames reached by both passes are merged
+    # in place with merge_rule (see FrameMerger). The prompted objects are
+    # removed from the frames the passes do not reach, so nothing is left
+    # of an earlier run with a wider window. The z extent of every object
+    # is kept in self.object_extents.
+    def iter_video_propagate(
+            self,
+            output=None,
+            window=None,
+            stop_after_empty=None,
+            merge_rule="forward",
+    ):
+        if output is None:
+            output = self.output
+        prompt_frames = self.prompts.frames()
+        if not prompt_frames:
+            logger.warning("No prompts to propagate")
+            return
+        if self.use_tiles():
+            yield from self.iter_tiled_video_propagate(
+                output, window, stop_after_empty, merge_rule
+            )
+            return
+
+        num_frames = self.inference_state["num_frames"]
+        passes = propagation_passes(prompt_frames, num_frames, window)
+        frames_in_range = self.clear_outside_range(output, window, num_frames)
+        total_frames = sum(max_frames + 1 for _, max_frames, _ in passes)
+        frames_done = 0
+        extents = ObjectExtents(self.prompts, stop_after_empty)
+        merger = FrameMerger(merge_rule, self.prompts)
+        self.object_extents = extents.extents
+        self.bound_memory(self.inference_state)
+
+        with self.autocast(), self.timings.span("propagate"):
+            for start_frame_idx, max_frames, reverse in passes:
+                logger.info(
+                    "Executing %s from frame %d over %d frames",
+                    "reverse" if reverse else "forward",
+                    start_frame_idx,
+                    max_frames + 1,
+                )
+                extents.start_pass(reverse)
+                # The model time of a frame runs from resuming the predictor
+                # generator until it hands out the frame
+                step_start = time.perf_counter()
+                for (
+                        out_frame_idx,
+                        out_obj_ids,
+                        out_mask_logits,
+                ) in self.predictor.propagate_in_video(
+                    self.inference_state,
+                    start_frame_idx=start_frame_idx,
+                    max_frame_num_to_track=max_frames,
+                    reverse=reverse,
+                ):
+                    self.timings.record(
+                        "propagate.model",
+                        time.perf_counter() - step_start,
+                        step_start,
+                        frame=int(out_frame_idx),
+                    )
+                    # Includes the device to host transfer of the plane
+                    with self.timings.span("propagate.composite"):
+                        mask_for_this_frame = self.compositor.composite(
+                            out_obj_ids, out_mask_logits
+                        )
+                        present, scores = self.compositor.object_stats(
+                            out_mask_logits
+                        )
+                    with self.timings.span("propagate.write"):
+                        merger.merge(
+                            output,
+                            out_frame_idx,
+                            mask_for_this_frame,
+                            reverse,
+                            out_obj_ids,
+                            scores,
+                        )
+                    extents.update(out_frame_idx, out_obj_ids, present)
+                    frames_in_range.discard(int(out_frame_idx))
+
+                    frames_done += 1
+                    yield out_frame_idx, int(frames_done * 100 / total_frames)
+
+                    if extents.pass_finished(out_obj_ids):
+                        logger.info(
+                            "All objects empty for %d frames, stopping at "
+                            "frame %d",
+                            stop_after_empty,
+                            out_frame_idx,
+                        )
+                        break
+                    step_start = time.perf_counter()
+
+        # Frames the passes stopped before
+        clear_objects(output, self.prompts.objects(), sorted(frames_in_range))
+        self.log_object_extents()
+
+    # Remove the labels of the prompted objects outside the frame range a
+    # propagation with this window covers. Returns the frames inside the
+    # range; the ones the passes do not reach are cleared once they are
+    # done.
+    def clear_outside_range(self, output, window, num_frames):
+        _, _, lo, hi = propagation_range(
+            self.prompts.frames(), num_frames, window
+        )
+        clear_objects(
+            output,
+            self.prompts.objects(),
+            [z for z in range(num_frames) if not lo <= z <= hi],
+        )
+        return set(range(lo, hi + 1))
+
+    # A new inference state over the frames of this volume, without prompts
+    def new_inference_state(self):
+        frame_source = self.frame_source
+        if frame_source is None:
+            # JPEG frames - read the volume directly instead of loading
+            # every JPEG again
+            frame_source = self.frame_loader(self.image_volume)
+            frame_source.embedding_cache = self.embedding_cache
+        return init_state_from_frames(
+            self.predictor, frame_source, **self.init_state_kwargs
+        )
+
+    # Send the prompts of obj_ids to another inference state. Frame indices
+    # go through frame_map and points are divided by xy_step when given
+    # (for states over a subset of the frames at a lower resolution).
+    def add_object_prompts(self, state, obj_ids, frame_map=None, xy_step=1):
+        for obj_id, frame_idx, points, labels in self.prompts.items():
+            if obj_id not in obj_ids:
+                continue
+            self.predictor.add_new_points_or_box(
+                inference_state=state,
+                frame_idx=frame_map[frame_idx] if frame_map else frame_idx,
+                obj_id=obj_id,
+                points=points / xy_step,
+                labels=labels,
+                clear_old_points=False,
+            )
+
+    # Generator re-propagating one object after a correction on frame_idx
+    # (by default the object and frame of the last click). The object is
+    # tracked alone from all of its prompts in a separate inference state,
+    # forward and then backward from the corrected frame. A direction stops
+    # once the new masks match the stored ones (IoU >= converge_iou) for
+    # converge_frames frames in a row, or after window frames. Only the
+    # pixels of that object change in output, other objects keep theirs.
+    # Yields (frame_idx, progress) like iter_video_propagate.
+    def iter_incremental_propagate(
+            self,
+            obj_id=None,
+            frame_idx=None,
+            output=None,
+            converge_iou=0.95,
+            converge_frames=3,
+            window=None,
+    ):
+        if obj_id is None or frame_idx is None:
+            if self.last_correction is None:
+                logger.warning("No correction to propagate")
+                return
+            obj_id, frame_idx = self.last_correction
+        if output is None:
+            output = self.output
+        if self.use_tiles():
+            logger.warning(
+                "Tiled volumes are propagated as a whole after a correction"
+            )
+            yield from self.iter_video_propagate(output=output, window=window)
+            return
+
+        num_frames = self.inference_state["num_frames"]
+        passes = [
+            (False, num_frames - 1 - frame_idx),
+            (True, frame_idx),
+        ]
+        if window is not None and window >= 0:
+            passes = [(reverse, min(frames, window)) for reverse, frames in passes]
+        total_frames = sum(frames + 1 for _, frames in passes)
+        frames_done = 0
+
+        with self.autocast(), self.timings.span(
+                "propagate.incremental", obj_id=int(obj_id)
+        ):
+            with self.timings.span("propagate.incremental_init"):
+                state = self.new_inference_state()
+                self.add_object_prompts(state, [obj_id])
+                self.bound_memory(state)
+
+            for reverse, max_frames in passes:
+                converged = 0
+                step_start = time.perf_counter()
+                for (
+                        out_frame_idx,
+                        out_obj_ids,
+                        out_mask_logits,
+                ) in self.predictor.propagate_in_video(
+                    state,
+                    start_frame_idx=frame_idx,
+                    max_frame_num_to_track=max_frames,
+                    reverse=reverse,
+                ):
+                    self.timings.record(
+                        "propagate.model",
+                        time.perf_counter() - step_start,
+                        step_start,
+                        frame=int(out_frame_idx),
+                    )
+                    with self.timings.span("propagate.composite"):
+                        mask = (
+                            self.compositor.composite(out_obj_ids, out_mask_logits)
+                            == obj_id
+                        )
+                    with self.timings.span("propagate.write"):
+                        iou = replace_object_mask(
+                            output, out_frame_idx, obj_id, mask
+                        )
+                    if mask.any():
+                        z_min, z_max = self.object_extents.get(
+                            obj_id, (out_frame_idx, out_frame_idx)
+                        )
+                        self.object_extents[obj_id] = (
+                            min(z_min, out_frame_idx),
+                            max(z_max, out_frame_idx),
+                        )
+
+                    frames_done += 1
+                    yield out_frame_idx, int(frames_done * 100 / total_frames)
+
+                    if out_frame_idx != frame_idx:
+                        converged = converged + 1 if iou >= converge_iou else 0
+                    if converged >= converge_frames:
+                        logger.info(
+                            "Object %d converged at frame %d (%s)",
+                            obj_id,
+                            out_frame_idx,
+                            "reverse" if reverse else "forward",
+                        )
+                        break
+                    step_start = time.perf_counter()
+
+    # Generator over a quick preview of the propagation: every stride-th
+    # frame (and every prompted frame) read with an XY step of xy_step, in
+    # a separate inference state. Each preview mask is upsampled into the
+    # output frames nearest to its frame, so the whole volume gets a rough
+    # segmentation after a fraction of the model calls. Yields (frame_idx,
+    # progress) for every output frame written. See iter_refine_objects for
+    # the full resolution pass of the objects that look right.
+    def iter_preview_propagate(
+            self, stride=4, xy_step=2, output=None, merge_rule="forward"
+    ):
+        if output is None:
+            output = self.output
+        prompt_frames = self.prompts.frames()
+        if not prompt_frames:
+            logger.warning("No prompts to preview")
+            return
+        num_frames = self.inference_state["num_frames"]
+        frames = preview_frames(num_frames, prompt_frames, stride)
+        spans = preview_spans(frames, num_frames)
+        preview_index = {frame: i for i, frame in enumerate(frames)}
+        xy_step = max(1, int(xy_step))
+
+        # Also closed when a cancel closes the generator at a yield
+        frame_source = None
+        try:
+            with self.autocast(), self.timings.span(
+                    "preview", frames=len(frames), xy_step=xy_step
+            ):
+                with self.timings.span("preview.init"):
+                    frame_source = self.frame_loader(
+                        FrameSubset(self.image_volume, frames),
+                        crop=(slice(None, None, xy_step),) * 2,
+                    )
+                    state = init_state_from_frames(
+                        self.predictor, frame_source, **self.init_state_kwargs
+                    )
+                    self.add_object_prompts(
+                        state, self.prompts.objects(), preview_index, xy_step
+                    )
+                    self.bound_memory(state)
+                compositor = MaskCompositor(
+                    state["video_height"], state["video_width"], self.predictor.device
+                )
+                # The passes are merged at preview resolution, then upsampled
+                preview = np.zeros(
+                    (len(frames), state["video_height"], state["video_width"]),
+                    dtype=output.dtype,
+                )
+                merger = FrameMerger(merge_rule, self.prompts)
+                passes = propagation_passes(
+                    [preview_index[frame] for frame in prompt_frames], len(frames)
+                )
+                total_frames = sum(max_frames + 1 for _, max_frames, _ in passes)
+                frames_done = 0
+                for start_frame_idx, max_frames, reverse in passes:
+                    step_start = time.perf_counter()
+                    for (
+                            out_frame_idx,
+                            out_obj_ids,
+                            out_mask_logits,
+                    ) in self.predictor.propagate_in_video(
+                        state,
+                        start_frame_idx=start_frame_idx,
+                        max_frame_num_to_track=max_frames,
+                        reverse=reverse,
+                    ):
+                        self.timings.record(
+                            "preview.model",
+                            time.perf_counter() - step_start,
+                            step_start,
+                            frame=frames[out_frame_idx],
+                        )
+                        labels = compositor.composite(out_obj_ids, out_mask_logits)
+                        _, scores = compositor.object_stats(out_mask_logits)
+                        merger.merge(
+                            preview, out_frame_idx, labels, reverse, out_obj_ids, scores
+                        )
+                        frames_done += 1
+                        progress = int(frames_done * 100 / total_frames)
+                        with self.timings.span("preview.write"):
+                            plane = upsample_plane(
+                                preview[out_frame_idx], output.shape[1:], xy_step
+                            )
+                            start, stop = spans[out_frame_idx]
+                            for frame_idx in range(start, stop):
+                                output[frame_idx] = plane
+                        for frame_idx in range(start, stop):
+                            yield frame_idx, progress
+                        step_start = time.perf_counter()
+        finally:
+            if frame_source is not None:
+                frame_source.close()
+        self.preview_objects = set(self.prompts.objects())
+        logger.info(
+            "Previewed %d objects on %d of %d frames at 1/%d resolution",
+            len(self.preview_objects),
+            len(frames),
+            num_frames,
+            xy_step,
+        )
+
+    # Generator propagating only obj_ids (by default the previewed objects)
+    # at full resolution in a separate inference state, e.g. the objects
+    # accepted after a preview. Their preview masks are cleared first, the
+    # new masks only take background pixels, so other objects keep
+    # theirs. Yields (frame_idx, progress) like iter_video_propagate.
+    def iter_refine_objects(self, obj_ids=None, output=None, window=None):
+        if output is None:
+            output = self.output
+        if obj_ids is None:
+            obj_ids = self.preview_objects
+        obj_ids = sorted(
+            int(obj_id) for obj_id in obj_ids if obj_id in self.prompts
+        )
+        prompt_frames = sorted(
+            {frame for obj_id in obj_ids for frame in self.prompts.frames(obj_id)}
+        )
+        if not prompt_frames:
+            logger.warning("No prompted objects to refine")
+            return
+        if self.use_tiles():
+            logger.warning("Tiled volumes are refined with every object")
+            yield from self.iter_video_propagate(output=output, window=window)
+            self.preview_objects.clear()
+            return
+
+        num_frames = self.inference_state["num_frames"]
+        passes = propagation_passes(prompt_frames, num_frames, window)
+        total_frames = sum(max_frames + 1 for _, max_frames, _ in passes)
+        frames_done = 0
+        with self.autocast(), self.timings.span("refine", objects=len(obj_ids)):
+            with self.timings.span("refine.init"):
+                previewed = [o for o in obj_ids if o in self.preview_objects]
+                if previewed:
+                    for frame_idx in range(num_frames):
+                        plane = output[frame_idx]
+                        stale = np.isin(plane, previewed)
+                        if stale.any():
+                            plane[stale] = 0
+                            output[frame_idx] = plane
+                state = self.new_inference_state()
+                self.add_object_prompts(state, obj_ids)
+                self.bound_memory(state)
+
+            for start_frame_idx, max_frames, reverse in passes:
+                step_start = time.perf_counter()
+                for (
+                        out_frame_idx,
+                        out_obj_ids,
+                        out_mask_logits,
+                ) in self.predictor.propagate_in_video(
+                    state,
+                    start_frame_idx=start_frame_idx,
+                    max_frame_num_to_track=max_frames,
+                    reverse=reverse,
+                ):
+                    self.timings.record(
+                        "propagate.model",
+                        time.perf_counter() - step_start,
+                        step_start,
+                        frame=int(out_frame_idx),
+                    )
+                    with self.timings.span("propagate.composite"):
+                        labels = self.compositor.composite(
+                            out_obj_ids, out_mask_logits
+                        )
+                    with self.timings.span("propagate.write"):
+                        for obj_id in obj_ids:
+                            mask = labels == obj_id
+                            if reverse:
+                                # Keep what the forward pass found
+                                mask |= output[out_frame_idx] == obj_id
+                            replace_object_mask(
+                                output, out_frame_idx, obj_id, mask
+                            )
+                            if mask.any():
+                                z_min, z_max = self.object_extents.get(
+                                    obj_id, (out_frame_idx, out_frame_idx)
+                                )
+                                self.object_extents[obj_id] = (
+                                    min(z_min, out_frame_idx),
+                                    max(z_max, out_frame_idx),
+                                )
+
+                    frames_done += 1
+                    yield out_frame_idx, int(frames_done * 100 / total_frames)
+                    step_start = time.perf_counter()
+
+        self.preview_objects.difference_update(obj_ids)
+        logger.info("Refined objects %s at full resolution", obj_ids)
+
+    # Tiling only pays off when a slice is larger than one tile
+    def use_tiles(self):
+        return bool(self.tile_size) and max(
+            self.inference_state["video_height"],
+            self.inference_state["video_width"],
+        ) > self.tile_size
+
+    # Same as iter_video_propagate but every slice is split into overlapping
+    # tiles propagated at full resolution. Only the tiles holding prompts,
+    # or the masks of the prompted frames, get an inference state, and the
+    # tiles objects move into take them over during the pass; the tile
+    # masks are blended over the overlaps and merged into output.
+    def iter_tiled_video_propagate(
+            self,
+            output,
+            window=None,
+            stop_after_empty=None,
+            merge_rule="forward",
+    ):
+        propagator = TiledPropagator(
+            self.predictor,
+            self.image_volume,
+            self.tile_size,
+            overlap=self.tile_overlap,
+            contrast_policy=self.contrast_policy,
+        )
+        extents = ObjectExtents(self.prompts, stop_after_empty)
+        merger = FrameMerger(merge_rule, self.prompts)
+        self.object_extents = extents.extents
+        frames_in_range = self.clear_outside_range(
+            output, window, len(self.image_volume)
+        )
+
+        with self.autocast(), self.timings.span("propagate"):
+            with self.timings.span("propagate.tiles_init"):
+                propagator.prepare(self.prompts, label_planes=output)
+            total_frames = max(propagator.total_frames(window), 1)
+            frames_done = 0
+            current_pass = None
+            try:
+                # Model time of a frame covers every tile plus the blending
+                step_start = time.perf_counter()
+                for (
+                        frame_idx,
+                        labels,
+                        obj_ids,
+                        present,
+                        scores,
+                        reverse,
+                        tile_frames,
+                ) in propagator.iter_frames(window, stop_after_empty):
+                    self.timings.record(
+                        "propagate.model",
+                        time.perf_counter() - step_start,
+                        step_start,
+                        frame=int(frame_idx),
+                        tiles=tile_frames,
+                    )
+                    if reverse != current_pass:
+                        current_pass = reverse
+                        extents.start_pass(reverse)
+                    with self.timings.span("propagate.write"):
+                        merger.merge(
+                            output, frame_idx, labels, reverse, obj_ids, scores
+                        )
+                    extents.update(frame_idx, obj_ids, present)
+                    frames_in_range.discard(int(frame_idx))
+
+                    frames_done += tile_frames
+                    yield frame_idx, min(100, int(frames_done * 100 / total_frames))
+                    step_start = time.perf_counter()
+            finally:
+                propagator.close()
+
+        clear_objects(output, self.prompts.objects(), sorted(frames_in_range))
+        self.log_object_extents()
+
+    def log_object_extents(self):
+        for obj_id, (z_min, z_max) in sorted(self.object_extents.items()):
+            logger.info("Object %d spans frames %d - %d", obj_id, z_min, z_max)
+
+    # What the inference state holds in memory and on disk, see
+    # state_memory_report
+    def memory_report(self):
+        return state_memory_report(self.inference_state, self.frame_source)
+
+    # Throughput, latency and memory figures from the recorded timings:
+    # frames_per_s of propagation, ms_per_click, the mean ms of every stage,
+    # the memory in use (see memory_usage) and what the inference state
+    # holds (resident, see memory_report)
+    def performance_summary(self):
+        stages = self.timings.summary()
+        summary = {
+            "stages": stages,
+            "memory": memory_usage(self.predictor.device),
+            "resident": self.memory_report(),
+        }
+        frames = stages.get("propagate.model")
+        propagate = stages.get("propagate")
+        if frames and propagate and propagate["total_ms"]:
+            summary["frames_per_s"] = frames["count"] * 1000 / propagate["total_ms"]
+        if "click" in stages:
+            summary["ms_per_click"] = stages["click"]["mean_ms"]
+        return summary
+
+    # Blocking propagation, returns the label volume
+    def propagate(self, window=None, stop_after_empty=None, merge_rule="forward"):
+        for _ in self.iter_video_propagate(
+                window=window,
+                stop_after_empty=stop_after_empty,
+                merge_rule=merge_rule,
+        ):
+            pass
+        return self.output
+
+    # Add a batch of clicks, prompts are (z, y, x, label, obj_id) rows.
+    # Clicks are grouped by object and frame, and every group is sent to
+    # the predictor in one call. The masks of the prompted frames are not
+    # rendered, propagation writes them. Returns the number of groups.
+    def add_prompts(self, prompts):
+        groups = {}
+        for z, y, x, label, obj_id in prompts:
+            points, labels = groups.setdefault((int(obj_id), int(z)), ([], []))
+            points.append((float(x), float(y)))
+            labels.append(int(label))
+        if not groups:
+            return 0
+        check_label_fits(max(obj_id for obj_id, _ in groups), self.output)
+
+        with self.autocast(), self.timings.span(
+                "prompts.model", groups=len(groups)
+        ):
+            for (obj_id, frame_idx), (points, labels) in groups.items():
+                for point, label in zip(points, labels):
+                    self.prompts.add(obj_id, frame_idx, point, label)
+                self.predictor.add_new_points_or_box(
+                    inference_state=self.inference_state,
+                    frame_idx=frame_idx,
+                    obj_id=obj_id,
+                    points=np.array(points, dtype=np.float32),
+                    labels=np.array(labels, dtype=np.int32),
+                    clear_old_points=False,
+                )
+        logger.info(
+            "Added %d clicks in %d object / frame groups",
+            sum(len(labels) for _, labels in groups.values()),
+            len(groups),
+        )
+        return len(groups)
+
+    # Forget every prompt, the output is kept
+    def clear_prompts(self):
+        self.predictor.reset_state(self.inference_state)
+        self.prompts.clear()
+        self.last_correction = None
+        self.preview_objects.clear()
+
+    # Forget every prompt and clear the output in place
+    def reset(self):
+        self.clear_prompts()
+        # Clear in place, keeping the dtype and without a new volume
+        self.output[...] = 0
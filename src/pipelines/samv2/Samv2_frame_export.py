@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from pipelines.samv2.Samv2_label_store import is_in_memory
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+# Name of the JPEG file of a frame, as expected by the SAM V2 loader
+def frame_file_name(index):
+    return f"{index:04d}.jpeg"
+
+
+# Directory of a zarr array on local disk (zarr 2 DirectoryStore or zarr 3
+# LocalStore), None for other arrays and stores
+def _zarr_array_dir(array):
+    store = getattr(array, "store", None)
+    root = getattr(store, "root", None) or getattr(store, "path", None)
+    if root is None:
+        return None
+    path = Path(str(root)) / (getattr(array, "path", "") or "")
+    return path if path.is_dir() else None
+
+
+# Zarr arrays a dask array reads from. Only the single key layers (where
+# from_zarr keeps its source array) are looked at, so large graphs are not
+# materialized.
+def _dask_sources(volume):
+    graph = volume.__dask_graph__()
+    for layer in getattr(graph, "layers", {}).values():
+        if len(layer) != 1:
+            continue
+        for value in layer.values():
+            if _zarr_array_dir(value) is not None:
+                yield value
+
+
+# Name, size and modification time of every file of a zarr array: chunk
+# writes show up here without reading a chunk
+def _update_with_store_files(digest, array_dir):
+    for root, _, files in sorted(os.walk(array_dir)):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            relpath = os.path.relpath(os.path.join(root, name), array_dir)
+            digest.update(f"{relpath}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+
+# Hash of a volume plus the settings used to turn it into frames. Numpy
+# arrays (memmaps included) are hashed by content. Lazy volumes (dask,
+# zarr) are not read as a whole: they are fingerprinted by their dask graph
+# name, the file names, sizes and modification times of the zarr stores on
+# local disk they read from, and the content of sample_frames evenly spaced
+# frames. An edit in place that leaves all of these unchanged (e.g. a
+# remote store, or an unsampled frame rewritten within the mtime
+# resolution) is not noticed.
+def volume_content_hash(volume, contrast_policy, chunk_frames=16, sample_frames=8):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((tuple(volume.shape), str(volume.dtype))).encode())
+    digest.update(
+        json.dumps(contrast_policy.to_dict(), sort_keys=True).encode()
+    )
+    if volume.ndim == 2:
+        volume = volume[None]
+
+    if not is_in_memory(volume):
+        if type(volume).__module__.startswith("dask."):
+            digest.update(f"dask:{volume.name}".encode())
+            sources = list(_dask_sources(volume))
+        else:
+            # Views of a sub-volume (AxisView) hold the array they read
+            sources = [getattr(volume, "array", volume)]
+        for source in sources:
+            array_dir = _zarr_array_dir(source)
+            if array_dir is not None:
+                _update_with_store_files(digest, array_dir)
+        num_frames = volume.shape[0]
+        for index in sorted(
+            set(np.linspace(0, num_frames - 1, sample_frames).astype(int))
+        ):
+            frame = np.ascontiguousarray(volume[int(index)])
+            digest.update(memoryview(frame).cast("B"))
+        return digest.hexdigest()
+
+    for start in range(0, volume.shape[0], chunk_frames):
+        chunk = np.ascontiguousarray(volume[start: start + chunk_frames])
+        digest.update(memoryview(chunk).cast("B"))
+    return digest.hexdigest()
+
+
+def read_manifest(frame_dir):
+    try:
+        with open(Path(frame_dir) / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(frame_dir, manifest):
+    manifest_path = Path(frame_dir) / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+# Check whether the frames on disk were made from this exact content
+def frames_are_current(frame_dir, content_hash, num_frames):
+    manifest = read_manifest(frame_dir)
+    if manifest is None or manifest.get("content_hash") != content_hash:
+        return False
+    return all(
+        os.path.exists(os.path.join(frame_dir, frame_file_name(i)))
+        for i in range(num_frames)
+    )
+
+
+# Worker function - PIL releases the GIL while encoding, so threads scale
+def _save_frame(slice_path, frame):
+    Image.fromarray(frame).save(slice_path)
+    return slice_path
+
+
+# Export a volume as a JPEG frame directory, in parallel and only if needed
+def export_frames(
+        volume,
+        frame_dir,
+        contrast_policy,
+        num_workers=None,
+        chunk_frames=None,
+):
+    frame_dir = Path(frame_dir)
+    frame_dir.mkdir(parents=True, exist_ok=True)
+    if volume.ndim == 2:
+        # It's a single 2D image
+        volume = volume[None]
+    num_frames = volume.shape[0]
+    num_workers = num_workers or os.cpu_count() or 1
+    chunk_frames = chunk_frames or max(16, 2 * num_workers)
+
+    content_hash = volume_content_hash(volume, contrast_policy)
+    if frames_are_current(frame_dir, content_hash, num_frames):
+        logger.info("Frames in %s are up to date (%s)", frame_dir, content_hash)
+        return content_hash
+
+    # Volume or settings changed, drop the old frames
+    manifest_path = frame_dir / MANIFEST_NAME
+    if manifest_path.exists():
+        manifest_path.unlink()
+    for stale in frame_dir.glob("*.jpeg"):
+        stale.unlink()
+
+    if not contrast_policy.is_identity:
+        logger.info(
+            "Converting volume to 8-bit from %s with %s",
+            volume.dtype,
+            contrast_policy,
+        )
+
+    buffer = np.empty(
+        (chunk_frames, volume.shape[1], volume.shape[2]), dtype=np.uint8
+    )
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start in range(0, num_frames, chunk_frames):
+            stop = min(start + chunk_frames, num_frames)
+            chunk = contrast_policy.apply(
+                volume[start:stop], out=buffer[: stop - start]
+            )
+            # Wait for the chunk before the buffer is reused
+            list(
+                executor.map(
+                    _save_frame,
+                    [
+                        os.path.join(frame_dir, frame_file_name(i))
+                        for i in range(start, stop)
+                    ],
+                    list(chunk),
+                )
+            )
+
+    write_manifest(
+        frame_dir,
+        {
+            "content_hash": content_hash,
+            "num_frames": num_frames,
+            "shape": list(volume.shape),
+            "dtype": str(volume.dtype),
+            "contrast_policy": contrast_policy.to_dict(),
+        },
+    )
+    logger.info("%d frames generated with %d workers", num_frames, num_workers)
+    return content_hash
@@ -0,0 +1,244 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from pipelines.samv2.Samv2_timing import get_timings
+
+# Normalization constants used by the SAM V2 frame loaders
+IMG_MEAN = (0.485, 0.456, 0.406)
+IMG_STD = (0.229, 0.224, 0.225)
+
+
+# Frame source that feeds the predictor straight from a numpy, memmap or
+# dask / zarr volume. Frames are read and converted on first access and only
+# a small LRU of converted frames is kept, nothing is written to disk. crop
+# (a pair of y, x slices) restricts every frame to a region, read lazily.
+# While frames are read in order (forward or backward), the next
+# prefetch_frames frames in that direction are loaded on a background
+# thread, so reading and converting overlaps with the model. Every frame
+# goes through the volume wide contrast_policy (see Samv2_normalization).
+class VolumeFrameLoader:
+    def __init__(
+            self,
+            volume,
+            image_size,
+            contrast_policy,
+            device=None,
+            offload_video_to_cpu=False,
+            max_cached_frames=16,
+            crop=None,
+            prefetch_frames=0,
+    ):
+        if volume.ndim == 2:
+            # It's a single 2D image - treat it as a one frame video
+            volume = volume[None]
+        if volume.ndim != 3:
+            raise ValueError(
+                f"Unsupported number of dimensions: {volume.ndim}"
+            )
+
+        if device is None:
+            device = torch.device("cpu")
+        self.volume = volume
+        self.image_size = image_size
+        self.device = device
+        self.storage_device = (
+            torch.device("cpu") if offload_video_to_cpu else device
+        )
+        self.contrast_policy = contrast_policy
+        self.embedding_cache = None  # Set to reuse encoder outputs from disk
+        self.crop = tuple(crop) if crop is not None else (slice(None),) * 2
+        self.video_height = len(range(*self.crop[0].indices(volume.shape[1])))
+        self.video_width = len(range(*self.crop[1].indices(volume.shape[2])))
+
+        self.img_mean = torch.tensor(IMG_MEAN, dtype=torch.float32)[
+            :, None, None
+        ].to(device)
+        self.img_std = torch.tensor(IMG_STD, dtype=torch.float32)[
+            :, None, None
+        ].to(device)
+
+        # Room for the prefetched frames next to the one in use
+        self.prefetch_frames = prefetch_frames
+        self.max_cached_frames = max(max_cached_frames, prefetch_frames + 2)
+        self._frames = OrderedDict()
+        self._pending = {}  # index -> future of a prefetched frame
+        self._prefetcher = None
+        self._last_index = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.volume.shape[0]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Frame {index} out of range")
+
+        with self._lock:
+            step = (
+                index - self._last_index if self._last_index is not None else 0
+            )
+            self._last_index = index
+            frame = self._frames.get(index)
+            if frame is not None:
+                self._frames.move_to_end(index)
+            pending = self._pending.get(index)
+        if step in (1, -1):
+            self.prefetch(
+                range(index + step, index + step * (self.prefetch_frames + 1), step)
+            )
+        if frame is not None:
+            return frame
+        if pending is not None:
+            return pending.result()
+
+        frame = self.load_frame(index)
+        self._cache(index, frame)
+        return frame
+
+    def _cache(self, index, frame):
+        with self._lock:
+            self._frames[index] = frame
+            self._frames.move_to_end(index)
+            while len(self._frames) > self.max_cached_frames:
+                self._frames.popitem(last=False)
+
+    # Load frames on the background thread, skipping the frames that are
+    # cached or already on their way
+    def prefetch(self, indices):
+        for index in indices:
+            if not 0 <= index < len(self):
+                continue
+            with self._lock:
+                if index in self._frames or index in self._pending:
+                    continue
+                if self._prefetcher is None:
+                    self._prefetcher = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="samv2-prefetch"
+                    )
+                self._pending[index] = self._prefetcher.submit(
+                    self._prefetch_frame, index
+                )
+
+    def _prefetch_frame(self, index):
+        try:
+            frame = self.load_frame(index)
+            self._cache(index, frame)
+            return frame
+        finally:
+            with self._lock:
+                self._pending.pop(index, None)
+
+    # Number and size of the converted frames held in memory
+    def resident(self):
+        with self._lock:
+            frames = list(self._frames.values())
+        return {
+            "count": len(frames),
+            "bytes": sum(f.numel() * f.element_size() for f in frames),
+        }
+
+    def close(self):
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=True, cancel_futures=True)
+            self._prefetcher = None
+        with self._lock:
+            self._frames.clear()
+
+    # Read one slice (np.asarray also computes dask / zarr slices)
+    def read_slice(self, index):
+        return np.asarray(self.volume[(index,) + self.crop])
+
+    # Convert a slice to 8-bit with the volume wide contrast policy
+    def to_uint8(self, frame_slice):
+        return self.contrast_policy.apply(frame_slice)
+
+    def load_frame(self, index):
+        with get_timings().span("frames.load", frame=int(index)):
+            return self._load_frame(index)
+
+    def _load_frame(self, index):
+        frame_slice = self.to_uint8(self.read_slice(index))
+
+        # Same steps as the JPEG loader: RGB, square resize, [0, 1], mean/std
+        image = torch.from_numpy(np.ascontiguousarray(frame_slice))
+        image = image.to(self.device, dtype=torch.float32)
+        image = F.interpolate(
+            image[None, None],
+            size=(self.image_size, self.image_size),
+            mode="bicubic",
+            align_corners=False,
+            antialias=True,
+        )[0]
+        image = image.clamp_(0.0, 255.0) / 255.0
+        # Grey to RGB happens in the mean subtraction broadcast
+        image = image.expand(3, -1, -1) - self.img_mean
+        image /= self.img_std
+        return image.to(self.storage_device)
+
+
+# Converted frames that fit in budget_mb (16 without a budget)
+def cached_frames_for(budget_mb, image_size):
+    if not budget_mb:
+        return 16
+    return max(1, int(budget_mb * 1024**2 // (3 * image_size**2 * 4)))
+
+
+# Initialize an inference state from an in-memory frame loader. init_state
+# only reads video paths, so the state is built here the way it builds it,
+# with the loader in place of the decoded frames. It holds the entries of
+# every sam2 version: the per object outputs and the consolidated outputs
+# older versions track with (each version ignores the other's entries).
+def init_state_from_frames(
+        predictor,
+        frames,
+        offload_video_to_cpu=None,
+        offload_state_to_cpu=False,
+):
+    device = predictor.device
+    if offload_video_to_cpu is None:
+        offload_video_to_cpu = (
+            getattr(frames, "storage_device", device) != device
+        )
+    state = {
+        "images": frames,
+        "num_frames": len(frames),
+        "offload_video_to_cpu": offload_video_to_cpu,
+        "offload_state_to_cpu": offload_state_to_cpu,
+        "video_height": frames.video_height,
+        "video_width": frames.video_width,
+        "device": device,
+        "storage_device": (
+            torch.device("cpu") if offload_state_to_cpu else device
+        ),
+        "point_inputs_per_obj": {},
+        "mask_inputs_per_obj": {},
+        "cached_features": {},
+        "constants": {},
+        "obj_id_to_idx": OrderedDict(),
+        "obj_idx_to_id": OrderedDict(),
+        "obj_ids": [],
+        "output_dict_per_obj": {},
+        "temp_output_dict_per_obj": {},
+        "frames_tracked_per_obj": {},
+        "output_dict": {
+            "cond_frame_outputs": {},
+            "non_cond_frame_outputs": {},
+        },
+        "consolidated_frame_inds": {
+            "cond_frame_outputs": set(),
+            "non_cond_frame_outputs": set(),
+        },
+        "tracking_has_started": False,
+        "frames_already_tracked": {},
+    }
+    # Warm up the visual backbone on the first frame, as init_state does
+    with torch.inference_mode():
+        predictor._get_image_feature(state, frame_idx=0, batch_size=1)
+    return state
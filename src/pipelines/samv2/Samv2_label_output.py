@@ -0,0 +1,62 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from pipelines.samv2.Samv2_label_store import (
+    copy_labels,
+    is_in_memory,
+    open_label_store,
+)
+from pipelines.samv2.Samv2_sparse_labels import as_sparse
+
+logger = logging.getLogger(__name__)
+
+
+# How the output labels of an engine are held: dtype, zarr label store or
+# sparse labels. Shared by SamV2Engine and SeriesEngine; the class needs
+# output (a settable attribute or property), image_volume, work_dir and
+# name.
+class LabelOutputMixin:
+    # Store the output labels in a smaller dtype (e.g. uint16) when they fit
+    def convert_output_dtype(self, label_dtype):
+        label_dtype = np.dtype(label_dtype)
+        if self.output.dtype == label_dtype:
+            return self.output
+        if not is_in_memory(self.output):
+            logger.info("Keeping %s labels of the lazy output", self.output.dtype)
+            return self.output
+        max_label = int(self.output.max()) if self.output.size else 0
+        if max_label > np.iinfo(label_dtype).max:
+            logger.warning(
+                "Keeping %s labels, label %d does not fit in %s",
+                self.output.dtype,
+                max_label,
+                label_dtype,
+            )
+            return self.output
+        logger.info("Converting labels from %s to %s", self.output.dtype, label_dtype)
+        self.output = self.output.astype(label_dtype)
+        return self.output
+
+    # Move the output labels to a chunked zarr volume in the work dir, so
+    # labels are written to disk frame by frame instead of being held in
+    # memory. Labels already in the output are copied over when they match
+    # the image shape.
+    def use_label_store(self, label_dtype=None, store_name=None):
+        store_path = self.work_dir / Path(f"{store_name or self.name}.zarr")
+        dtype = np.dtype(label_dtype) if label_dtype else self.output.dtype
+        store = open_label_store(store_path, self.image_volume.shape, dtype)
+        if self.output is store:
+            return store
+        if tuple(self.output.shape) == tuple(store.shape):
+            copy_labels(self.output, store)
+        self.output = store
+        return store
+
+    # Keep the output labels as a SparseLabelVolume: per object bounding
+    # boxes and bit-packed masks instead of a dense volume. Memory follows
+    # the labeled voxels and only the planes that are read get rendered.
+    def use_sparse_labels(self, label_dtype=None):
+        self.output = as_sparse(self.output, label_dtype)
+        return self.output
@@ -0,0 +1,92 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import zarr
+except ImportError:  # optional dependency, only needed for label stores
+    zarr = None
+
+logger = logging.getLogger(__name__)
+
+# Largest chunk edge in the YX plane, a chunk holds one frame in z
+MAX_CHUNK_EDGE = 2048
+
+
+# True for arrays napari can edit in place as plain numpy (memmaps included)
+def is_in_memory(array):
+    return isinstance(array, np.ndarray)
+
+
+# Chunking that lets propagation write one frame at a time
+def frame_chunks(shape):
+    plane = tuple(min(size, MAX_CHUNK_EDGE) for size in shape[-2:])
+    return (1,) * (len(shape) - 2) + plane
+
+
+# Blosc (zstd, bit shuffle) compression arguments for a new zarr array,
+# for zarr 3 and zarr 2
+def blosc_compression(clevel=5):
+    if zarr is None:
+        return {}
+    codecs = getattr(zarr, "codecs", None)
+    if codecs is not None and hasattr(codecs, "BloscCodec"):
+        return {
+            "compressors": [
+                codecs.BloscCodec(cname="zstd", clevel=clevel, shuffle="bitshuffle")
+            ]
+        }
+    from numcodecs import Blosc
+
+    return {
+        "compressor": Blosc(cname="zstd", clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+    }
+
+
+# Open (or create) a chunked zarr label volume on disk. An existing store is
+# reused when its shape and dtype still match, otherwise it is recreated
+# (with the compression arguments, e.g. blosc_compression()).
+def open_label_store(path, shape, dtype, compression=None):
+    if zarr is None:
+        raise ImportError(
+            "Writing labels to a chunked store needs zarr, "
+            "install it with `pip install zarr`"
+        )
+    path = Path(path)
+    shape = tuple(shape)
+    dtype = np.dtype(dtype)
+    if path.exists():
+        try:
+            store = zarr.open_array(str(path), mode="r+")
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning("Recreating unreadable label store %s: %s", path, e)
+        else:
+            if store.shape == shape and np.dtype(store.dtype) == dtype:
+                logger.info("Reusing label store %s", path)
+                return store
+            logger.info(
+                "Recreating label store %s, it holds %s %s labels",
+                path,
+                store.shape,
+                store.dtype,
+            )
+    logger.info(
+        "Creating label store %s with chunks %s", path, frame_chunks(shape)
+    )
+    return zarr.open_array(
+        str(path),
+        mode="w",
+        shape=shape,
+        chunks=frame_chunks(shape),
+        dtype=dtype,
+        fill_value=0,
+        **(compression or {}),
+    )
+
+
+# Copy labels into a store a few frames at a time
+def copy_labels(source, store, chunk_frames=8):
+    for start in range(0, source.shape[0], chunk_frames):
+        stop = min(start + chunk_frames, source.shape[0])
+        store[start:stop] = np.asarray(source[start:stop])
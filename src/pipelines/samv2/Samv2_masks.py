@@ -0,0 +1,70 @@
+import torch
+
+
+# Turns the per-object mask logits of a frame into one label image.
+# Everything happens in a few batched tensor ops on the model device and
+# the label image crosses to the host once per frame, into a reused
+# (pinned on cuda) buffer.
+#
+# Overlaps are resolved deterministically: a pixel goes to the object with
+# the highest logit, ties go to the object listed first in out_obj_ids,
+# and pixels where no logit is above the threshold stay background (0).
+class MaskCompositor:
+    def __init__(self, height, width, device, threshold=0.0):
+        self.height = height
+        self.width = width
+        self.device = torch.device(device)
+        self.threshold = threshold
+
+        self._host = torch.empty(
+            (height, width),
+            dtype=torch.int32,
+            pin_memory=self.device.type == "cuda",
+        )
+        self._host_np = self._host.numpy()
+        self._obj_ids = None
+        self._obj_id_tensor = None
+
+    # Object ids as a device tensor, rebuilt only when the ids change
+    def _ids_on_device(self, out_obj_ids):
+        out_obj_ids = tuple(int(obj_id) for obj_id in out_obj_ids)
+        if out_obj_ids != self._obj_ids:
+            self._obj_ids = out_obj_ids
+            self._obj_id_tensor = torch.tensor(
+                out_obj_ids, dtype=torch.int32, device=self.device
+            )
+        return self._obj_id_tensor
+
+    # Label image of the frame, kept on the model device
+    def composite_tensor(self, out_obj_ids, out_mask_logits):
+        if len(out_obj_ids) == 0:
+            return torch.zeros(
+                (self.height, self.width), dtype=torch.int32, device=self.device
+            )
+        logits = out_mask_logits[:, 0]
+        best_logit, best_idx = logits.max(dim=0)
+        labels = self._ids_on_device(out_obj_ids)[best_idx]
+        return torch.where(
+            best_logit > self.threshold, labels, torch.zeros_like(labels)
+        )
+
+    # Label image of the frame as a numpy array. The array is a view of the
+    # reused host buffer, so it is only valid until the next call - copy it
+    # (or pass out=) to keep it.
+    def composite(self, out_obj_ids, out_mask_logits, out=None):
+        labels = self.composite_tensor(out_obj_ids, out_mask_logits)
+        self._host.copy_(labels)
+        if out is not None:
+            out[...] = self._host_np
+            return out
+        return self._host_np
+
+    # Per object (present, score) as numpy arrays with one host transfer.
+    # present tells whether the object has any foreground pixel and score
+    # is the mean logit over its foreground pixels.
+    def object_stats(self, out_mask_logits):
+        foreground = (out_mask_logits > self.threshold).flatten(1)
+        counts = foreground.sum(dim=1).float()
+        sums = (out_mask_logits.flatten(1).float() * foreground).sum(dim=1)
+        stats = torch.stack([counts, sums / counts.clamp(min=1)]).cpu().numpy()
+        return stats[0] > 0, stats[1]
@@ -0,0 +1,240 @@
+import logging
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+from pathlib import Path
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+# Bytes of the tensors in a (nested) state entry. Only the resident entries
+# of a SpillingFrameOutputs count, see its disk_bytes.
+def tensor_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, SpillingFrameOutputs):
+        return sum(tensor_bytes(v) for v in dict.values(value))
+    if isinstance(value, dict):
+        return sum(tensor_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(v) for v in value)
+    return 0
+
+
+# Frame outputs of one object (frame_idx -> output dict) that keep at most
+# max_resident frames in memory. Beyond that, the frame farthest from the
+# last one written or read is saved to spill_dir and dropped; reading it
+# again loads it back. Propagation walks the frames in order and only looks
+# at the memory of the last few frames, so the spilled frames are rarely
+# read. The files go away with the dict.
+class SpillingFrameOutputs(dict):
+    def __init__(self, spill_dir, max_resident, entries=()):
+        super().__init__()
+        self.spill_dir = Path(spill_dir)
+        self.max_resident = max(1, max_resident)
+        self._spilled = {}  # frame_idx -> (path, bytes)
+        self._last_key = None
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, str(self.spill_dir), True
+        )
+        for key, value in dict(entries).items():
+            self[key] = value
+
+    def _path(self, key):
+        return self.spill_dir / f"{key}.pt"
+
+    def _evict(self):
+        while dict.__len__(self) > self.max_resident:
+            key = max(
+                dict.keys(self),
+                key=lambda k: abs(k - self._last_key),
+            )
+            value = dict.pop(self, key)
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            torch.save(value, path)
+            self._spilled[key] = (path, path.stat().st_size)
+
+    # Load a spilled frame without making it resident
+    def _load(self, key):
+        path, _ = self._spilled[key]
+        return torch.load(path, weights_only=True)
+
+    def __setitem__(self, key, value):
+        self._drop_spilled(key)
+        super().__setitem__(key, value)
+        self._last_key = key
+        self._evict()
+
+    def __getitem__(self, key):
+        self._last_key = key
+        if key in self._spilled and not dict.__contains__(self, key):
+            value = self._load(key)
+            self[key] = value
+            return value
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._spilled
+
+    def _drop_spilled(self, key):
+        spilled = self._spilled.pop(key, None)
+        if spilled is not None:
+            spilled[0].unlink(missing_ok=True)
+
+    def pop(self, key, *default):
+        if key in self._spilled:
+            value = self._load(key)
+            self._drop_spilled(key)
+            return value
+        return super().pop(key, *default)
+
+    def __delitem__(self, key):
+        if key in self._spilled:
+            self._drop_spilled(key)
+        else:
+            super().__delitem__(key)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._spilled)
+
+    def __iter__(self):
+        yield from list(dict.keys(self))
+        yield from list(self._spilled)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        for key in self:
+            yield self._peek(key)
+
+    def items(self):
+        for key in self:
+            yield key, self._peek(key)
+
+    def _peek(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self._load(key)
+
+    def clear(self):
+        super().clear()
+        for key in list(self._spilled):
+            self._drop_spilled(key)
+
+    @property
+    def resident_frames(self):
+        return dict.__len__(self)
+
+    @property
+    def spilled_frames(self):
+        return len(self._spilled)
+
+    @property
+    def disk_bytes(self):
+        return sum(size for _, size in self._spilled.values())
+
+
+# Non conditioning frames a SAM2 model reads back for every tracked frame:
+# the memories of the last num_maskmem frames (memory_temporal_stride_for_eval
+# apart) and the object pointers of the last max_obj_ptrs_in_encoder frames.
+# A memory bank holding fewer frames reloads some of them from disk on every
+# frame.
+def frames_read_per_step(model):
+    num_maskmem = getattr(model, "num_maskmem", 7)
+    stride = getattr(model, "memory_temporal_stride_for_eval", 1)
+    max_obj_ptrs = getattr(model, "max_obj_ptrs_in_encoder", 16)
+    return max(num_maskmem * stride, max_obj_ptrs)
+
+
+# Bounds the per-object memory bank of SAM2 inference states: the non
+# conditioning frame outputs (memory features, masks, object pointers) of
+# every object are swapped for SpillingFrameOutputs holding at most
+# max_resident_frames frames each, the rest goes to a spill_dir of its own
+# under root (named after prefix), so banks of engines with the same name,
+# e.g. in two viewers or a batch job, never touch each other's files.
+# Prompted (conditioning) frames always stay in memory.
+class MemoryBank:
+    def __init__(self, root, max_resident_frames, prefix="bank"):
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        self.spill_dir = Path(tempfile.mkdtemp(prefix=f"{prefix}-", dir=root))
+        self.max_resident_frames = max_resident_frames
+        self._lock = threading.Lock()
+
+    # Keep at least the frames the model reads back per frame resident
+    def fit_model(self, model):
+        needed = frames_read_per_step(model)
+        if self.max_resident_frames < needed:
+            logger.warning(
+                "Keeping %d memory bank frames per object instead of %d, "
+                "the model reads back the last %d frames for every frame",
+                needed,
+                self.max_resident_frames,
+                needed,
+            )
+            self.max_resident_frames = needed
+
+    # The dicts of the non conditioning outputs of a state, for every sam2
+    # version (per object dicts, and the consolidated dict of older ones)
+    @staticmethod
+    def frame_output_dicts(state):
+        output_dicts = list(state.get("output_dict_per_obj", {}).values())
+        if "output_dict" in state:
+            output_dicts.append(state["output_dict"])
+        return output_dicts
+
+    # Swap the plain dicts of the state for spilling ones. Objects added
+    # after the last call get plain dicts from sam2, so this runs before
+    # every propagation.
+    def attach(self, state):
+        with self._lock:
+            for output_dict in self.frame_output_dicts(state):
+                outputs = output_dict["non_cond_frame_outputs"]
+                if isinstance(outputs, SpillingFrameOutputs):
+                    continue
+                output_dict["non_cond_frame_outputs"] = SpillingFrameOutputs(
+                    self.spill_dir / uuid.uuid4().hex,
+                    self.max_resident_frames,
+                    outputs,
+                )
+
+    def close(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+# What an inference state holds: the converted frames of its frame source,
+# the cached image features and the memory bank (resident and on disk)
+def state_memory_report(state, frame_source=None):
+    report = {}
+    if frame_source is not None and hasattr(frame_source, "resident"):
+        frames = frame_source.resident()
+        report["frames"] = frames["count"]
+        report["frames_mb"] = frames["bytes"] / 1024**2
+    report["features_mb"] = tensor_bytes(state.get("cached_features", {})) / 1024**2
+    resident_frames = spilled_frames = resident = disk = 0
+    for output_dict in MemoryBank.frame_output_dicts(state):
+        resident += tensor_bytes(output_dict.get("cond_frame_outputs", {}))
+        outputs = output_dict["non_cond_frame_outputs"]
+        resident += tensor_bytes(outputs)
+        if isinstance(outputs, SpillingFrameOutputs):
+            resident_frames += outputs.resident_frames
+            spilled_frames += outputs.spilled_frames
+            disk += outputs.disk_bytes
+        else:
+            resident_frames += len(outputs)
+    report["memory_bank_frames"] = resident_frames
+    report["memory_bank_mb"] = resident / 1024**2
+    report["spilled_frames"] = spilled_frames
+    report["spilled_mb"] = disk / 1024**2
+    return report
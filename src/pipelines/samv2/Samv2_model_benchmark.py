@@ -0,0 +1,197 @@
+import argparse
+import logging
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from pipelines.samv2.Samv2_model_store import MODEL_CONFIGS, ModelStore
+from pipelines.samv2.Samv2_timing import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Precision / optimization modes on the CPU and the engine options they use
+MODE_OPTIONS = {
+    "fp32": {},
+    "int8": {"quantize": True},
+    "compile": {"compile_model": True},
+}
+
+
+# A bright disc drifting through noise, one frame per slice
+def benchmark_volume(num_frames, size, seed=0):
+    rng = np.random.default_rng(seed)
+    volume = rng.integers(0, 60, (num_frames, size, size), dtype=np.uint8)
+    yy, xx = np.mgrid[:size, :size]
+    for z in range(num_frames):
+        cy, cx = size // 2, size // 3 + z * size // (3 * num_frames)
+        volume[z][(yy - cy) ** 2 + (xx - cx) ** 2 < (size // 8) ** 2] += 150
+    return volume
+
+
+# Time one model in one mode on the CPU. The first click and the first
+# warmup_frames propagated frames are not counted (they include the
+# torch.compile graph builds). Returns load seconds, the click to mask
+# latency on a new slice and the mean time per propagated frame.
+def benchmark_model(
+        model,
+        mode,
+        checkpoint,
+        work_dir,
+        num_frames=8,
+        size=512,
+        threads=None,
+        warmup_frames=2,
+):
+    from pipelines.samv2.Samv2_engine import SamV2Engine
+    from pipelines.samv2.Samv2_predictor_pool import get_predictor_pool
+
+    model_cfg, _ = MODEL_CONFIGS[model]
+    volume = benchmark_volume(num_frames, size)
+    start = time.perf_counter()
+    engine = SamV2Engine(
+        volume,
+        checkpoint,
+        model_cfg,
+        work_dir,
+        name=f"benchmark_{model}_{mode}",
+        device="cpu",
+        num_threads=threads,
+        **MODE_OPTIONS[mode],
+    )
+    load_s = time.perf_counter() - start
+    try:
+        center = size // 2
+        engine.add_point(0, center, size // 3, 1)
+        engine.add_point(num_frames - 1, center, 2 * size // 3, 1)
+        click_ms = engine.last_click_latency_ms
+
+        stamps = [time.perf_counter()]
+        for _ in engine.iter_video_propagate():
+            stamps.append(time.perf_counter())
+        frame_s = np.diff(stamps)[warmup_frames:]
+    finally:
+        engine.close()
+        get_predictor_pool().clear()
+    return {
+        "model": model,
+        "mode": mode,
+        "load_s": load_s,
+        "click_ms": click_ms,
+        "frame_ms": float(frame_s.mean() * 1000) if frame_s.size else None,
+        "frames": int(frame_s.size),
+    }
+
+
+def machine_description(threads):
+    cpu = platform.processor() or platform.machine()
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/cpuinfo") as f:
+                cpu = next(
+                    line.split(":", 1)[1].strip()
+                    for line in f
+                    if line.startswith("model name")
+                )
+        except (OSError, StopIteration):
+            pass
+    import torch
+
+    return (
+        f"{cpu}, {os.cpu_count()} logical cores, "
+        f"{threads or os.cpu_count()} torch threads, "
+        f"torch {torch.__version__}, Python {platform.python_version()}"
+    )
+
+
+# Markdown table: one row per model, ms per frame and per click by mode
+def format_table(results, modes):
+    header = ["Model"]
+    for mode in modes:
+        header += [f"CPU {mode} (ms/frame)", f"CPU {mode} (ms/click)"]
+    lines = [
+        "| " + " | ".join(header) + " |",
+        "| " + " | ".join("---" for _ in header) + " |",
+    ]
+    by_key = {(r["model"], r["mode"]): r for r in results}
+    for model in dict.fromkeys(r["model"] for r in results):
+        row = [model]
+        for mode in modes:
+            result = by_key.get((model, mode))
+            for key in ("frame_ms", "click_ms"):
+                value = result and result[key]
+                row.append(f"{value:,.0f}" if value else "-")
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="samv2-benchmark",
+        description=(
+            "Time the SAM V2 checkpoints on the CPU in full precision, with "
+            "int8 quantization and with torch.compile, on a synthetic volume."
+        ),
+    )
+    parser.add_argument("--models", nargs="+", default=list(MODEL_CONFIGS), choices=sorted(MODEL_CONFIGS))
+    parser.add_argument("--modes", nargs="+", default=list(MODE_OPTIONS), choices=list(MODE_OPTIONS))
+    parser.add_argument("--frames", type=int, default=8, help="slices of the synthetic volume")
+    parser.add_argument("--size", type=int, default=512, help="slice height and width")
+    parser.add_argument("--warmup-frames", type=int, default=2, help="propagated frames not counted")
+    parser.add_argument("--threads", type=int, help="CPU threads (default: every core)")
+    parser.add_argument("--work-dir", default=".samv2-benchmark", help="directory for caches")
+    parser.add_argument("--model-cache", help="shared checkpoint cache (default: $SAMV2_MODEL_CACHE or the user cache dir)")
+    parser.add_argument("--random-weights", action="store_true", help="build the networks without a checkpoint: same speed, meaningless masks")
+    parser.add_argument("--log-level", default="WARNING", choices=("DEBUG", "INFO", "WARNING", "ERROR"))
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_level)
+    work_dir = Path(args.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    store = None if args.random_weights else ModelStore(args.model_cache)
+
+    results = []
+    for model in args.models:
+        checkpoint = None
+        if store is not None:
+            try:
+                checkpoint = store.fetch(MODEL_CONFIGS[model][1])
+            except (OSError, ValueError) as e:
+                logger.error("Could not get the %s checkpoint: %s", model, e)
+                return 1
+        for mode in args.modes:
+            result = benchmark_model(
+                model,
+                mode,
+                checkpoint,
+                work_dir,
+                num_frames=args.frames,
+                size=args.size,
+                threads=args.threads,
+                warmup_frames=args.warmup_frames,
+            )
+            frame_ms = result["frame_ms"]
+            print(
+                f"{model} {mode}: load {result['load_s']:.1f} s, "
+                f"click {result['click_ms']:.0f} ms, "
+                + (f"{frame_ms:.0f} ms/frame " if frame_ms else "")
+                + f"({result['frames']} frames)",
+                flush=True,
+            )
+            results.append(result)
+
+    print()
+    print(machine_description(args.threads))
+    print()
+    print(format_table(results, args.modes))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
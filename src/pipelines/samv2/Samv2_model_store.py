@@ -0,0 +1,343 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://dl.fbaipublicfiles.com/segment_anything_2/092824/"
+
+# Environment overrides: cache directory, download base URL and offline mode
+CACHE_DIR_ENV = "SAMV2_MODEL_CACHE"
+BASE_URL_ENV = "SAMV2_MODEL_URL"
+OFFLINE_ENV = "SAMV2_OFFLINE"
+
+MANIFEST_NAME = "manifest.json"
+# Optional "<sha256>  <file name>" lines (sha256sum format) to verify against
+CHECKSUMS_NAME = "SHA256SUMS"
+
+# Pinned SHA-256 of checkpoints by file name. A download or cached file of
+# a checkpoint listed with a hash that does not match is refused;
+# checkpoints not listed (or listed as None) are trusted on first download
+# and checked against the hash recorded in the manifest from then on.
+CHECKPOINT_SHA256 = {}
+
+# Model name -> (config, checkpoint file) of the models offered by the
+# widget, samv2-batch and samv2-benchmark
+MODEL_CONFIGS = {
+    "sam2.1_hiera_large": ("configs/sam2.1/sam2.1_hiera_l.yaml", "sam2.1_hiera_large.pt"),
+    "sam2.1_hiera_small": ("configs/sam2.1/sam2.1_hiera_s.yaml", "sam2.1_hiera_small.pt"),
+    "sam2.1_hiera_tiny": ("configs/sam2.1/sam2.1_hiera_t.yaml", "sam2.1_hiera_tiny.pt"),
+    "sam2.1_hiera_base_plus": ("configs/sam2.1/sam2.1_hiera_b+.yaml", "sam2.1_hiera_base_plus.pt"),
+}
+
+CHUNK_BYTES = 1024**2
+# Files smaller than this are fetched in one part
+MIN_PART_BYTES = 16 * 1024**2
+
+
+# Shared model cache: $SAMV2_MODEL_CACHE, else the user cache directory
+def default_cache_dir():
+    if os.environ.get(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV]).expanduser()
+    if os.name == "nt" and os.environ.get("LOCALAPPDATA"):
+        base = Path(os.environ["LOCALAPPDATA"])
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return base / "napari-samv2" / "models"
+
+
+def env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes", "on")
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Byte ranges [start, end) splitting size into at most parts parts
+def split_ranges(size, parts):
+    parts = max(1, min(parts, size // MIN_PART_BYTES))
+    bounds = [size * i // parts for i in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Checkpoints shared by every project and process of the user. Downloads go
+# to per part ".part" files next to the target, resume from the bytes
+# already on disk (HTTP Range), run the parts in parallel when the server
+# supports ranges, and are only renamed to the checkpoint name once the
+# whole file is there and its SHA-256 checks out. Expected hashes come from
+# checksums, a SHA256SUMS file in the cache dir or the pinned table
+# (CHECKPOINT_SHA256 by default); the hash of every
+# checkpoint is recorded in the manifest and checked again whenever the
+# file changed on disk. offline=True only serves checkpoints already in
+# the cache (e.g. a pre-populated shared directory).
+class ModelStore:
+    def __init__(
+            self,
+            cache_dir=None,
+            base_url=None,
+            offline=None,
+            checksums=None,
+            pinned=None,
+            parts=4,
+            timeout=30,
+            retries=3,
+    ):
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.base_url = (
+            base_url or os.environ.get(BASE_URL_ENV) or DEFAULT_BASE_URL
+        )
+        self.offline = env_flag(OFFLINE_ENV) if offline is None else offline
+        self.checksums = dict(checksums or {})
+        self.pinned = dict(CHECKPOINT_SHA256 if pinned is None else pinned)
+        self.parts = parts
+        self.timeout = timeout
+        self.retries = retries
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return self.cache_dir / name
+
+    def url(self, name):
+        return self.base_url.rstrip("/") + "/" + name
+
+    def read_manifest(self):
+        try:
+            with open(self.cache_dir / MANIFEST_NAME) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_manifest(self, manifest):
+        tmp_path = self.cache_dir / f"{MANIFEST_NAME}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.cache_dir / MANIFEST_NAME)
+
+    # Expected SHA-256 of a checkpoint, None for checkpoints that are not
+    # pinned (they are checked against the hash recorded on download)
+    def expected_sha256(self, name):
+        if name in self.checksums:
+            return self.checksums[name].lower()
+        try:
+            with open(self.cache_dir / CHECKSUMS_NAME) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1].lstrip("*") == name:
+                        return fields[0].lower()
+        except OSError:
+            pass
+        pinned = self.pinned.get(name)
+        return pinned.lower() if pinned else None
+
+    # Verify a cached checkpoint. The SHA-256 is only recomputed when the
+    # size or modification time differ from the manifest record.
+    def verify(self, name):
+        path = self.path(name)
+        if not path.is_file():
+            return False
+        stat = path.stat()
+        manifest = self.read_manifest()
+        record = manifest.get(name)
+        expected = self.expected_sha256(name)
+        if (
+                record is None
+                or record.get("size") != stat.st_size
+                or record.get("mtime") != stat.st_mtime
+        ):
+            logger.info("Verifying %s", path)
+            record = {
+                "sha256": sha256_file(path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                **({"url": record["url"]} if record and "url" in record else {}),
+            }
+            if expected is None and name in manifest:
+                # Changed on disk since it was recorded
+                expected = manifest[name].get("sha256")
+        if expected is not None and record["sha256"] != expected:
+            logger.error(
+                "%s does not match its SHA-256 (%s, expected %s)",
+                path,
+                record["sha256"],
+                expected,
+            )
+            return False
+        if manifest.get(name) != record:
+            manifest[name] = record
+            self.write_manifest(manifest)
+        return True
+
+    # Path of the verified checkpoint, downloaded when it is not cached
+    def fetch(self, name):
+        with self._lock:
+            if self.verify(name):
+                return self.path(name)
+            if self.offline:
+                raise FileNotFoundError(
+                    f"{name} is not in the model cache {self.cache_dir} and "
+                    f"downloads are disabled (offline mode)"
+                )
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.download(name)
+            return self.path(name)
+
+    def download(self, name):
+        import requests
+
+        url = self.url(name)
+        with requests.Session() as session:
+            response = session.head(
+                url, allow_redirects=True, timeout=self.timeout
+            )
+            response.raise_for_status()
+            size = int(response.headers.get("Content-Length") or 0)
+            ranges_supported = (
+                response.headers.get("Accept-Ranges", "").lower() == "bytes"
+            )
+            if size and ranges_supported:
+                ranges = split_ranges(size, self.parts)
+            else:
+                # No ranges - one stream from the start, nothing to resume
+                ranges = [(0, None)]
+                self.part_path(name, 0).unlink(missing_ok=True)
+            logger.info(
+                "Downloading %s (%.0f MB) from %s in %d parts",
+                name,
+                size / 1024**2,
+                url,
+                len(ranges),
+            )
+
+            # The part files only fit a download split the same way
+            self.clear_stale_parts(name, len(ranges))
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [
+                    pool.submit(
+                        self.fetch_part, session, url, name, index, start, end
+                    )
+                    for index, (start, end) in enumerate(ranges)
+                ]
+                for future in futures:
+                    future.result()
+
+        self.assemble(name, len(ranges), size, url)
+
+    def part_path(self, name, index):
+        return self.cache_dir / f"{name}.part{index}"
+
+    def clear_stale_parts(self, name, num_parts):
+        for part in self.cache_dir.glob(f"{name}.part*"):
+            suffix = part.name[len(name) + len(".part"):]
+            if not suffix.isdigit() or int(suffix) >= num_parts:
+                part.unlink(missing_ok=True)
+        # A single part resumes from its own size, several parts need to
+        # agree with the current split
+        marker = self.cache_dir / f"{name}.parts"
+        if marker.exists() and marker.read_text().strip() != str(num_parts):
+            for index in range(num_parts):
+                self.part_path(name, index).unlink(missing_ok=True)
+        marker.write_text(str(num_parts))
+
+    # Fetch bytes [start, end) into the part file, resuming from what the
+    # part file already holds and retrying dropped connections
+    def fetch_part(self, session, url, name, index, start, end):
+        import requests
+
+        part_path = self.part_path(name, index)
+        for attempt in range(1, self.retries + 1):
+            have = part_path.stat().st_size if part_path.exists() else 0
+            if end is not None and start + have >= end:
+                return
+            headers = {}
+            if end is not None:
+                headers["Range"] = f"bytes={start + have}-{end - 1}"
+            try:
+                with session.get(
+                        url, headers=headers, stream=True, timeout=self.timeout
+                ) as response:
+                    response.raise_for_status()
+                    if end is not None and response.status_code != 206:
+                        raise ValueError(f"{url} ignored the range request")
+                    with open(part_path, "ab" if end is not None else "wb") as f:
+                        for chunk in response.iter_content(CHUNK_BYTES):
+                            f.write(chunk)
+                return
+            except requests.exceptions.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(
+                    "Part %d of %s failed (%s), resuming (attempt %d of %d)",
+                    index,
+                    name,
+                    e,
+                    attempt + 1,
+                    self.retries,
+                )
+
+    # Join the parts into a temporary file, check its size and SHA-256 and
+    # rename it to the checkpoint name (atomic on the same file system)
+    def assemble(self, name, num_parts, size, url):
+        tmp_path = self.cache_dir / f"{name}.{os.getpid()}.tmp"
+        digest = hashlib.sha256()
+        try:
+            with open(tmp_path, "wb") as out:
+                for index in range(num_parts):
+                    with open(self.part_path(name, index), "rb") as f:
+                        for chunk in iter(lambda f=f: f.read(CHUNK_BYTES), b""):
+                            digest.update(chunk)
+                            out.write(chunk)
+            received = tmp_path.stat().st_size
+            if size and received != size:
+                raise ValueError(
+                    f"Downloaded {received} of {size} bytes of {name}"
+                )
+            sha256 = digest.hexdigest()
+            expected = self.expected_sha256(name)
+            if expected is not None and sha256 != expected:
+                # Corrupt parts - start over next time
+                for index in range(num_parts):
+                    self.part_path(name, index).unlink(missing_ok=True)
+                raise ValueError(
+                    f"{name} from {url} has SHA-256 {sha256}, "
+                    f"expected {expected}"
+                )
+            os.replace(tmp_path, self.path(name))
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+        for index in range(num_parts):
+            self.part_path(name, index).unlink(missing_ok=True)
+        (self.cache_dir / f"{name}.parts").unlink(missing_ok=True)
+
+        stat = self.path(name).stat()
+        manifest = self.read_manifest()
+        manifest[name] = {
+            "sha256": sha256,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "url": url,
+        }
+        self.write_manifest(manifest)
+        logger.info("Downloaded %s (sha256 %s)", name, sha256)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# The shared store of this process, configured from the environment
+def get_model_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ModelStore()
+        return _store
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CONTRAST_MODES = ("percentile", "contrast_limits", "dtype")
+
+# Fixed ranges used by the "dtype" mode
+DTYPE_RANGES = {
+    np.dtype(np.uint8): (0, 255),
+    np.dtype(np.uint16): (0, 65535),
+    np.dtype(np.int16): (-32768, 32767),
+}
+
+
+# Intensity window used to map a whole volume to 8-bit. The statistics are
+# computed once per volume so every frame gets the same mapping.
+class ContrastPolicy:
+    def __init__(self, mode, low, high, source_dtype, percentiles=None):
+        if mode not in CONTRAST_MODES:
+            raise ValueError(
+                f"Invalid contrast mode {mode!r}. Expected one of "
+                f"{CONTRAST_MODES}."
+            )
+        self.mode = mode
+        self.low = float(low)
+        self.high = float(high)
+        self.source_dtype = np.dtype(source_dtype)
+        self.percentiles = (
+            None if percentiles is None else tuple(map(float, percentiles))
+        )
+
+    def __repr__(self):
+        return (
+            f"ContrastPolicy(mode={self.mode!r}, low={self.low}, "
+            f"high={self.high}, source_dtype={self.source_dtype.name!r})"
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, ContrastPolicy) and (
+            self.to_dict() == other.to_dict()
+        )
+
+    # uint8 data in its full range needs no conversion at all
+    @property
+    def is_identity(self):
+        return self.source_dtype == np.uint8 and (self.low, self.high) == (
+            0.0,
+            255.0,
+        )
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "low": self.low,
+            "high": self.high,
+            "source_dtype": self.source_dtype.name,
+            "percentiles": (
+                None if self.percentiles is None else list(self.percentiles)
+            ),
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(
+            values["mode"],
+            values["low"],
+            values["high"],
+            values["source_dtype"],
+            percentiles=values.get("percentiles"),
+        )
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    # Map an array (any shape) to uint8, writing into out when given
+    def apply(self, array, out=None):
+        array = np.asarray(array)
+        if out is None:
+            out = np.empty(array.shape, dtype=np.uint8)
+
+        if self.is_identity and array.dtype == np.uint8:
+            out[...] = array
+            return out
+        if self.high <= self.low:
+            out.fill(0)
+            return out
+
+        scaled = array.astype(np.float32)
+        scaled -= np.float32(self.low)
+        scaled *= np.float32(255.0 / (self.high - self.low))
+        np.clip(scaled, 0.0, 255.0, out=scaled)
+        out[...] = scaled  # truncates like astype(np.uint8)
+        return out
+
+
+# Pick a strided subsample of roughly max_samples voxels from about 64
+# frames (spread over both leading axes of a 4D volume)
+def subsample_volume(volume, max_samples=2_000_000):
+    if volume.ndim == 2:
+        volume = volume[None]
+    *leading, height, width = volume.shape
+    per_axis = 64 ** (1 / len(leading))
+    steps = [max(1, int(np.ceil(size / per_axis))) for size in leading]
+    n_sampled = int(
+        np.prod([len(range(0, size, step)) for size, step in zip(leading, steps)])
+    )
+    per_frame = max(1, max_samples // n_sampled)
+    xy_step = max(1, int(np.ceil(np.sqrt(height * width / per_frame))))
+    return np.asarray(
+        volume[tuple(slice(None, None, step) for step in steps + [xy_step] * 2)]
+    )
+
+
+# Compute the contrast policy for a volume
+def compute_contrast_policy(
+        volume,
+        mode="percentile",
+        contrast_limits=None,
+        percentiles=(0.5, 99.5),
+        max_samples=2_000_000,
+):
+    dtype = np.dtype(volume.dtype)
+
+    if mode == "contrast_limits":
+        if contrast_limits is None:
+            raise ValueError("contrast_limits mode needs the layer limits")
+        low, high = contrast_limits
+        return ContrastPolicy(mode, low, high, dtype)
+
+    # 8-bit data is passed through untouched unless limits are requested
+    if dtype == np.uint8:
+        return ContrastPolicy(mode, 0, 255, dtype)
+
+    if mode == "dtype":
+        if dtype in DTYPE_RANGES:
+            low, high = DTYPE_RANGES[dtype]
+        elif dtype.kind == "f":
+            # Same rule as the old per slice conversion, but volume wide
+            vmax = float(subsample_volume(volume, max_samples).max())
+            low, high = 0.0, 1.0
+            if vmax > 1.0:
+                high = 255.0 if vmax < 256.0 else vmax
+        else:
+            sample = subsample_volume(volume, max_samples)
+            low, high = float(sample.min()), float(sample.max())
+        return ContrastPolicy(mode, low, high, dtype)
+
+    if mode == "percentile":
+        sample = subsample_volume(volume, max_samples)
+        low, high = np.percentile(sample, percentiles)
+        return ContrastPolicy(
+            mode, low, high, dtype, percentiles=percentiles
+        )
+
+    raise ValueError(
+        f"Invalid contrast mode {mode!r}. Expected one of {CONTRAST_MODES}."
+    )
+
+
+# Shape of a volume and a hash of the strided subsample its statistics
+# come from. Recorded with a policy, so another volume of the same layer
+# name (or an edited one) gets its own policy.
+def volume_fingerprint(volume, max_samples=2_000_000):
+    sample = np.ascontiguousarray(subsample_volume(volume, max_samples))
+    digest = hashlib.blake2b(memoryview(sample).cast("B"), digest_size=16)
+    return {
+        "shape": [int(size) for size in volume.shape],
+        "sample_hash": digest.hexdigest(),
+    }
+
+
+# Load a recorded policy if it still fits the volume, else compute and record
+def resolve_contrast_policy(policy_path, volume, mode, **kwargs):
+    fingerprint = volume_fingerprint(
+        volume, kwargs.get("max_samples", 2_000_000)
+    )
+    if os.path.exists(policy_path):
+        try:
+            with open(policy_path) as f:
+                recorded = json.load(f)
+            policy = ContrastPolicy.from_dict(recorded)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable contrast policy %s: %s", policy_path, e)
+        else:
+            if (
+                policy.mode == mode
+                and policy.source_dtype == np.dtype(volume.dtype)
+                and mode != "contrast_limits"
+                and recorded.get("volume") == fingerprint
+            ):
+                return policy
+            if recorded.get("volume") != fingerprint:
+                logger.info(
+                    "Recomputing %s, it was recorded for another volume",
+                    policy_path,
+                )
+
+    policy = compute_contrast_policy(volume, mode, **kwargs)
+    with open(policy_path, "w") as f:
+        json.dump({**policy.to_dict(), "volume": fingerprint}, f, indent=2)
+    logger.info("Recorded %s in %s", policy, policy_path)
+    return policy
+
+
+# Convert a whole volume to uint8 in chunks of frames
+def convert_volume_to_8bit(volume, policy, chunk_frames=16, out=None):
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.uint8)
+    if volume.ndim == 2:
+        return policy.apply(volume, out=out)
+
+    for start in range(0, volume.shape[0], chunk_frames):
+        stop = min(start + chunk_frames, volume.shape[0])
+        policy.apply(volume[start:stop], out=out[start:stop])
+    return out
@@ -1,14 +1,17 @@
-import os
 from pathlib import Path
 
 import numpy as np
-import torch
-from PIL import Image
 from qtpy.QtWidgets import QWidget
-from sam2.build_sam import build_sam2_video_predictor
 
+from pipelines.samv2.Samv2_engine import SamV2Engine
+from pipelines.samv2.Samv2_label_store import is_in_memory
+from pipelines.samv2.Samv2_series import SeriesEngine
+from pipelines.samv2.Samv2_session import load_session, save_session
+from pipelines.samv2.Samv2_sparse_labels import export_coco_rle, export_zarr
 
-# Sam V2 pipeline class
+
+# Sam V2 pipeline class - connects the napari layers and the widget
+# controls to a SamV2Engine, which does all the work
 class SamV2_pipeline(QWidget):
     def __init__(
             self,
@@ -16,329 +19,309 @@ class SamV2_pipeline(QWidget):
             main_window_object,
             checkpoint_path,
             model_cfg_name,
+            use_jpeg_frames=False,
+            contrast_mode="percentile",
+            export_workers=None,
+            embedding_cache_gb=None,
+            label_dtype=None,
+            tile_size=None,
+            tile_overlap=128,
+            label_store=False,
+            sparse_labels=False,
+            device="auto",
+            num_threads=None,
+            quantize=False,
+            compile_model=False,
+            propagation_axis=1,
+            series_workers=2,
+            frame_cache_mb=None,
+            memory_bank_frames=None,
+            offload=False,
     ):
         super().__init__()
         self.viewer = napari_viewer
         self.mwo = main_window_object
-        self.source_frame_dir = (
-            None  # Will be set inside process volume function
-        )
-
-        # torch autocast - following samv2 recommended execution code
-        torch.autocast(device_type="cuda", dtype=torch.bfloat16).__enter__()
-        if torch.cuda.get_device_properties(0).major >= 8:
-            torch.backends.cuda.matmul.allow_tf32 = True
-            torch.backends.cudnn.allow_tf32 = True
-
-        DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        sam2_checkpoint = checkpoint_path
-        model_cfg = model_cfg_name
-
-        self.predictor = build_sam2_video_predictor(model_cfg, sam2_checkpoint)
 
-        self.preprocess_volume()
-
-        self.inference_state = self.predictor.init_state(
-            video_path=self.source_frame_dir.as_posix()
-        )
-
-        self.prompts = {}
+        image_layer_name = self.mwo.image_layers_combo.currentText()
+        image_layer = self.viewer.layers[image_layer_name]
+        output_layer = self.get_output_layer()
+
+        volume = self.get_image_volume()
+        engine_kwargs = {
+            "name": image_layer_name,
+            "output": output_layer.data,
+            "use_jpeg_frames": use_jpeg_frames,
+            "contrast_mode": contrast_mode,
+            "contrast_limits": image_layer.contrast_limits,
+            "export_workers": export_workers,
+            "embedding_cache_gb": embedding_cache_gb,
+            "tile_size": tile_size,
+            "tile_overlap": tile_overlap,
+            "device": device,
+            "num_threads": num_threads,
+            "quantize": quantize,
+            "compile_model": compile_model,
+            "frame_cache_mb": frame_cache_mb,
+            "memory_bank_frames": memory_bank_frames,
+            "offload_frames": offload,
+            "offload_state": offload,
+        }
+        work_dir = Path(self.mwo.interdir_lineedt.text())
+        if volume.ndim == 4:
+            # Every index of the other leading axis is its own sub-volume
+            self.engine = SeriesEngine(
+                volume,
+                checkpoint_path,
+                model_cfg_name,
+                work_dir,
+                propagation_axis=propagation_axis,
+                max_workers=series_workers,
+                **engine_kwargs,
+            )
+        else:
+            self.engine = SamV2Engine(
+                volume, checkpoint_path, model_cfg_name, work_dir, **engine_kwargs
+            )
+        # Coordinates of a point: [z, y, x], or [t, z, y, x] for 4D layers
+        self.point_ndim = 4 if volume.ndim == 4 else 3
 
-    def preprocess_volume(self):
+        if label_store:
+            output_layer.data = self.engine.use_label_store(
+                label_dtype, store_name=output_layer.name
+            )
+        elif sparse_labels:
+            output_layer.data = self.engine.use_sparse_labels(label_dtype)
+        elif label_dtype is not None:
+            labels = self.engine.convert_output_dtype(label_dtype)
+            if labels is not output_layer.data:
+                output_layer.data = labels
+
+    @property
+    def prompts(self):
+        return self.engine.prompts
+
+    @property
+    def object_extents(self):
+        return self.engine.object_extents
+
+    def get_output_layer(self):
+        layer_name = self.mwo.output_layers_combo.currentText()
+        return self.viewer.layers[layer_name]
+
+    # The engine writes into the output layer data, follow the layer if its
+    # data was replaced since the last call
+    def sync_output(self):
+        layer = self.get_output_layer()
+        self.engine.output = layer.data
+        return layer
+
+    # Image layer data at full resolution (level 0 of a multiscale layer).
+    # Lazy arrays stay lazy, frames are read from them on demand.
+    def get_image_volume(self):
         layer_name = self.mwo.image_layers_combo.currentText()
         layer = self.viewer.layers[layer_name]
-        volume = layer.data
-
-        # Create a source frame directory
-        self.source_frame_dir = Path(self.mwo.interdir_lineedt.text()) / Path(layer_name)
-        print("Creating the frame dir ", self.source_frame_dir)
-        self.source_frame_dir.mkdir(parents=True, exist_ok=True)
-
-        if volume.ndim == 2:
-            # It's a single 2D image
-            slice_path = os.path.join(self.source_frame_dir, "0000.jpeg")
-            if not os.path.exists(slice_path):
-                slice = volume
-
-                if slice.dtype != np.uint8:
-                    print(f"Converting 2D image to 8-bit from {slice.dtype}")
-                    slice = self._convert_to_8bit(slice)
-
-                slice_array = Image.fromarray(slice)
-                slice_array.save(slice_path)
-
-            print("Single Frame Generated")
-
-        elif volume.ndim == 3:
-            # It's a volume
-            for i in range(volume.shape[0]):
-                slice_path = os.path.join(self.source_frame_dir, f"{i:04d}.jpeg")
-                if os.path.exists(slice_path):
-                    continue
-
-                slice = volume[i, :, :]
-
-                if slice.dtype != np.uint8:
-                    print(f"Converting slice {i} to 8-bit from {slice.dtype}")
-                    slice = self._convert_to_8bit(slice)
-
-                slice_array = Image.fromarray(slice)
-                slice_array.save(slice_path)
-
-            print("Frames Generated")
-        else:
-            print(f"Unsupported number of dimensions: {volume.ndim}")
-
-    # Helper function to convert slices to 8-bit
-    def _convert_to_8bit(self, slice):
-        if slice.dtype == np.uint16:
-            type_min, type_max = 0, 65535
-        elif slice.dtype == np.int16:
-            type_min, type_max = -32768, 32767
-        elif slice.dtype in (np.float32, np.float64):
-            type_min, type_max = 0.0, 1.0
-            if slice.max() > 1.0:
-                type_max = 255.0 if slice.max() < 256.0 else slice.max()
-        else:
-            type_min, type_max = slice.min(), slice.max()
-
-        if type_min == type_max:
-            slice_normalized = np.zeros(slice.shape, dtype=np.uint8)
-        else:
-            slice_normalized = np.clip(
-                ((slice.astype(float) - type_min) / (type_max - type_min) * 255.0),
-                0, 255
-            ).astype(np.uint8)
-
-        return slice_normalized
+        if getattr(layer, "multiscale", False):
+            return layer.data[0]
+        return layer.data
+
+    @property
+    def timings(self):
+        return self.engine.timings
+
+    # See SamV2Engine.performance_summary
+    def performance_summary(self):
+        return self.engine.performance_summary()
+
+    # Write one label plane, touching only the pixels that changed.
+    # plane_key indexes the plane in the layer: (z,) or (t, z) for 4D.
+    def write_label_plane(self, layer, plane_key, mask_for_this_frame):
+        plane_key = tuple(int(k) for k in np.atleast_1d(plane_key))
+        with self.timings.span("napari.write_plane", plane=plane_key):
+            changed = np.nonzero(layer.data[plane_key] != mask_for_this_frame)
+            if len(changed[0]) == 0:
+                return
+            if is_in_memory(layer.data) and hasattr(layer, "data_setitem"):
+                # napari partial update - refreshes only the painted region
+                indices = tuple(
+                    np.full(len(changed[0]), k) for k in plane_key
+                ) + changed
+                layer.data_setitem(indices, mask_for_this_frame[changed])
+            else:
+                layer.data[plane_key] = mask_for_this_frame
+                layer.refresh()
 
     def add_point(self, point_array, label_id, neg_or_pos=1):
-        ann_frame_idx = point_array[0]
-        ann_obj_id = label_id
-        new_point = [point_array[2], point_array[1]]
-        new_label = neg_or_pos
-        check_if_our_z_is_new = True
-        check_if_our_annotation_is_new = True
-        # print(ann_obj_id)
-
-        # Check if in dict else add it
-        if ann_obj_id in self.prompts:
-            all_list = []
-            for existing_list in self.prompts[ann_obj_id]:
-                if existing_list[0] == ann_frame_idx:
-                    points = existing_list[1]
-                    labels = list(existing_list[2])
-                    points = np.append(points, [new_point], axis=0)
-                    labels.append(new_label)
-                    new_list = [
-                        ann_frame_idx,
-                        points,
-                        np.array(labels, np.int32),
-                    ]
-                    all_list.append(new_list)
-                    check_if_our_z_is_new = False
-                else:
-                    all_list.append(existing_list)
-
-            self.prompts[ann_obj_id] = all_list
-            check_if_our_annotation_is_new = False
-
-        else:
-            points = np.array(
-                [[point_array[2], point_array[1]]], dtype=np.float32
-            )
-            labels = np.array([neg_or_pos], np.int32)
-            self.prompts[ann_obj_id] = [[ann_frame_idx, points, labels]]
-
-        if check_if_our_z_is_new and not (check_if_our_annotation_is_new):
-            points = np.array(
-                [[point_array[2], point_array[1]]], dtype=np.float32
+        layer = self.sync_output()
+        if self.point_ndim == 4:
+            plane_key, mask_for_this_frame = self.engine.add_point(
+                point_array, label_id, neg_or_pos, write=False
             )
-            labels = np.array([neg_or_pos], np.int32)
-            existing_val = self.prompts[ann_obj_id]
-            existing_val.append(
-                [ann_frame_idx, points, labels]
+        else:
+            z, y, x = point_array[0], point_array[1], point_array[2]
+            mask_for_this_frame = self.engine.add_point(
+                z, y, x, label_id, neg_or_pos, write=False
             )
-            self.prompts[ann_obj_id] = existing_val
-
-            # print(labels,points,ann_frame_idx)
+            plane_key = (z,)
+        self.write_label_plane(layer, plane_key, mask_for_this_frame)
 
-        layer_name = self.mwo.output_layers_combo.currentText()
-        layer = self.viewer.layers[layer_name]
-        label_layer_data = layer.data
-
-        _, out_obj_ids, out_mask_logits = self.predictor.add_new_points_or_box(
-            inference_state=self.inference_state,
-            frame_idx=ann_frame_idx,
-            obj_id=ann_obj_id,
-            points=points,
-            labels=labels,
+    # Generator over the propagated frames, see
+    # SamV2Engine.iter_video_propagate - it can run in a worker thread
+    def iter_video_propagate(
+            self,
+            output=None,
+            window=None,
+            stop_after_empty=None,
+            merge_rule="forward",
+    ):
+        self.sync_output()
+        yield from self.engine.iter_video_propagate(
+            output=output,
+            window=window,
+            stop_after_empty=stop_after_empty,
+            merge_rule=merge_rule,
         )
-        mask_for_this_frame = np.zeros(
-            (label_layer_data.shape[1], label_layer_data.shape[2]),
-            dtype=np.int32,
+
+    # Generator re-propagating the last corrected object, see
+    # SamV2Engine.iter_incremental_propagate
+    def iter_incremental_propagate(self, window=None):
+        self.sync_output()
+        yield from self.engine.iter_incremental_propagate(window=window)
+
+    # Generator over a coarse preview, see SamV2Engine.iter_preview_propagate
+    def iter_preview_propagate(self, stride=4, xy_step=2, merge_rule="forward"):
+        self.sync_output()
+        yield from self.engine.iter_preview_propagate(
+            stride=stride, xy_step=xy_step, merge_rule=merge_rule
         )
-        for i, out_obj_id in enumerate(out_obj_ids):
-            out_mask = (out_mask_logits[i] > 0.0).cpu().numpy()
-            # print(out_mask.shape)
-            mask_for_this_frame[out_mask[0] == True] = out_obj_id
 
-        label_layer_data[ann_frame_idx, :, :] = mask_for_this_frame
-        layer.data = label_layer_data
+    # Generator refining accepted objects at full resolution, see
+    # SamV2Engine.iter_refine_objects
+    def iter_refine_objects(self, obj_ids=None, window=None):
+        self.sync_output()
+        yield from self.engine.iter_refine_objects(obj_ids, window=window)
 
-    def video_propagate(self):
-        # run propagation throughout the video and collect the results in a dict
-        layer_name = self.mwo.output_layers_combo.currentText()
-        layer = self.viewer.layers[layer_name]
-        label_layer_data = layer.data
-        label_layer_data_2 = label_layer_data.copy()
-        firsttime = True
-
-        print("Executing forward")
-        for (
-                out_frame_idx,
-                out_obj_ids,
-                out_mask_logits,
-        ) in self.predictor.propagate_in_video(
-            self.inference_state, start_frame_idx=0
-        ):
-            mask_for_this_frame = np.zeros(
-                (label_layer_data.shape[1], label_layer_data.shape[2]),
-                dtype=np.int32,
-            )
-            for i, out_obj_id in enumerate(out_obj_ids):
-                out_mask = (out_mask_logits[i] > 0.0).cpu().numpy()
-                # print(out_mask.shape)
-                mask_for_this_frame[out_mask[0] == True] = out_obj_id
-
-            label_layer_data[out_frame_idx, :, :] = mask_for_this_frame
-            progress = int((out_frame_idx * 50) / label_layer_data.shape[0])
-            self.mwo.video_propagation_progressBar.setValue(progress)
-
-        print("Executing reverse")
-        for (
-                out_frame_idx,
-                out_obj_ids,
-                out_mask_logits,
-        ) in self.predictor.propagate_in_video(
-            self.inference_state,
-            start_frame_idx=label_layer_data.shape[0] - 1,
-            reverse=True,
-        ):
-            mask_for_this_frame = np.zeros(
-                (label_layer_data.shape[1], label_layer_data.shape[2]),
-                dtype=np.int32,
-            )
-            for i, out_obj_id in enumerate(out_obj_ids):
-                out_mask = (out_mask_logits[i] > 0.0).cpu().numpy()
-                print(out_mask.shape)
-                mask_for_this_frame[out_mask[0] == True] = out_obj_id
+    @property
+    def preview_objects(self):
+        return self.engine.preview_objects
 
-            label_layer_data_2[out_frame_idx, :, :] = mask_for_this_frame
+    def close(self):
+        self.engine.close()
 
-            if firsttime:
-                final_progress_here = int(
-                    (out_frame_idx * 50) / label_layer_data.shape[0]
+    # Repaint the output layer if the frame is the one on screen. frame_idx
+    # is a frame index or the (t, z) key of a plane of a 4D layer.
+    def refresh_frame(self, frame_idx):
+        layer_name = self.mwo.output_layers_combo.currentText()
+        plane_key = tuple(int(k) for k in np.atleast_1d(frame_idx))
+        current_step = self.viewer.dims.current_step[-self.point_ndim:]
+        if tuple(current_step[: len(plane_key)]) == plane_key:
+            with self.timings.span("napari.refresh", plane=plane_key):
+                self.viewer.layers[layer_name].refresh()
+
+    # See Samv2_session.save_session
+    def save_session(self, path):
+        self.sync_output()
+        return save_session(self.engine, path)
+
+    # Restore a session into the output layer, see Samv2_session.load_session
+    def load_session(self, path):
+        layer = self.sync_output()
+        metadata = load_session(self.engine, path)
+        layer.refresh()
+        return metadata
+
+    # Export the output labels: a blosc compressed zarr volume (.zarr) or
+    # COCO style RLE JSON (.json), see Samv2_sparse_labels
+    def export_labels(self, path):
+        path = Path(path)
+        labels = self.sync_output().data
+        with self.timings.span("labels.export", format=path.suffix):
+            if path.suffix == ".zarr":
+                export_zarr(labels, path)
+            elif path.suffix == ".json":
+                export_coco_rle(labels, path)
+            else:
+                raise ValueError(
+                    f"Unknown label export format {path.suffix}, "
+                    "expected .zarr or .json"
                 )
-                firsttime = False
-
-            progress = int((out_frame_idx * 50) / label_layer_data.shape[0])
-            progress = abs(final_progress_here - progress) + 50
-            self.mwo.video_propagation_progressBar.setValue(progress)
+        return path
 
-        layer.data = np.maximum(label_layer_data, label_layer_data_2)
-        # self.mwo.video_propagation_progressBar.setValue(progress)
-        self.mwo.video_propagation_progressBar.setValue(100)
+    # (point, obj_id, label) of every click held by the engine, point in
+    # layer coordinates ([z, y, x] or [t, z, y, x])
+    def prompt_points(self):
+        if self.point_ndim == 4:
+            engines = sorted(self.engine.engines.items())
+        else:
+            engines = [(None, self.engine)]
+        for index, engine in engines:
+            for obj_id, frame_idx, points, labels in engine.prompts.items():
+                if index is None:
+                    plane_key = (frame_idx,)
+                else:
+                    plane_key = self.engine.plane_key(index, frame_idx)
+                for (x, y), label in zip(points.tolist(), labels.tolist()):
+                    yield [*plane_key, y, x], obj_id, label
 
     def reset(self):
-        self.predictor.reset_state(self.inference_state)
-        layer_name = self.mwo.output_layers_combo.currentText()
-        layer = self.viewer.layers[layer_name]
-        label_layer_data = layer.data
-        zero_mask = np.zeros(label_layer_data.shape, dtype=np.int32)
-        layer.data = zero_mask
+        layer = self.sync_output()
+        self.engine.reset()
+        layer.refresh()
+
+    # (z, y, x, label, obj_id) rows of a points layer, (t, z, y, x, ...) for
+    # 4D layers. label and obj_id come from the "label" / "obj_id" features
+    # of every point when the layer has them, else the given defaults apply
+    # to all points.
+    def read_points_layer(self, layer, label, obj_id):
+        data = np.asarray(layer.data)
+        if data.size == 0:
+            return []
+        coords = np.rint(data[:, -self.point_ndim:]).astype(int)
+        features = layer.features
+        labels = (
+            features["label"].fillna(label).to_numpy(int)
+            if "label" in features
+            else np.full(len(coords), label)
+        )
+        obj_ids = (
+            features["obj_id"].fillna(obj_id).to_numpy(int)
+            if "obj_id" in features
+            else np.full(len(coords), obj_id)
+        )
+        return [
+            (*point, point_label, point_obj_id)
+            for point, point_label, point_obj_id in zip(
+                coords.tolist(), labels.tolist(), obj_ids.tolist()
+            )
+        ]
 
-    def reset_and_video_propagate(self):
+    # Replay the clicks of the points layers as one batch, then a generator
+    # over the propagated frames like iter_video_propagate. Run it in a
+    # worker thread (see PropagationWorker in the widget), the replay and
+    # the propagation both call the model.
+    def iter_reset_and_video_propagate(
+            self,
+            window=None,
+            stop_after_empty=None,
+            merge_rule="forward",
+    ):
         #Clear existing prompts
-        self.prompts = {}
-
-        #Read points from Positive Points layer
-        if "Positive Points" in self.viewer.layers:
-            pos_layer = self.viewer.layers["Positive Points"]
-            for point in pos_layer.data:
-                z, y, x = map(int, point)
-                layer_name = self.mwo.output_layers_combo.currentText()
-                label_layer = self.viewer.layers[layer_name]
-                active_label = label_layer.selected_label
-                self.add_point([z, y, x], active_label, neg_or_pos=1)
-
-        #Read points from Negative Points layer
-        if "Negative Points" in self.viewer.layers:
-            neg_layer = self.viewer.layers["Negative Points"]
-            for point in neg_layer.data:
-                z, y, x = map(int, point)
-                layer_name = self.mwo.output_layers_combo.currentText()
-                label_layer = self.viewer.layers[layer_name]
-                active_label = label_layer.selected_label
-                self.add_point([z, y, x], active_label, neg_or_pos=0)
-
-        # Step 4: Now propagate after adding points
-        layer_name = self.mwo.output_layers_combo.currentText()
-        layer = self.viewer.layers[layer_name]
-        label_layer_data = layer.data
-        label_layer_data_2 = label_layer_data.copy()
-        firsttime = True
-
-        print("Executing forward")
-        for (
-                out_frame_idx,
-                out_obj_ids,
-                out_mask_logits,
-        ) in self.predictor.propagate_in_video(
-            self.inference_state, start_frame_idx=0
-        ):
-            mask_for_this_frame = np.zeros(
-                (label_layer_data.shape[1], label_layer_data.shape[2]),
-                dtype=np.int32,
-            )
-            for i, out_obj_id in enumerate(out_obj_ids):
-                out_mask = (out_mask_logits[i] > 0.0).cpu().numpy()
-                mask_for_this_frame[out_mask[0] == True] = out_obj_id
-
-            label_layer_data[out_frame_idx, :, :] = mask_for_this_frame
-            progress = int((out_frame_idx * 50) / label_layer_data.shape[0])
-            self.mwo.video_propagation_progressBar.setValue(progress)
-
-        print("Executing reverse")
-        for (
-                out_frame_idx,
-                out_obj_ids,
-                out_mask_logits,
-        ) in self.predictor.propagate_in_video(
-            self.inference_state,
-            start_frame_idx=label_layer_data.shape[0] - 1,
-            reverse=True,
+        self.engine.clear_prompts()
+
+        # Points without an obj_id feature belong to the active label
+        active_label = self.get_output_layer().selected_label
+        prompts = []
+        for layer_name, label in (
+                ("Positive Points", 1),
+                ("Negative Points", 0),
         ):
-            mask_for_this_frame = np.zeros(
-                (label_layer_data.shape[1], label_layer_data.shape[2]),
-                dtype=np.int32,
-            )
-            for i, out_obj_id in enumerate(out_obj_ids):
-                out_mask = (out_mask_logits[i] > 0.0).cpu().numpy()
-                mask_for_this_frame[out_mask[0] == True] = out_obj_id
-
-            label_layer_data_2[out_frame_idx, :, :] = mask_for_this_frame
-
-            if firsttime:
-                final_progress_here = int(
-                    (out_frame_idx * 50) / label_layer_data.shape[0]
+            if layer_name in self.viewer.layers:
+                prompts += self.read_points_layer(
+                    self.viewer.layers[layer_name], label, active_label
                 )
-                firsttime = False
+        self.engine.add_prompts(prompts)
 
-            progress = int((out_frame_idx * 50) / label_layer_data.shape[0])
-            progress = abs(final_progress_here - progress) + 50
-            self.mwo.video_propagation_progressBar.setValue(progress)
-
-        # Final step: Combine forward and reverse
-        layer.data = np.maximum(label_layer_data, label_layer_data_2)
-        self.mwo.video_propagation_progressBar.setValue(100)
\ No newline at end of file
+        yield from self.iter_video_propagate(
+            window=window,
+            stop_after_empty=stop_after_empty,
+            merge_rule=merge_rule,
+        )
@@ -0,0 +1,165 @@
+import contextlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from pipelines.samv2.Samv2_device import compile_predictor, quantize_predictor
+
+logger = logging.getLogger(__name__)
+
+# Memory the idle (unused) predictors may keep loaded before eviction
+DEFAULT_IDLE_BUDGET_BYTES = 4 * 1024**3
+
+
+# Bytes held by the weights and buffers of a model
+def model_bytes(model):
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in list(model.parameters()) + list(model.buffers())
+    )
+
+
+# Autocast dtype following the samv2 recommended execution code: bfloat16
+# on cuda, full precision elsewhere
+def default_autocast_dtype(device):
+    return torch.bfloat16 if torch.device(device).type == "cuda" else None
+
+
+# Scoped autocast for a device and dtype. autocast is thread local, so every
+# thread running the model has to enter it itself.
+def autocast_context(device, dtype):
+    device = torch.device(device)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+class _PoolEntry:
+    def __init__(self, predictor, size):
+        self.predictor = predictor
+        self.size = size
+        self.users = 0
+
+
+# Process wide registry of loaded video predictors keyed by (model config,
+# checkpoint, device, dtype, optimizations). Widgets and layers acquire a
+# shared predictor and keep their own inference state; a predictor nobody
+# uses stays loaded (warm) until the idle ones grow past the budget, least
+# recently used first.
+class PredictorPool:
+    def __init__(self, idle_budget_bytes=DEFAULT_IDLE_BUDGET_BYTES):
+        self.idle_budget_bytes = idle_budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(
+            model_cfg,
+            checkpoint_path,
+            device,
+            dtype=None,
+            quantize=False,
+            compile_model=False,
+    ):
+        return (
+            str(model_cfg),
+            # No checkpoint: randomly initialized weights (benchmarks)
+            os.path.abspath(str(checkpoint_path)) if checkpoint_path else None,
+            str(torch.device(device)),
+            str(dtype).replace("torch.", "") if dtype is not None else None,
+            bool(quantize),
+            bool(compile_model),
+        )
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Loaded predictor for the key, built (checkpoint read from disk) only
+    # on the first request. Every acquire needs a matching release.
+    def acquire(
+            self,
+            model_cfg,
+            checkpoint_path,
+            device,
+            dtype=None,
+            quantize=False,
+            compile_model=False,
+    ):
+        key = self.make_key(
+            model_cfg, checkpoint_path, device, dtype, quantize, compile_model
+        )
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # sam2 is only needed once a model is actually loaded
+                from sam2.build_sam import build_sam2_video_predictor
+
+                logger.info(
+                    "Loading %s on %s from %s", model_cfg, key[2], checkpoint_path
+                )
+                predictor = build_sam2_video_predictor(
+                    model_cfg, checkpoint_path, device=key[2]
+                )
+                if quantize:
+                    quantize_predictor(predictor)
+                if compile_model:
+                    compile_predictor(predictor)
+                entry = _PoolEntry(predictor, model_bytes(predictor))
+                self._entries[key] = entry
+            else:
+                logger.info("Reusing loaded %s on %s", model_cfg, key[2])
+            self._entries.move_to_end(key)
+            entry.users += 1
+            self.evict_idle()
+            return entry.predictor
+
+    def release(self, predictor):
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.predictor is predictor:
+                    entry.users = max(0, entry.users - 1)
+                    break
+            self.evict_idle()
+
+    def idle_bytes(self):
+        return sum(
+            entry.size for entry in self._entries.values() if not entry.users
+        )
+
+    # Drop least recently used idle predictors until they fit the budget
+    def evict_idle(self, idle_budget_bytes=None):
+        if idle_budget_bytes is None:
+            idle_budget_bytes = self.idle_budget_bytes
+        evicted = False
+        with self._lock:
+            for key in list(self._entries):
+                if self.idle_bytes() <= idle_budget_bytes:
+                    break
+                if not self._entries[key].users:
+                    logger.info("Unloading idle %s from %s", key[0], key[2])
+                    del self._entries[key]
+                    evicted = True
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        self.evict_idle(idle_budget_bytes=0)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# The shared pool of this process
+def get_predictor_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PredictorPool()
+        return _pool
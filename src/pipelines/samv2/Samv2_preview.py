@@ -0,0 +1,43 @@
+import numpy as np
+
+
+# Frames of a preview: every stride-th frame plus every prompted frame
+def preview_frames(num_frames, prompt_frames, stride):
+    if stride < 1:
+        raise ValueError(f"Invalid preview stride {stride}, expected >= 1")
+    return sorted(set(range(0, num_frames, stride)) | set(prompt_frames))
+
+
+# [start, stop) of the frames every preview frame stands in for: each frame
+# of the volume takes the nearest preview frame
+def preview_spans(frames, num_frames):
+    bounds = [0]
+    bounds += [(a + b + 1) // 2 for a, b in zip(frames[:-1], frames[1:])]
+    bounds.append(num_frames)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Nearest neighbour upsampling of a label plane read with an XY step of
+# xy_step back to shape
+def upsample_plane(plane, shape, xy_step):
+    rows = np.minimum(np.arange(shape[0]) // xy_step, plane.shape[0] - 1)
+    cols = np.minimum(np.arange(shape[1]) // xy_step, plane.shape[1] - 1)
+    return plane[rows[:, None], cols[None, :]]
+
+
+# Some frames of a volume, seen as a volume. Only the frames that are read
+# are loaded, so lazy volumes stay lazy.
+class FrameSubset:
+    def __init__(self, volume, frames):
+        self.volume = volume
+        self.frames = list(frames)
+        self.shape = (len(self.frames),) + tuple(volume.shape[1:])
+        self.dtype = volume.dtype
+        self.ndim = volume.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        return self.volume[(self.frames[key[0]],) + key[1:]]
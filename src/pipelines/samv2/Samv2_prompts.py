@@ -0,0 +1,95 @@
+import numpy as np
+
+
+# Click prompts grouped by object and frame. Points and labels are kept in
+# python lists so adding a click is O(1); numpy arrays are only built when
+# a (object, frame) group is read back.
+class PromptStore:
+    def __init__(self):
+        self._prompts = {}  # obj_id -> {frame_idx: ([x, y] list, labels)}
+        self._last_click = {}  # obj_id -> sequence number of its last click
+        self._sequence = 0
+
+    def __contains__(self, obj_id):
+        return obj_id in self._prompts
+
+    def __len__(self):
+        return sum(
+            len(labels)
+            for frames in self._prompts.values()
+            for _, labels in frames.values()
+        )
+
+    def __bool__(self):
+        return bool(self._prompts)
+
+    def add(self, obj_id, frame_idx, point_xy, label):
+        frames = self._prompts.setdefault(obj_id, {})
+        points, labels = frames.setdefault(frame_idx, ([], []))
+        points.append((float(point_xy[0]), float(point_xy[1])))
+        labels.append(int(label))
+        self._sequence += 1
+        self._last_click[obj_id] = self._sequence
+
+    # Points (N, 2) float32 as x, y and labels (N,) int32 of one group
+    def get(self, obj_id, frame_idx):
+        points, labels = self._prompts[obj_id][frame_idx]
+        return (
+            np.array(points, dtype=np.float32).reshape(-1, 2),
+            np.array(labels, dtype=np.int32),
+        )
+
+    def objects(self):
+        return sorted(self._prompts)
+
+    # Sorted frame indices with prompts, for one object or for all of them
+    def frames(self, obj_id=None):
+        if obj_id is not None:
+            return sorted(self._prompts.get(obj_id, {}))
+        return sorted(
+            {frame for frames in self._prompts.values() for frame in frames}
+        )
+
+    # Order in which objects were last clicked (higher is newer)
+    def last_click(self, obj_id):
+        return self._last_click.get(obj_id, 0)
+
+    # Iterate (obj_id, frame_idx, points, labels) over every group
+    def items(self):
+        for obj_id in self.objects():
+            for frame_idx in self.frames(obj_id):
+                points, labels = self.get(obj_id, frame_idx)
+                yield obj_id, frame_idx, points, labels
+
+    def remove_object(self, obj_id):
+        self._prompts.pop(obj_id, None)
+        self._last_click.pop(obj_id, None)
+
+    def clear(self):
+        self._prompts.clear()
+        self._last_click.clear()
+        self._sequence = 0
+
+    # JSON friendly copy of the store, see from_dict
+    def to_dict(self):
+        return {
+            "groups": [
+                [obj_id, frame_idx, [list(p) for p in points], list(labels)]
+                for obj_id, frames in self._prompts.items()
+                for frame_idx, (points, labels) in frames.items()
+            ],
+            "last_click": [[k, v] for k, v in self._last_click.items()],
+            "sequence": self._sequence,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        store = cls()
+        for obj_id, frame_idx, points, labels in data["groups"]:
+            store._prompts.setdefault(int(obj_id), {})[int(frame_idx)] = (
+                [(float(x), float(y)) for x, y in points],
+                [int(label) for label in labels],
+            )
+        store._last_click = {int(k): int(v) for k, v in data["last_click"]}
+        store._sequence = int(data["sequence"])
+        return store
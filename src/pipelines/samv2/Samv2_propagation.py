@@ -0,0 +1,196 @@
+import numpy as np
+
+
+# Frame range to propagate over. Without a window the passes still start at
+# the first / last prompted frame but run to the ends of the volume.
+def propagation_range(prompt_frames, num_frames, window=None):
+    first, last = min(prompt_frames), max(prompt_frames)
+    if window is None or window < 0:
+        return first, last, 0, num_frames - 1
+    return (
+        first,
+        last,
+        max(0, first - window),
+        min(num_frames - 1, last + window),
+    )
+
+
+# The forward pass starts at the first prompted frame and the reverse pass
+# at the last one, each one bounded by the window.
+# Returns a list of (start_frame_idx, max_frame_num_to_track, reverse).
+def propagation_passes(prompt_frames, num_frames, window=None):
+    first, last, lo, hi = propagation_range(prompt_frames, num_frames, window)
+    return [
+        (first, hi - first, False),
+        (last, last - lo, True),
+    ]
+
+
+# Remove the labels of obj_ids from the given frames of output, in place.
+# A propagation only rewrites the frames it reaches, so the frames outside
+# its window or past where it stopped would keep the masks of an earlier
+# run.
+def clear_objects(output, obj_ids, frames):
+    obj_ids = np.asarray(sorted(obj_ids))
+    for frame_idx in frames:
+        plane = np.asarray(output[frame_idx])
+        stale = np.isin(plane, obj_ids)
+        if stale.any():
+            plane[stale] = 0
+            output[frame_idx] = plane
+
+
+# Keeps the z extent of every object while propagating and counts how many
+# frames in a row an object has been empty since it left its prompted
+# frames, so a pass can stop once every object has disappeared.
+class ObjectExtents:
+    def __init__(self, prompts, stop_after_empty=None):
+        self.prompts = prompts
+        self.stop_after_empty = stop_after_empty
+        self.extents = {}
+        self._empty_run = {}
+        self._prompt_bounds = {}
+        self._reverse = False
+
+    def start_pass(self, reverse):
+        self._reverse = reverse
+        self._empty_run = {}
+        self._prompt_bounds = {}
+        for obj_id in self.prompts.objects():
+            frames = self.prompts.frames(obj_id)
+            self._prompt_bounds[obj_id] = (frames[0], frames[-1])
+
+    # True once the pass has moved beyond every prompt of the object
+    def _past_prompts(self, obj_id, frame_idx):
+        if obj_id not in self._prompt_bounds:
+            return True
+        first, last = self._prompt_bounds[obj_id]
+        return frame_idx < first if self._reverse else frame_idx > last
+
+    # present[i] tells whether out_obj_ids[i] has any foreground pixel
+    def update(self, frame_idx, out_obj_ids, present):
+        for obj_id, is_present in zip(out_obj_ids, present):
+            obj_id = int(obj_id)
+            if is_present:
+                lo, hi = self.extents.get(obj_id, (frame_idx, frame_idx))
+                self.extents[obj_id] = (min(lo, frame_idx), max(hi, frame_idx))
+                self._empty_run[obj_id] = 0
+            elif self._past_prompts(obj_id, frame_idx):
+                self._empty_run[obj_id] = self._empty_run.get(obj_id, 0) + 1
+
+    # Stop the pass when every object has been empty for long enough
+    def pass_finished(self, out_obj_ids):
+        if not self.stop_after_empty:
+            return False
+        return all(
+            self._empty_run.get(int(obj_id), 0) >= self.stop_after_empty
+            for obj_id in out_obj_ids
+        )
+
+
+# Intersection over union of two boolean masks, 1 when both are empty
+def mask_iou(a, b):
+    union = np.count_nonzero(a | b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(a & b) / union
+
+
+# Replace the pixels of one object on a frame with mask, in place. Pixels
+# it loses become background and it only gains background pixels, other
+# objects are never overwritten. Returns the IoU of the new mask with the
+# stored one.
+def replace_object_mask(output, frame_idx, obj_id, mask):
+    plane = output[frame_idx]
+    old = plane == obj_id
+    iou = mask_iou(old, mask)
+    if iou < 1.0:
+        plane[old & ~mask] = 0
+        plane[mask & (plane == 0)] = obj_id
+        output[frame_idx] = plane
+    return iou
+
+
+MERGE_RULES = ("forward", "confidence", "newest_prompt")
+
+
+# Smallest unsigned label dtype that can hold max_obj_id
+def label_dtype_for(max_obj_id):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_obj_id <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+# Raise if an object id cannot be stored in the output volume
+def check_label_fits(obj_id, output):
+    dtype = np.dtype(output.dtype)
+    if dtype.kind in "iu" and not (
+            np.iinfo(dtype).min <= obj_id <= np.iinfo(dtype).max
+    ):
+        raise ValueError(
+            f"Label {obj_id} does not fit in the {dtype.name} output layer"
+        )
+
+
+# Writes the frames of a forward and a reverse pass into one output volume
+# in place, one frame at a time. A frame seen only once is written as is.
+# A frame seen by both passes keeps the forward labels, background pixels
+# take the reverse labels, and where both passes found different objects
+# the rule decides:
+#   forward        - the forward pass wins
+#   confidence     - the object with the higher mean logit on that frame wins
+#   newest_prompt  - the object that was clicked most recently wins
+class FrameMerger:
+    def __init__(self, rule="forward", prompts=None):
+        if rule not in MERGE_RULES:
+            raise ValueError(
+                f"Invalid merge rule {rule!r}. Expected one of {MERGE_RULES}."
+            )
+        self.rule = rule
+        self.prompts = prompts
+        self._forward_scores = {}  # frame_idx -> {obj_id: score}
+
+    def merge(self, output, frame_idx, labels, reverse, obj_ids=(), scores=()):
+        if not reverse:
+            output[frame_idx] = labels
+            self._forward_scores[frame_idx] = dict(
+                zip(map(int, obj_ids), map(float, scores))
+            )
+            return
+        forward_scores = self._forward_scores.pop(frame_idx, None)
+        if forward_scores is None:
+            # Only the reverse pass reached this frame
+            output[frame_idx] = labels
+            return
+
+        plane = output[frame_idx]
+        fill = (plane == 0) & (labels != 0)
+        if self.rule != "forward":
+            conflict = np.nonzero((plane != 0) & (labels != 0) & (plane != labels))
+            if len(conflict[0]):
+                existing = plane[conflict]
+                new = labels[conflict]
+                if self.rule == "confidence":
+                    reverse_scores = dict(
+                        zip(map(int, obj_ids), map(float, scores))
+                    )
+                    take_new = self._lookup(new, reverse_scores) > self._lookup(
+                        existing, forward_scores
+                    )
+                else:
+                    take_new = self._lookup(new, None) > self._lookup(
+                        existing, None
+                    )
+                fill[tuple(axis[take_new] for axis in conflict)] = True
+        plane[fill] = labels[fill]
+        output[frame_idx] = plane
+
+    # Per-pixel priority of the labels through a small lookup table
+    def _lookup(self, label_values, scores):
+        unique, inverse = np.unique(label_values, return_inverse=True)
+        if scores is None:
+            priority = [self.prompts.last_click(int(obj_id)) for obj_id in unique]
+        else:
+            priority = [scores.get(int(obj_id), -np.inf) for obj_id in unique]
+        return np.asarray(priority, dtype=np.float64)[inverse]
@@ -0,0 +1,395 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from pipelines.samv2.Samv2_engine import SamV2Engine
+from pipelines.samv2.Samv2_label_output import LabelOutputMixin
+from pipelines.samv2.Samv2_label_store import is_in_memory
+from pipelines.samv2.Samv2_normalization import resolve_contrast_policy
+from pipelines.samv2.Samv2_timing import get_timings, memory_usage
+
+logger = logging.getLogger(__name__)
+
+
+# One index of an axis of an array, seen as an array with one dimension
+# less. Reads and writes go through to the array, so it also works for
+# arrays whose slices are copies (e.g. zarr).
+class AxisView:
+    def __init__(self, array, axis, index):
+        self.array = array
+        self.axis = axis
+        self.index = index
+        self.shape = tuple(
+            size for i, size in enumerate(array.shape) if i != axis
+        )
+        self.dtype = array.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def _key(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:i] + fill + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return key[: self.axis] + (self.index,) + key[self.axis:]
+
+    def __getitem__(self, key):
+        return self.array[self._key(key)]
+
+    def __setitem__(self, key, value):
+        self.array[self._key(key)] = value
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+# Numpy and dask arrays are indexed directly (a view or a lazy slice)
+def axis_view(array, axis, index):
+    if is_in_memory(array) or type(array).__module__.startswith("dask."):
+        return array[(slice(None),) * axis + (index,)]
+    return AxisView(array, axis, index)
+
+
+# 4D (e.g. T x Z x Y x X) volumes. The masks are propagated along
+# propagation_axis (0 or 1) and every index of the other leading axis (the
+# series axis) is an independent 3D sub-volume with its own SamV2Engine.
+# The engines are created on first use and share the pooled predictor, one
+# contrast policy and the 4D output, each writing its own slice of it.
+# Propagation runs max_workers sub-volumes at a time.
+class SeriesEngine(LabelOutputMixin):
+    def __init__(
+            self,
+            volume,
+            checkpoint_path,
+            model_cfg_name,
+            work_dir,
+            name="volume",
+            output=None,
+            propagation_axis=1,
+            max_workers=2,
+            contrast_mode="percentile",
+            contrast_limits=None,
+            **engine_kwargs,
+    ):
+        if volume.ndim != 4:
+            raise ValueError(f"Expected a 4D volume, got {volume.ndim}D")
+        if propagation_axis not in (0, 1):
+            raise ValueError(
+                f"Invalid propagation axis {propagation_axis}, "
+                f"expected 0 or 1"
+            )
+        self.image_volume = volume
+        self.checkpoint_path = checkpoint_path
+        self.model_cfg_name = model_cfg_name
+        self.work_dir = Path(work_dir)
+        self.name = name
+        self.propagation_axis = propagation_axis
+        self.series_axis = 1 - propagation_axis
+        self.max_workers = max_workers
+        self.engine_kwargs = engine_kwargs
+        self.engines = {}
+        self._pending = {}
+        self.last_index = None
+        self.timings = get_timings()
+        self._lock = threading.Lock()
+        self._output = (
+            output
+            if output is not None
+            else np.zeros(volume.shape, dtype=np.int32)
+        )
+
+        # One intensity mapping for every sub-volume
+        policy_dir = self.work_dir / Path(self.name)
+        policy_dir.mkdir(parents=True, exist_ok=True)
+        with self.timings.span("frames.contrast_policy"):
+            self.contrast_policy = resolve_contrast_policy(
+                policy_dir / "contrast_policy.json",
+                volume,
+                contrast_mode,
+                contrast_limits=contrast_limits,
+            )
+
+    def __len__(self):
+        return self.image_volume.shape[self.series_axis]
+
+    # The engines write into views of the 4D output, rebuilt when it is
+    # replaced
+    @property
+    def output(self):
+        return self._output
+
+    @output.setter
+    def output(self, output):
+        with self._lock:
+            self._output = output
+            for index, engine in self.engines.items():
+                engine.output = axis_view(output, self.series_axis, index)
+
+    # Engine of one sub-volume, created on first use. The engine is built
+    # outside the lock (it converts frames and loads the predictor), so
+    # other sub-volumes are not held up; callers asking for an index that
+    # is being built wait for that build.
+    def engine(self, index):
+        with self._lock:
+            if index in self.engines:
+                return self.engines[index]
+            if not 0 <= index < len(self):
+                raise IndexError(f"Sub-volume {index} out of range")
+            pending = self._pending.get(index)
+            building = pending is None
+            if building:
+                pending = self._pending[index] = Future()
+            output = self._output
+        if not building:
+            return pending.result()
+
+        axis_name = "tz"[self.series_axis]
+        try:
+            engine = SamV2Engine(
+                axis_view(self.image_volume, self.series_axis, index),
+                self.checkpoint_path,
+                self.model_cfg_name,
+                self.work_dir,
+                name=f"{self.name}_{axis_name}{index}",
+                output=axis_view(output, self.series_axis, index),
+                contrast_policy=self.contrast_policy,
+                **self.engine_kwargs,
+            )
+        except BaseException as e:
+            with self._lock:
+                del self._pending[index]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            # The output may have been replaced during the build
+            if self._output is not output:
+                engine.output = axis_view(self._output, self.series_axis, index)
+            self.engines[index] = engine
+            del self._pending[index]
+        pending.set_result(engine)
+        return engine
+
+    # Index of the 4D label plane of a frame of a sub-volume
+    def plane_key(self, index, frame_idx):
+        key = [0, 0]
+        key[self.series_axis] = index
+        key[self.propagation_axis] = frame_idx
+        return tuple(key)
+
+    # (sub-volume, frame, y, x) of a 4D point
+    def split_point(self, point):
+        leading = (int(point[0]), int(point[1]))
+        return (
+            leading[self.series_axis],
+            leading[self.propagation_axis],
+            int(point[2]),
+            int(point[3]),
+        )
+
+    # Add one click at a 4D point. Returns the key of its label plane and
+    # the plane, see SamV2Engine.add_point.
+    def add_point(self, point, obj_id, neg_or_pos=1, write=True):
+        index, frame_idx, y, x = self.split_point(point)
+        plane = self.engine(index).add_point(
+            frame_idx, y, x, obj_id, neg_or_pos, write=write
+        )
+        self.last_index = index
+        return self.plane_key(index, frame_idx), plane
+
+    # Batch of (a0, a1, y, x, label, obj_id) rows, see SamV2Engine.add_prompts
+    def add_prompts(self, prompts):
+        per_index = {}
+        for *point, label, obj_id in prompts:
+            index, frame_idx, y, x = self.split_point(point)
+            per_index.setdefault(index, []).append(
+                (frame_idx, y, x, label, obj_id)
+            )
+        return sum(
+            self.engine(index).add_prompts(rows)
+            for index, rows in sorted(per_index.items())
+        )
+
+    @property
+    def prompted_indices(self):
+        return sorted(
+            index for index, engine in self.engines.items() if engine.prompts
+        )
+
+    # Generator over the propagated frames of every prompted sub-volume
+    # (or of indices), max_workers of them at a time on worker threads.
+    # Yields (plane_key, progress) as the frames are written; closing the
+    # generator stops the workers after their current frame.
+    def iter_video_propagate(self, indices=None, max_workers=None, **kwargs):
+        indices = self.prompted_indices if indices is None else list(indices)
+        if not indices:
+            logger.warning("No prompts to propagate")
+            return
+        yield from self._run_parallel(
+            indices,
+            lambda engine: engine.iter_video_propagate(**kwargs),
+            max_workers,
+        )
+
+    def _run_parallel(self, indices, make_generator, max_workers=None):
+        workers = max(1, min(max_workers or self.max_workers, len(indices)))
+        logger.info(
+            "Propagating %d sub-volumes with %d workers", len(indices), workers
+        )
+        # Bounded, so pausing the consumer also pauses the workers
+        results = queue.Queue(maxsize=4 * workers)
+        stop = threading.Event()
+        progress = dict.fromkeys(indices, 0)
+
+        def run(index):
+            frames = make_generator(self.engine(index))
+            try:
+                for frame_idx, frame_progress in frames:
+                    item = (index, frame_idx, frame_progress)
+                    while not stop.is_set():
+                        try:
+                            results.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+            finally:
+                frames.close()
+
+        with ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="samv2-series"
+        ) as pool:
+            futures = [pool.submit(run, index) for index in indices]
+            try:
+                while True:
+                    try:
+                        index, frame_idx, frame_progress = results.get(
+                            timeout=0.1
+                        )
+                    except queue.Empty:
+                        for future in futures:
+                            if future.done() and future.exception():
+                                raise future.exception() from None
+                        if all(f.done() for f in futures) and results.empty():
+                            break
+                        continue
+                    progress[index] = frame_progress
+                    yield (
+                        self.plane_key(index, frame_idx),
+                        sum(progress.values()) // len(indices),
+                    )
+            finally:
+                stop.set()
+
+    # Preview of every prompted sub-volume, see
+    # SamV2Engine.iter_preview_propagate
+    def iter_preview_propagate(self, max_workers=None, **kwargs):
+        indices = self.prompted_indices
+        if not indices:
+            logger.warning("No prompts to preview")
+            return
+        yield from self._run_parallel(
+            indices,
+            lambda engine: engine.iter_preview_propagate(**kwargs),
+            max_workers,
+        )
+
+    # Full resolution pass of obj_ids (by default the previewed objects) in
+    # every sub-volume holding them, see SamV2Engine.iter_refine_objects
+    def iter_refine_objects(self, obj_ids=None, max_workers=None, **kwargs):
+        if obj_ids is None:
+            indices = [
+                index
+                for index in self.prompted_indices
+                if self.engines[index].preview_objects
+            ]
+        else:
+            indices = [
+                index
+                for index in self.prompted_indices
+                if any(obj_id in self.engines[index].prompts for obj_id in obj_ids)
+            ]
+        if not indices:
+            logger.warning("No prompted objects to refine")
+            return
+        yield from self._run_parallel(
+            indices,
+            lambda engine: engine.iter_refine_objects(obj_ids, **kwargs),
+            max_workers,
+        )
+
+    @property
+    def preview_objects(self):
+        return set().union(
+            *(engine.preview_objects for engine in self.engines.values())
+        )
+
+    # Blocking propagation of every prompted sub-volume
+    def propagate(self, **kwargs):
+        for _ in self.iter_video_propagate(**kwargs):
+            pass
+        return self.output
+
+    # Re-propagate the object of the last click, see
+    # SamV2Engine.iter_incremental_propagate
+    def iter_incremental_propagate(self, **kwargs):
+        if self.last_index is None:
+            logger.warning("No correction to propagate")
+            return
+        index = self.last_index
+        for frame_idx, progress in self.engines[index].iter_incremental_propagate(
+                **kwargs
+        ):
+            yield self.plane_key(index, frame_idx), progress
+
+    # Frame range (along the propagation axis) of every object over all
+    # sub-volumes
+    @property
+    def object_extents(self):
+        extents = {}
+        for engine in self.engines.values():
+            for obj_id, (z_min, z_max) in engine.object_extents.items():
+                lo, hi = extents.get(obj_id, (z_min, z_max))
+                extents[obj_id] = (min(lo, z_min), max(hi, z_max))
+        return extents
+
+    # Memory reports of the sub-volumes, added up
+    def memory_report(self):
+        report = {}
+        for engine in list(self.engines.values()):
+            for key, value in engine.memory_report().items():
+                report[key] = report.get(key, 0) + value
+        return report
+
+    def performance_summary(self):
+        if self.engines:
+            summary = next(iter(self.engines.values())).performance_summary()
+            summary["resident"] = self.memory_report()
+            return summary
+        return {"stages": self.timings.summary(), "memory": memory_usage()}
+
+    def clear_prompts(self):
+        for engine in self.engines.values():
+            engine.clear_prompts()
+        self.last_index = None
+
+    def reset(self):
+        self.clear_prompts()
+        self.output[...] = 0
+
+    def close(self):
+        for engine in self.engines.values():
+            engine.close()
+        self.engines.clear()
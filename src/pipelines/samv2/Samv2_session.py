@@ -0,0 +1,315 @@
+import importlib.metadata
+import io
+import json
+import logging
+import os
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from pipelines.samv2.Samv2_prompts import PromptStore
+from pipelines.samv2.Samv2_propagation import check_label_fits
+from pipelines.samv2.Samv2_sparse_labels import iter_label_planes
+from pipelines.samv2.Samv2_timing import get_timings
+
+logger = logging.getLogger(__name__)
+
+SESSION_FORMAT = 1
+SESSION_SUFFIX = ".samv2"
+
+# Entries of a SAM2 inference state holding the prompts and the tracker
+# memory (conditioning and propagated frame outputs). Which of them exist
+# depends on the sam2 version, the frames and cached features do not go
+# into a session.
+TRACKER_STATE_KEYS = (
+    "obj_id_to_idx",
+    "obj_idx_to_id",
+    "obj_ids",
+    "point_inputs_per_obj",
+    "mask_inputs_per_obj",
+    "output_dict",
+    "output_dict_per_obj",
+    "temp_output_dict_per_obj",
+    "consolidated_frame_inds",
+    "tracking_has_started",
+    "frames_already_tracked",
+    "frames_tracked_per_obj",
+    "constants",
+)
+# Kept on the storage device of the state (the CPU when the state is
+# offloaded), every other tensor lives on the model device
+STORAGE_DEVICE_KEYS = ("maskmem_features", "pred_masks")
+
+
+# Version of the installed sam2 package, None when it cannot be told
+def sam2_version():
+    try:
+        import sam2
+    except ImportError:
+        return None
+    version = getattr(sam2, "__version__", None)
+    if version:
+        return str(version)
+    # The upstream package does not set __version__, only its distribution
+    for dist_name in ("SAM-2", "sam2"):
+        try:
+            return importlib.metadata.version(dist_name)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+    return None
+
+
+# File name of the checkpoint of an engine (the cache directory may differ
+# between machines)
+def checkpoint_name(engine):
+    path = getattr(engine, "checkpoint_path", None)
+    return Path(path).name if path else None
+
+
+# Copy of a state entry with every tensor on the CPU. Sets become tagged
+# lists, torch.load(weights_only=True) does not allow them.
+def _to_saved(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu()
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(value)}
+    if isinstance(value, dict):
+        # Other dict types (e.g. spilling frame outputs) are saved as dicts
+        cls = type(value) if type(value) in (dict, OrderedDict) else dict
+        return cls((k, _to_saved(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_saved(v) for v in value)
+    return value
+
+
+def _to_state(value, state, key=None):
+    if isinstance(value, torch.Tensor):
+        device = (
+            state.get("storage_device", state["device"])
+            if key in STORAGE_DEVICE_KEYS
+            else state["device"]
+        )
+        return value.to(device, non_blocking=True)
+    if isinstance(value, dict):
+        if set(value) == {"__set__"}:
+            return set(value["__set__"])
+        return type(value)(
+            (k, _to_state(v, state, k if isinstance(k, str) else key))
+            for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_state(v, state, key) for v in value)
+    return value
+
+
+# (index, SamV2Engine) of an engine or of the sub-volumes of a SeriesEngine
+def _engines(engine):
+    if hasattr(engine, "engines"):
+        return sorted(engine.engines.items())
+    return [(0, engine)]
+
+
+def _plane_name(key):
+    return "labels/" + ("_".join(str(k) for k in key) or "plane") + ".npy"
+
+
+# Save prompts, tracker memory and labels of an engine (SamV2Engine or
+# SeriesEngine) to one zip file:
+#   session.json      format, model, checkpoint, sam2 version, shapes,
+#                     prompts and object extents
+#   tracker/<i>.pt    inference state entries of (sub-volume) engine i
+#   labels/<key>.npy  every label plane holding an object
+# The entries are deflated. The file is written next to path and renamed,
+# so an interrupted save keeps the previous session.
+def save_session(engine, path):
+    path = Path(path)
+    timings = get_timings()
+    output = engine.output
+    metadata = {
+        "format": SESSION_FORMAT,
+        "name": engine.name,
+        "model_cfg": engine.model_cfg_name,
+        "checkpoint": checkpoint_name(engine),
+        "sam2_version": sam2_version(),
+        "volume_shape": list(engine.image_volume.shape),
+        "label_dtype": np.dtype(output.dtype).name,
+        "propagation_axis": getattr(engine, "propagation_axis", None),
+        "last_index": getattr(engine, "last_index", None),
+        "engines": [],
+    }
+
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with timings.span("session.save"), zipfile.ZipFile(
+            tmp_path, "w", compression=zipfile.ZIP_DEFLATED
+    ) as zf:
+        for index, sub_engine in _engines(engine):
+            state = sub_engine.inference_state
+            tracker_state = {
+                key: _to_saved(state[key])
+                for key in TRACKER_STATE_KEYS
+                if key in state
+            }
+            buffer = io.BytesIO()
+            torch.save(tracker_state, buffer)
+            zf.writestr(f"tracker/{index}.pt", buffer.getvalue())
+            metadata["engines"].append(
+                {
+                    "index": index,
+                    "prompts": sub_engine.prompts.to_dict(),
+                    "object_extents": [
+                        [int(obj_id), int(lo), int(hi)]
+                        for obj_id, (lo, hi) in sorted(
+                            sub_engine.object_extents.items()
+                        )
+                    ],
+                    "last_correction": (
+                        [int(v) for v in sub_engine.last_correction]
+                        if sub_engine.last_correction
+                        else None
+                    ),
+                }
+            )
+
+        planes = 0
+        for key, plane in iter_label_planes(output):
+            with zf.open(_plane_name(key), "w") as f:
+                np.save(f, plane)
+            planes += 1
+        metadata["label_planes"] = planes
+        zf.writestr("session.json", json.dumps(metadata, indent=2))
+    os.replace(tmp_path, path)
+    logger.info(
+        "Saved the session of %s (%d engines, %d label planes) to %s",
+        engine.name,
+        len(metadata["engines"]),
+        planes,
+        path,
+    )
+    return path
+
+
+# Restore a session into an engine made for the same volume and model.
+# The tracker memory goes straight into the inference states, so nothing
+# is encoded or propagated again. Tracker state saved with another sam2
+# version or checkpoint is not used - the prompts are replayed instead
+# (only the prompted frames run through the model). Returns the session
+# metadata.
+def load_session(engine, path):
+    path = Path(path)
+    timings = get_timings()
+    with timings.span("session.load"), zipfile.ZipFile(path) as zf:
+        metadata = json.loads(zf.read("session.json"))
+        if metadata.get("format") != SESSION_FORMAT:
+            raise ValueError(
+                f"{path} has session format {metadata.get('format')}, "
+                f"expected {SESSION_FORMAT}"
+            )
+        if tuple(metadata["volume_shape"]) != tuple(engine.image_volume.shape):
+            raise ValueError(
+                f"{path} was saved for a {tuple(metadata['volume_shape'])} "
+                f"volume, not {tuple(engine.image_volume.shape)}"
+            )
+        if metadata["model_cfg"] != engine.model_cfg_name:
+            raise ValueError(
+                f"{path} was saved with {metadata['model_cfg']}, "
+                f"the engine runs {engine.model_cfg_name}"
+            )
+        if metadata["propagation_axis"] != getattr(
+                engine, "propagation_axis", None
+        ):
+            raise ValueError(
+                f"{path} was propagated along axis "
+                f"{metadata['propagation_axis']}"
+            )
+        replay = None
+        if metadata.get("sam2_version") != sam2_version():
+            replay = (
+                f"saved with sam2 {metadata.get('sam2_version')}, "
+                f"running {sam2_version()}"
+            )
+        elif metadata.get("checkpoint") != checkpoint_name(engine):
+            replay = (
+                f"saved with the {metadata.get('checkpoint')} checkpoint, "
+                f"running {checkpoint_name(engine)}"
+            )
+        if replay:
+            logger.warning(
+                "Replaying the prompts of %s instead of restoring its "
+                "tracker memory (%s)",
+                path,
+                replay,
+            )
+        output = engine.output
+        for record in metadata["engines"]:
+            for obj_id in PromptStore.from_dict(record["prompts"]).objects():
+                check_label_fits(obj_id, output)
+
+        engine.clear_prompts()
+        for record in metadata["engines"]:
+            index = record["index"]
+            sub_engine = (
+                engine.engine(index) if hasattr(engine, "engines") else engine
+            )
+            restore_tracker_state(
+                sub_engine,
+                torch.load(
+                    io.BytesIO(zf.read(f"tracker/{index}.pt")),
+                    map_location="cpu",
+                    weights_only=True,
+                ),
+                PromptStore.from_dict(record["prompts"]),
+                replay=bool(replay),
+            )
+            sub_engine.object_extents = {
+                obj_id: (lo, hi) for obj_id, lo, hi in record["object_extents"]
+            }
+            last_correction = record["last_correction"]
+            sub_engine.last_correction = (
+                tuple(last_correction) if last_correction else None
+            )
+        if hasattr(engine, "engines"):
+            engine.last_index = metadata["last_index"]
+
+        output[...] = 0
+        for name in zf.namelist():
+            if not name.startswith("labels/"):
+                continue
+            stem = name[len("labels/"): -len(".npy")]
+            key = (
+                ()
+                if stem == "plane"
+                else tuple(int(k) for k in stem.split("_"))
+            )
+            with zf.open(name) as f:
+                output[key] = np.load(f).astype(output.dtype, copy=False)
+    logger.info(
+        "Loaded the session of %s (%d label planes) from %s",
+        metadata["name"],
+        metadata["label_planes"],
+        path,
+    )
+    return metadata
+
+
+# Put saved inference state entries (see TRACKER_STATE_KEYS) into the
+# state of an engine and take over its prompts. With replay, the saved
+# state was made by another sam2 version or checkpoint and the prompts are
+# sent to the model again instead.
+def restore_tracker_state(engine, tracker_state, prompts, replay=False):
+    state = engine.inference_state
+    engine.predictor.reset_state(state)
+    if replay:
+        engine.prompts = PromptStore()
+        engine.add_prompts(
+            (frame_idx, y, x, label, obj_id)
+            for obj_id, frame_idx, points, labels in prompts.items()
+            for (x, y), label in zip(points.tolist(), labels.tolist())
+        )
+        engine.prompts = prompts
+        return
+    for key, value in tracker_state.items():
+        state[key] = _to_state(value, state)
+    engine.prompts = prompts
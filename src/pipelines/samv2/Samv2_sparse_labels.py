@@ -0,0 +1,385 @@
+import itertools
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from pipelines.samv2.Samv2_label_store import (
+    blosc_compression,
+    is_in_memory,
+    open_label_store,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _full_key(key, ndim):
+    key = key if isinstance(key, tuple) else (key,)
+    if any(k is Ellipsis for k in key):
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    if len(key) > ndim:
+        raise IndexError(f"Too many indices for a {ndim}D label volume")
+    return key + (slice(None),) * (ndim - len(key))
+
+
+def _is_full(key, size):
+    return isinstance(key, slice) and key.indices(size) == (0, size, 1)
+
+
+# Label volume stored object by object: every label plane keeps, for every
+# object on it, its bounding box and the bit-packed mask inside the box.
+# Memory grows with the labeled pixels, not with the volume. Planes are
+# rendered to a dense array only when they are read (e.g. the slice napari
+# shows, or the frame propagation merges into), so the volume can back a
+# labels layer and be the output of an engine. Indexing follows numpy for
+# integers and slices; point indices (tuples of integer arrays, as napari
+# paints with) are supported for writes and reads.
+class SparseLabelVolume:
+    def __init__(self, shape, dtype=np.int32):
+        if len(shape) < 2:
+            raise ValueError(f"Expected at least 2 dimensions, got {shape}")
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        # plane key -> {obj_id: (y0, y1, x0, x1, packed bits)}
+        self._planes = {}
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def plane_shape(self):
+        return self.shape[-2:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    # Bytes held by the packed masks
+    @property
+    def nbytes(self):
+        return sum(
+            bits.nbytes
+            for objects in self._planes.values()
+            for *_, bits in objects.values()
+        )
+
+    # Sorted keys of the planes holding at least one object
+    def planes(self):
+        return sorted(self._planes)
+
+    def objects(self, plane_key):
+        return sorted(self._planes.get(tuple(plane_key), {}))
+
+    # Mask of one object inside its bounding box: (y0, x0, boolean crop)
+    def object_mask(self, plane_key, obj_id):
+        y0, y1, x0, x1, bits = self._planes[tuple(plane_key)][obj_id]
+        crop = np.unpackbits(bits, count=(y1 - y0) * (x1 - x0))
+        return y0, x0, crop.reshape(y1 - y0, x1 - x0).view(bool)
+
+    def render(self, plane_key):
+        plane = np.zeros(self.plane_shape, dtype=self.dtype)
+        for obj_id in self.objects(plane_key):
+            y0, x0, crop = self.object_mask(plane_key, obj_id)
+            window = plane[y0: y0 + crop.shape[0], x0: x0 + crop.shape[1]]
+            window[crop] = obj_id
+        return plane
+
+    # Store the pixels (ys, xs) of an object, replacing its old mask
+    def set_object(self, plane_key, obj_id, ys, xs):
+        plane_key = tuple(plane_key)
+        objects = self._planes.setdefault(plane_key, {})
+        if len(ys) == 0:
+            objects.pop(obj_id, None)
+        else:
+            y0, y1 = int(ys.min()), int(ys.max()) + 1
+            x0, x1 = int(xs.min()), int(xs.max()) + 1
+            crop = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+            crop[ys - y0, xs - x0] = True
+            objects[int(obj_id)] = (y0, y1, x0, x1, np.packbits(crop))
+        if not objects:
+            del self._planes[plane_key]
+
+    # Encode a dense plane. Only the labeled pixels are sorted and split by
+    # object, background costs one pass of np.flatnonzero.
+    def store(self, plane_key, plane):
+        plane_key = tuple(plane_key)
+        plane = np.asarray(plane)
+        self._planes.pop(plane_key, None)
+        flat = plane.ravel()
+        index = np.flatnonzero(flat)
+        if not index.size:
+            return
+        values = flat[index]
+        order = np.argsort(values, kind="stable")
+        index, values = index[order], values[order]
+        splits = np.flatnonzero(np.diff(values)) + 1
+        for obj_index, obj_values in zip(
+                np.split(index, splits), np.split(values, splits)
+        ):
+            ys, xs = np.divmod(obj_index, plane.shape[1])
+            self.set_object(plane_key, obj_values[0], ys, xs)
+
+    # Leading (plane) part of a key: the plane keys it selects and the
+    # shape of the kept leading axes
+    def _lead(self, key):
+        ranges, shape = [], []
+        for k, size in zip(key[:-2], self.shape[:-2]):
+            if isinstance(k, slice):
+                ranges.append(range(*k.indices(size)))
+                shape.append(len(ranges[-1]))
+            else:
+                k = int(k)
+                ranges.append([k + size if k < 0 else k])
+        return list(itertools.product(*ranges)), tuple(shape)
+
+    @staticmethod
+    def _is_point_key(key):
+        return any(
+            isinstance(k, (np.ndarray, list)) and np.ndim(k) > 0 for k in key
+        )
+
+    def __getitem__(self, key):
+        key = _full_key(key, self.ndim)
+        if self._is_point_key(key):
+            return self._get_points(key)
+        plane_keys, lead_shape = self._lead(key)
+        yx = key[-2:]
+        planes = [self.render(plane_key)[yx] for plane_key in plane_keys]
+        if not lead_shape:
+            return planes[0]
+        region = np.broadcast_to(self.dtype.type(0), self.plane_shape)[yx].shape
+        if not planes:
+            return np.zeros(lead_shape + region, dtype=self.dtype)
+        return np.stack(planes).reshape(lead_shape + region)
+
+    def __setitem__(self, key, value):
+        key = _full_key(key, self.ndim)
+        if self._is_point_key(key):
+            self._set_points(key, value)
+            return
+        plane_keys, lead_shape = self._lead(key)
+        yx = key[-2:]
+        whole_planes = all(
+            _is_full(k, size) for k, size in zip(yx, self.plane_shape)
+        )
+        value = np.asarray(value, dtype=self.dtype)
+        if value.ndim == 0 and value == 0 and whole_planes:
+            # Clearing costs nothing
+            for plane_key in plane_keys:
+                self._planes.pop(plane_key, None)
+            return
+        region = np.broadcast_to(self.dtype.type(0), self.plane_shape)[yx].shape
+        value = np.broadcast_to(value, lead_shape + region).reshape(
+            (len(plane_keys),) + region
+        )
+        for plane_key, plane_value in zip(plane_keys, value):
+            if whole_planes:
+                self.store(plane_key, plane_value)
+            else:
+                plane = self.render(plane_key)
+                plane[yx] = plane_value
+                self.store(plane_key, plane)
+
+    # Point indices grouped by plane
+    def _point_groups(self, key):
+        coords = np.broadcast_arrays(*(np.asarray(k) for k in key))
+        coords = [c.ravel() for c in coords]
+        lead = np.stack(coords[:-2], axis=1) if self.ndim > 2 else None
+        if lead is None:
+            yield (), np.arange(len(coords[0])), coords[-2], coords[-1]
+            return
+        planes, inverse = np.unique(lead, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for i, plane_key in enumerate(planes):
+            which = np.flatnonzero(inverse == i)
+            yield (
+                tuple(int(k) for k in plane_key),
+                which,
+                coords[-2][which],
+                coords[-1][which],
+            )
+
+    def _get_points(self, key):
+        shape = np.broadcast_shapes(*(np.shape(k) for k in key))
+        out = np.zeros(int(np.prod(shape)), dtype=self.dtype)
+        for plane_key, which, ys, xs in self._point_groups(key):
+            out[which] = self.render(plane_key)[ys, xs]
+        return out.reshape(shape)
+
+    def _set_points(self, key, value):
+        value = np.asarray(value, dtype=self.dtype)
+        for plane_key, which, ys, xs in self._point_groups(key):
+            plane = self.render(plane_key)
+            plane[ys, xs] = value if value.ndim == 0 else value.ravel()[which]
+            self.store(plane_key, plane)
+
+    def __array__(self, dtype=None, copy=None):
+        volume = np.zeros(self.shape, dtype=dtype or self.dtype)
+        for plane_key in self.planes():
+            volume[plane_key] = self.render(plane_key)
+        return volume
+
+    # Sparse copy of a dense (or lazy) label volume, read plane by plane
+    @classmethod
+    def from_array(cls, array, dtype=None):
+        labels = cls(array.shape, dtype or array.dtype)
+        for plane_key in np.ndindex(*array.shape[:-2]):
+            plane = np.asarray(array[plane_key])
+            if plane.any():
+                labels.store(plane_key, plane)
+        return labels
+
+
+# Labels of a dense or sparse volume as (plane key, plane), skipping the
+# empty planes of sparse volumes
+def iter_label_planes(labels):
+    if isinstance(labels, SparseLabelVolume):
+        for plane_key in labels.planes():
+            yield plane_key, labels.render(plane_key)
+        return
+    for plane_key in np.ndindex(*labels.shape[:-2]):
+        plane = np.asarray(labels[plane_key])
+        if plane.any():
+            yield plane_key, plane
+
+
+# Write labels to a chunked zarr volume compressed with blosc (zstd,
+# bit shuffle). Chunks are single frames and only frames holding labels
+# are written, so the store size follows the labeled voxels.
+def export_zarr(labels, path):
+    reused = Path(path).exists()
+    store = open_label_store(
+        path, labels.shape, labels.dtype, compression=blosc_compression()
+    )
+    if reused:
+        # A new store is empty already, an old one may hold other labels
+        store[...] = 0
+    planes = 0
+    for plane_key, plane in iter_label_planes(labels):
+        store[plane_key] = plane
+        planes += 1
+    logger.info("Exported %d label planes to %s", planes, path)
+    return store
+
+
+# Column major run lengths of the pixels (ys, xs) of an image of shape,
+# starting with a background run (the uncompressed COCO RLE counts)
+def rle_counts(ys, xs, shape):
+    height, width = shape
+    index = np.sort(np.asarray(xs, dtype=np.int64) * height + ys)
+    if not index.size:
+        return [height * width]
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    starts = index[np.r_[0, breaks]]
+    ends = index[np.r_[breaks - 1, index.size - 1]] + 1
+    counts = np.empty(2 * starts.size + 1, dtype=np.int64)
+    counts[0] = starts[0]
+    counts[1:-1:2] = ends - starts
+    counts[2:-1:2] = starts[1:] - ends[:-1]
+    counts[-1] = height * width - ends[-1]
+    return counts.tolist()
+
+
+# Pixels (ys, xs) of uncompressed COCO RLE counts
+def rle_pixels(counts, shape):
+    height, _ = shape
+    bounds = np.cumsum(counts)
+    starts, ends = bounds[0:-1:2], bounds[1::2]
+    if len(ends):
+        index = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+    else:
+        index = np.empty(0, dtype=np.int64)
+    xs, ys = np.divmod(index, height)
+    return ys, xs
+
+
+# Write labels as COCO style JSON: one image per label plane ("plane" holds
+# its key) and one annotation per object and plane with an uncompressed RLE
+# mask (pycocotools reads it with frPyObjects), its bbox and area.
+def export_coco_rle(labels, path):
+    height, width = labels.shape[-2:]
+    images, annotations = [], []
+    sparse = (
+        labels
+        if isinstance(labels, SparseLabelVolume)
+        else SparseLabelVolume.from_array(labels)
+    )
+    for image_id, plane_key in enumerate(sparse.planes(), start=1):
+        images.append(
+            {
+                "id": image_id,
+                "plane": list(plane_key),
+                "height": height,
+                "width": width,
+            }
+        )
+        for obj_id in sparse.objects(plane_key):
+            y0, x0, crop = sparse.object_mask(plane_key, obj_id)
+            ys, xs = np.nonzero(crop)
+            annotations.append(
+                {
+                    "id": len(annotations) + 1,
+                    "image_id": image_id,
+                    "category_id": 1,
+                    "object_id": int(obj_id),
+                    "segmentation": {
+                        "size": [height, width],
+                        "counts": rle_counts(ys + y0, xs + x0, (height, width)),
+                    },
+                    "bbox": [
+                        int(x0),
+                        int(y0),
+                        int(crop.shape[1]),
+                        int(crop.shape[0]),
+                    ],
+                    "area": int(ys.size),
+                    "iscrowd": 0,
+                }
+            )
+    coco = {
+        "info": {
+            "shape": list(labels.shape),
+            "dtype": np.dtype(labels.dtype).name,
+        },
+        "images": images,
+        "annotations": annotations,
+        "categories": [{"id": 1, "name": "object"}],
+    }
+    with open(path, "w") as f:
+        json.dump(coco, f)
+    logger.info(
+        "Exported %d objects on %d planes to %s",
+        len(annotations),
+        len(images),
+        path,
+    )
+    return Path(path)
+
+
+# Sparse label volume of a COCO RLE file written by export_coco_rle
+def load_coco_rle(path):
+    with open(path) as f:
+        coco = json.load(f)
+    labels = SparseLabelVolume(coco["info"]["shape"], coco["info"]["dtype"])
+    planes = {image["id"]: tuple(image["plane"]) for image in coco["images"]}
+    for annotation in coco["annotations"]:
+        segmentation = annotation["segmentation"]
+        ys, xs = rle_pixels(segmentation["counts"], segmentation["size"])
+        labels.set_object(
+            planes[annotation["image_id"]], annotation["object_id"], ys, xs
+        )
+    return labels
+
+
+# Sparse copy of labels unless they are sparse already
+def as_sparse(labels, dtype=None):
+    if isinstance(labels, SparseLabelVolume) and (
+            dtype is None or labels.dtype == np.dtype(dtype)
+    ):
+        return labels
+    if not is_in_memory(labels):
+        logger.info("Reading %s labels into a sparse volume", labels.shape)
+    return SparseLabelVolume.from_array(labels, dtype)
@@ -0,0 +1,572 @@
+import heapq
+import itertools
+import logging
+
+import numpy as np
+
+from pipelines.samv2.Samv2_frame_source import (
+    VolumeFrameLoader,
+    init_state_from_frames,
+)
+from pipelines.samv2.Samv2_prompts import PromptStore
+from pipelines.samv2.Samv2_propagation import (
+    ObjectExtents,
+    propagation_passes,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# One rectangle of the YX plane, [y0, y1) x [x0, x1)
+class Tile:
+    def __init__(self, index, y0, y1, x0, x1):
+        self.index = index
+        self.y0, self.y1, self.x0, self.x1 = y0, y1, x0, x1
+
+    def __repr__(self):
+        return f"Tile({self.index}, y={self.y0}:{self.y1}, x={self.x0}:{self.x1})"
+
+    @property
+    def shape(self):
+        return self.y1 - self.y0, self.x1 - self.x0
+
+    @property
+    def slices(self):
+        return slice(self.y0, self.y1), slice(self.x0, self.x1)
+
+    def contains(self, y, x):
+        return self.y0 <= y < self.y1 and self.x0 <= x < self.x1
+
+
+# Start offsets of the tiles along one axis, the last tile is flush with
+# the end of the axis
+def _tile_starts(size, tile_size, overlap):
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    starts.append(size - tile_size)
+    return starts
+
+
+# Overlapping tiles covering a height x width plane
+def tile_grid(height, width, tile_size, overlap):
+    if not 0 <= overlap < tile_size:
+        raise ValueError(
+            f"Tile overlap {overlap} must be in [0, tile size {tile_size})"
+        )
+    tiles = []
+    for y0 in _tile_starts(height, tile_size, overlap):
+        for x0 in _tile_starts(width, tile_size, overlap):
+            tiles.append(
+                Tile(
+                    len(tiles),
+                    y0,
+                    min(y0 + tile_size, height),
+                    x0,
+                    min(x0 + tile_size, width),
+                )
+            )
+    return tiles
+
+
+# Blending weights of a tile: 1 in the middle with a linear ramp over the
+# overlap on every side that has a neighbouring tile, so the seams fade
+# from one tile into the next
+def tile_weights(tile, height, width, overlap):
+    def axis_weights(length, has_before, has_after):
+        weights = np.ones(length, dtype=np.float32)
+        n = min(overlap, length)
+        if n:
+            ramp = np.arange(1, n + 1, dtype=np.float32) / (n + 1)
+            if has_before:
+                weights[:n] = np.minimum(weights[:n], ramp)
+            if has_after:
+                weights[-n:] = np.minimum(weights[-n:], ramp[::-1])
+        return weights
+
+    tile_height, tile_width = tile.shape
+    return np.outer(
+        axis_weights(tile_height, tile.y0 > 0, tile.y1 < height),
+        axis_weights(tile_width, tile.x0 > 0, tile.x1 < width),
+    )
+
+
+# Prompts of one tile, in tile coordinates: the clicks that fall inside it
+# and mask prompts for objects that reach into the tile on a prompted frame
+# without being clicked there
+class TilePrompts:
+    def __init__(self):
+        self.clicks = PromptStore()
+        self.masks = {}  # (obj_id, frame_idx) -> bool mask of the tile
+
+    def objects(self):
+        return sorted(
+            set(self.clicks.objects()) | {obj_id for obj_id, _ in self.masks}
+        )
+
+    def frames(self, obj_id=None):
+        return sorted(
+            set(self.clicks.frames(obj_id))
+            | {
+                frame_idx
+                for mask_obj_id, frame_idx in self.masks
+                if obj_id is None or mask_obj_id == obj_id
+            }
+        )
+
+
+# Split prompts between tiles. A tile gets an (object, frame) group if it
+# contains one of the positive clicks of that group, together with every
+# click of the group that falls inside it. When the label planes of the
+# prompted frames are given, the tiles an object covers there without being
+# clicked get its mask instead, so objects spanning several tiles are
+# tracked in all of them. Objects moving into other tiles between the
+# prompted frames are handed over while propagating, see
+# TiledPropagator.follow_objects.
+# Returns {tile index: TilePrompts} for the tiles that got any prompt.
+def route_prompts(prompts, tiles, label_planes=None, min_mask_pixels=64):
+    routed = {}
+    for obj_id, frame_idx, points, labels in prompts.items():
+        clicked = set()
+        for tile in tiles:
+            inside = [
+                i for i, (x, y) in enumerate(points) if tile.contains(y, x)
+            ]
+            if not any(labels[i] == 1 for i in inside):
+                continue
+            clicked.add(tile.index)
+            tile_prompts = routed.setdefault(tile.index, TilePrompts())
+            for i in inside:
+                x, y = points[i]
+                tile_prompts.clicks.add(
+                    obj_id,
+                    frame_idx,
+                    (x - tile.x0, y - tile.y0),
+                    labels[i],
+                )
+
+        if label_planes is None:
+            continue
+        plane = np.asarray(label_planes[frame_idx])
+        for tile in tiles:
+            if tile.index in clicked:
+                continue
+            mask = plane[tile.slices] == obj_id
+            if np.count_nonzero(mask) >= min_mask_pixels:
+                tile_prompts = routed.setdefault(tile.index, TilePrompts())
+                tile_prompts.masks[(obj_id, frame_idx)] = mask
+    return routed
+
+
+# Stitches the per-tile mask logits of one frame. The logits of every
+# object are averaged with the tile weights over the tiles that track it,
+# then each pixel goes to the object with the highest blended logit above
+# the threshold (ties to the lowest object id).
+class FrameBlender:
+    def __init__(self, height, width, tiles, weights, object_regions, threshold=0.0):
+        self.tiles = tiles
+        self.weights = weights
+        self.threshold = threshold
+        self.labels = np.zeros((height, width), dtype=np.int32)
+        self.best = np.empty((height, width), dtype=np.float32)
+        # obj_id -> (y0, y1, x0, x1) bounding box of the tiles tracking it
+        self.object_regions = object_regions
+        self._accumulators = {}
+        self._touched = set()
+
+    # Grow the region of an object to a tile that started tracking it.
+    # Only between frames, the accumulator is rebuilt on the next add.
+    def extend_region(self, obj_id, tile):
+        y0, y1, x0, x1 = self.object_regions.get(
+            obj_id, (tile.y0, tile.y1, tile.x0, tile.x1)
+        )
+        self.object_regions[obj_id] = (
+            min(y0, tile.y0),
+            max(y1, tile.y1),
+            min(x0, tile.x0),
+            max(x1, tile.x1),
+        )
+        self._accumulators.pop(obj_id, None)
+
+    def _accumulator(self, obj_id):
+        if obj_id not in self._accumulators:
+            y0, y1, x0, x1 = self.object_regions[obj_id]
+            self._accumulators[obj_id] = (
+                np.zeros((y1 - y0, x1 - x0), dtype=np.float32),
+                np.zeros((y1 - y0, x1 - x0), dtype=np.float32),
+            )
+        return self._accumulators[obj_id]
+
+    def add(self, tile_index, obj_ids, logits):
+        tile = self.tiles[tile_index]
+        weights = self.weights[tile_index]
+        for i, obj_id in enumerate(obj_ids):
+            weighted_sum, weight_sum = self._accumulator(obj_id)
+            y0, _, x0, _ = self.object_regions[obj_id]
+            region = (
+                slice(tile.y0 - y0, tile.y1 - y0),
+                slice(tile.x0 - x0, tile.x1 - x0),
+            )
+            weighted_sum[region] += weights * logits[i]
+            weight_sum[region] += weights
+            self._touched.add(obj_id)
+
+    # Label plane of the frame plus per object presence and mean logit.
+    # The plane is reused by the next frame.
+    def finish(self):
+        self.labels.fill(0)
+        self.best.fill(self.threshold)
+        obj_ids = sorted(self._touched)
+        present = np.zeros(len(obj_ids), dtype=bool)
+        scores = np.zeros(len(obj_ids), dtype=np.float32)
+
+        for i, obj_id in enumerate(obj_ids):
+            weighted_sum, weight_sum = self._accumulators[obj_id]
+            y0, y1, x0, x1 = self.object_regions[obj_id]
+            blended = np.full_like(weighted_sum, -np.inf)
+            np.divide(weighted_sum, weight_sum, out=blended, where=weight_sum > 0)
+
+            best = self.best[y0:y1, x0:x1]
+            take = blended > best
+            best[take] = blended[take]
+            self.labels[y0:y1, x0:x1][take] = obj_id
+
+            foreground = blended > self.threshold
+            present[i] = foreground.any()
+            if present[i]:
+                scores[i] = blended[foreground].mean()
+            weighted_sum.fill(0)
+            weight_sum.fill(0)
+
+        self._touched.clear()
+        return self.labels, obj_ids, present, scores
+
+
+# Propagates a volume tile by tile. Only tiles holding prompts get an
+# inference state; the tiles are propagated in lockstep, frame by frame,
+# and their masks are blended into full size label planes. When the
+# blended mask of an object reaches into a tile that does not track it
+# (at least min_mask_pixels pixels in the overlap), that tile starts
+# tracking the object from its mask on that frame for the rest of the pass.
+class TiledPropagator:
+    def __init__(
+            self,
+            predictor,
+            volume,
+            tile_size,
+            contrast_policy,
+            overlap=128,
+            max_cached_frames=4,
+            min_mask_pixels=64,
+    ):
+        if volume.ndim == 2:
+            volume = volume[None]
+        self.predictor = predictor
+        self.volume = volume
+        self.num_frames, self.height, self.width = volume.shape
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.contrast_policy = contrast_policy
+        self.max_cached_frames = max_cached_frames
+        self.min_mask_pixels = min_mask_pixels
+        self.tiles = tile_grid(self.height, self.width, tile_size, overlap)
+        self.weights = {}
+        self.states = {}
+        self.routes = {}
+        # (tile index, state) of the tiles that took over objects during
+        # the current pass
+        self.followers = []
+
+    # Inference state over the frames of one tile
+    def tile_state(self, tile_index):
+        if tile_index not in self.weights:
+            self.weights[tile_index] = tile_weights(
+                self.tiles[tile_index], self.height, self.width, self.overlap
+            )
+        frames = VolumeFrameLoader(
+            self.volume,
+            image_size=self.predictor.image_size,
+            contrast_policy=self.contrast_policy,
+            device=self.predictor.device,
+            max_cached_frames=self.max_cached_frames,
+            crop=self.tiles[tile_index].slices,
+        )
+        return init_state_from_frames(self.predictor, frames)
+
+    def add_mask_prompts(self, state, tile_prompts):
+        for (obj_id, frame_idx), mask in tile_prompts.masks.items():
+            self.predictor.add_new_mask(
+                inference_state=state,
+                frame_idx=frame_idx,
+                obj_id=obj_id,
+                mask=mask,
+            )
+
+    # Build the inference state of every tile holding prompts. label_planes
+    # (the output volume) gives the masks of the prompted frames used to
+    # follow objects into neighbouring tiles.
+    def prepare(self, prompts, label_planes=None):
+        self.routes = route_prompts(
+            prompts, self.tiles, label_planes, self.min_mask_pixels
+        )
+        self.states = {}
+        for tile_index, tile_prompts in self.routes.items():
+            state = self.tile_state(tile_index)
+            for obj_id, frame_idx, points, labels in tile_prompts.clicks.items():
+                self.predictor.add_new_points_or_box(
+                    inference_state=state,
+                    frame_idx=frame_idx,
+                    obj_id=obj_id,
+                    points=points,
+                    labels=labels,
+                )
+            self.add_mask_prompts(state, tile_prompts)
+            self.states[tile_index] = state
+        logger.info(
+            "Tiled propagation on %d of %d tiles of %d px",
+            len(self.states),
+            len(self.tiles),
+            self.tile_size,
+        )
+
+    # Bounding box of the tiles tracking each object
+    def object_regions(self):
+        regions = {}
+        for tile_index, tile_prompts in self.routes.items():
+            tile = self.tiles[tile_index]
+            for obj_id in tile_prompts.objects():
+                y0, y1, x0, x1 = regions.get(
+                    obj_id, (tile.y0, tile.y1, tile.x0, tile.x1)
+                )
+                regions[obj_id] = (
+                    min(y0, tile.y0),
+                    max(y1, tile.y1),
+                    min(x0, tile.x0),
+                    max(x1, tile.x1),
+                )
+        return regions
+
+    # Number of frames the passes of every tile will visit at most (tiles
+    # taking over objects during a pass come on top)
+    def total_frames(self, window=None):
+        return sum(
+            max_frames + 1
+            for tile_prompts in self.routes.values()
+            for _, max_frames, _ in propagation_passes(
+                tile_prompts.frames(), self.num_frames, window
+            )
+        )
+
+    # Last frame any tile reaches in one direction
+    def pass_end(self, reverse, window=None):
+        passes = [
+            propagation_passes(tile_prompts.frames(), self.num_frames, window)[
+                1 if reverse else 0
+            ]
+            for tile_prompts in self.routes.values()
+        ]
+        if reverse:
+            return min(start - max_frames for start, max_frames, _ in passes)
+        return max(start + max_frames for start, max_frames, _ in passes)
+
+    # One direction of one tile, yields (frame_idx, tile_index, ids, logits).
+    # skip_start drops the start frame (already stitched when a tile takes
+    # over an object).
+    def _tile_pass(
+            self,
+            tile_index,
+            state,
+            tile_prompts,
+            start_frame_idx,
+            max_frames,
+            reverse,
+            stop_after_empty,
+            skip_start=False,
+    ):
+        extents = ObjectExtents(tile_prompts, stop_after_empty)
+        extents.start_pass(reverse)
+
+        for frame_idx, out_obj_ids, out_mask_logits in (
+                self.predictor.propagate_in_video(
+                    state,
+                    start_frame_idx=start_frame_idx,
+                    max_frame_num_to_track=max_frames,
+                    reverse=reverse,
+                )
+        ):
+            if skip_start and frame_idx == start_frame_idx:
+                continue
+            logits = out_mask_logits[:, 0].float().cpu().numpy()
+            present = (logits > 0).reshape(len(out_obj_ids), -1).any(axis=1)
+            extents.update(frame_idx, out_obj_ids, present)
+            yield frame_idx, tile_index, [int(i) for i in out_obj_ids], logits
+            if extents.pass_finished(out_obj_ids):
+                break
+
+    # Tiles an object of the stitched labels reaches into without being
+    # tracked there. tracked maps obj_id -> tile indices tracking it.
+    # Returns {tile index: TilePrompts} with the object masks on frame_idx.
+    def reached_tiles(self, labels, frame_idx, obj_ids, present, regions, tracked):
+        reached = {}
+        for obj_id, is_present in zip(obj_ids, present):
+            if not is_present:
+                continue
+            y0, y1, x0, x1 = regions[obj_id]
+            mask = labels[y0:y1, x0:x1] == obj_id
+            for tile in self.tiles:
+                if tile.index in tracked[obj_id]:
+                    continue
+                ty0, ty1 = max(tile.y0, y0), min(tile.y1, y1)
+                tx0, tx1 = max(tile.x0, x0), min(tile.x1, x1)
+                if ty0 >= ty1 or tx0 >= tx1:
+                    continue
+                inside = mask[ty0 - y0: ty1 - y0, tx0 - x0: tx1 - x0]
+                if np.count_nonzero(inside) < self.min_mask_pixels:
+                    continue
+                tile_mask = np.zeros(tile.shape, dtype=bool)
+                tile_mask[
+                    ty0 - tile.y0: ty1 - tile.y0, tx0 - tile.x0: tx1 - tile.x0
+                ] = inside
+                tile_prompts = reached.setdefault(tile.index, TilePrompts())
+                tile_prompts.masks[(obj_id, frame_idx)] = tile_mask
+        return reached
+
+    # Start tracking the objects that reached new tiles on frame_idx, from
+    # their stitched masks to the end of the pass. A tile state cannot take
+    # new objects once it has started tracking, so every hand-over gets a
+    # state of its own. Returns the tile passes to merge into the stream.
+    def follow_objects(
+            self,
+            labels,
+            frame_idx,
+            obj_ids,
+            present,
+            blender,
+            tracked,
+            reverse,
+            end,
+            stop_after_empty,
+    ):
+        max_frames = frame_idx - end if reverse else end - frame_idx
+        if max_frames <= 0:
+            return []
+        reached = self.reached_tiles(
+            labels, frame_idx, obj_ids, present, blender.object_regions, tracked
+        )
+        streams = []
+        for tile_index, tile_prompts in sorted(reached.items()):
+            state = self.tile_state(tile_index)
+            self.add_mask_prompts(state, tile_prompts)
+            self.followers.append((tile_index, state))
+            for obj_id in tile_prompts.objects():
+                tracked[obj_id].add(tile_index)
+                blender.extend_region(obj_id, self.tiles[tile_index])
+                logger.debug(
+                    "Object %d reached tile %d on frame %d",
+                    obj_id,
+                    tile_index,
+                    frame_idx,
+                )
+            streams.append(
+                self._tile_pass(
+                    tile_index,
+                    state,
+                    tile_prompts,
+                    frame_idx,
+                    max_frames,
+                    reverse,
+                    stop_after_empty,
+                    skip_start=True,
+                )
+            )
+        return streams
+
+    # Generator over the stitched frames of both passes. Yields
+    # (frame_idx, labels, obj_ids, present, scores, reverse, tile_frames)
+    # where tile_frames counts the tile frames consumed for that frame.
+    def iter_frames(self, window=None, stop_after_empty=None):
+        for reverse in (False, True):
+            self.followers = []
+            blender = FrameBlender(
+                self.height,
+                self.width,
+                self.tiles,
+                self.weights,
+                self.object_regions(),
+            )
+            tracked = {
+                obj_id: {
+                    tile_index
+                    for tile_index, tile_prompts in self.routes.items()
+                    if obj_id in tile_prompts.objects()
+                }
+                for obj_id in blender.object_regions
+            }
+            end = self.pass_end(reverse, window) if self.routes else 0
+
+            # All tiles report frames in the same order, so one merged
+            # stream visits each frame once for all tiles. Tiles taking
+            # over objects join the stream on the next frame.
+            streams = []
+            for tile_index, state in self.states.items():
+                tile_prompts = self.routes[tile_index]
+                start_frame_idx, max_frames, _ = propagation_passes(
+                    tile_prompts.frames(), self.num_frames, window
+                )[1 if reverse else 0]
+                streams.append(
+                    self._tile_pass(
+                        tile_index,
+                        state,
+                        tile_prompts,
+                        start_frame_idx,
+                        max_frames,
+                        reverse,
+                        stop_after_empty,
+                    )
+                )
+            heap = []
+            order = itertools.count()
+
+            def push(stream):
+                item = next(stream, None)
+                if item is not None:
+                    frame_key = -item[0] if reverse else item[0]
+                    heapq.heappush(heap, (frame_key, next(order), item, stream))
+
+            for stream in streams:
+                push(stream)
+
+            current_frame = None
+            tile_frames = 0
+            while heap:
+                _, _, item, stream = heapq.heappop(heap)
+                frame_idx, tile_index, obj_ids, logits = item
+                if current_frame is not None and frame_idx != current_frame:
+                    stitched = blender.finish()
+                    for new_stream in self.follow_objects(
+                            stitched[0],
+                            current_frame,
+                            stitched[1],
+                            stitched[2],
+                            blender,
+                            tracked,
+                            reverse,
+                            end,
+                            stop_after_empty,
+                    ):
+                        push(new_stream)
+                    yield (current_frame, *stitched, reverse, tile_frames)
+                    tile_frames = 0
+                current_frame = frame_idx
+                blender.add(tile_index, obj_ids, logits)
+                tile_frames += 1
+                push(stream)
+            if current_frame is not None:
+                yield (current_frame, *blender.finish(), reverse, tile_frames)
+        self.followers = []
+
+    # Drop the tile states (and the memory they hold)
+    def close(self):
+        self.states = {}
+        self.routes = {}
+        self.followers = []
@@ -0,0 +1,215 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Parent logger of every module of the pipeline
+LOGGER_NAME = "pipelines.samv2"
+
+# Spans kept for the Chrome trace, the oldest are dropped first
+MAX_TRACE_EVENTS = 200_000
+
+
+# Send the pipeline log records to stderr (once) at the given level
+def configure_logging(level=logging.INFO):
+    package_logger = logging.getLogger(LOGGER_NAME)
+    package_logger.setLevel(level)
+    if not package_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s")
+        )
+        package_logger.addHandler(handler)
+    return package_logger
+
+
+class _Stage:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+# Wall clock time of every pipeline stage. Spans are context managers that
+# add to the per stage totals, are logged at DEBUG level and are kept as
+# Chrome trace events. While a torch.profiler capture runs they are also
+# recorded as profiler ranges, so they line up with the torch ops.
+class Timings:
+    def __init__(self, max_events=MAX_TRACE_EVENTS):
+        self._stages = {}
+        self._events = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._model_hooks = weakref.WeakKeyDictionary()
+        self.profiling = False
+
+    def record(self, name, seconds, start=None, **args):
+        end = time.perf_counter()
+        start = end - seconds if start is None else start
+        with self._lock:
+            self._stages.setdefault(name, _Stage()).add(seconds)
+            self._events.append(
+                (name, start, seconds, threading.get_ident(), args or None)
+            )
+        logger.debug("%s took %.2f ms", name, seconds * 1000)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        profiler_range = (
+            torch.profiler.record_function(name)
+            if self.profiling
+            else contextlib.nullcontext()
+        )
+        start = time.perf_counter()
+        try:
+            with profiler_range:
+                yield
+        finally:
+            self.record(name, time.perf_counter() - start, start, **args)
+
+    # Time every call of the predictor's image encoder and memory attention.
+    # GPU work is asynchronous, so sync=True waits for it (slower, exact).
+    def instrument_model(self, predictor, sync=False):
+        if predictor in self._model_hooks:
+            return
+        handles = []
+        for name in ("image_encoder", "memory_attention"):
+            module = getattr(predictor, name, None)
+            if module is None:
+                continue
+            starts = {}
+
+            def pre_hook(module, inputs, starts=starts):
+                if sync and torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                starts[threading.get_ident()] = time.perf_counter()
+
+            def post_hook(module, inputs, output, name=name, starts=starts):
+                start = starts.pop(threading.get_ident(), None)
+                if start is None:
+                    return
+                if sync and torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                self.record(f"model.{name}", time.perf_counter() - start, start)
+
+            handles.append(module.register_forward_pre_hook(pre_hook))
+            handles.append(module.register_forward_hook(post_hook))
+        self._model_hooks[predictor] = handles
+
+    def remove_model_instrumentation(self, predictor):
+        for handle in self._model_hooks.pop(predictor, []):
+            handle.remove()
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._events.clear()
+
+    # {stage: {"count", "total_ms", "mean_ms", "max_ms"}}
+    def summary(self):
+        with self._lock:
+            return {
+                name: {
+                    "count": stage.count,
+                    "total_ms": stage.total * 1000,
+                    "mean_ms": stage.total * 1000 / stage.count,
+                    "max_ms": stage.max * 1000,
+                }
+                for name, stage in self._stages.items()
+            }
+
+    def mean_ms(self, name):
+        stage = self.summary().get(name)
+        return stage["mean_ms"] if stage else None
+
+    # Write the spans as a Chrome trace (chrome://tracing or Perfetto)
+    def export_chrome_trace(self, path):
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+        trace = {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "cat": name.split(".")[0],
+                    "ph": "X",
+                    "ts": (start - self._origin) * 1e6,
+                    "dur": seconds * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                    **({"args": args} if args else {}),
+                }
+                for name, start, seconds, tid, args in events
+            ],
+            "displayTimeUnit": "ms",
+        }
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        logger.info("Wrote %d spans to %s", len(events), path)
+        return path
+
+
+_timings = Timings()
+
+
+# The shared timings of this process
+def get_timings():
+    return _timings
+
+
+# Capture a torch.profiler trace of the block (CPU ops, and CUDA kernels on
+# a GPU) and write it as a Chrome trace to trace_path. The pipeline spans
+# show up as named ranges in the same trace.
+@contextlib.contextmanager
+def torch_profile(trace_path, timings=None):
+    timings = timings or get_timings()
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    timings.profiling = True
+    try:
+        with torch.profiler.profile(activities=activities) as profiler:
+            yield profiler
+    finally:
+        timings.profiling = False
+    profiler.export_chrome_trace(str(trace_path))
+    logger.info("Wrote the torch profiler trace to %s", trace_path)
+
+
+# Current and peak memory in MB: process RSS and, on a GPU, the memory
+# held by torch tensors on that device
+def memory_usage(device=None):
+    usage = {}
+    try:
+        import psutil
+
+        usage["rss_mb"] = psutil.Process().memory_info().rss / 1024**2
+    except ImportError:
+        pass
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        usage["peak_rss_mb"] = peak / (1024**2 if sys.platform == "darwin" else 1024)
+    except ImportError:  # Windows
+        pass
+    device = torch.device(device) if device is not None else None
+    if device is not None and device.type == "cuda":
+        usage["gpu_mb"] = torch.cuda.memory_allocated(device) / 1024**2
+        usage["peak_gpu_mb"] = torch.cuda.max_memory_allocated(device) / 1024**2
+    return usage